@@ -0,0 +1,171 @@
+"""Выгрузка и загрузка таблицы data в колоночном .npz.
+
+Архив — zip из массивов .npy, разбитых на куски по chunk_size записей:
+<кусок>/timer_id, user_id, mode (номера в словаре modes), start_ts,
+duration и заметки одним блобом UTF-8 со смещениями. Куски пишутся и
+читаются по одному, поэтому память не зависит от размера таблицы.
+Строки date/start/finish и time не хранятся: при загрузке они считаются
+по start_ts, duration и часовому поясу пользователя. Пояса из user_settings
+лежат в архиве отдельно (tz_user_id, tz_name) и загружаются первыми.
+
+    python database.py export telegram_bot_timer.db backup.npz
+    python database.py import new.db backup.npz
+"""
+import itertools
+import zipfile
+
+import numpy as np
+
+from database import rebuild_rollup, user_timezones
+from timezones import DEFAULT_TZ, get_zone, shift
+
+# 1 — без часовых поясов пользователей, такие архивы тоже загружаются
+FORMAT_VERSION = 2
+CHUNK_SIZE = 200000
+
+
+def _put(archive, name, array):
+    with archive.open(name + '.npy', 'w', force_zip64=True) as member:
+        np.lib.format.write_array(member, np.ascontiguousarray(array), allow_pickle=False)
+
+
+def export_data(conn, path, chunk_size=CHUNK_SIZE):
+    """Пишет таблицу data в path; возвращает число записей.
+
+    Записи без start_ts/finish_ts (старые строки, которые не удалось
+    разобрать при миграции) выгрузить нельзя: ValueError с их номерами.
+    """
+    broken = [timer_id for timer_id, in conn.execute("SELECT timer_id FROM data"
+                                                      " WHERE start_ts IS NULL OR finish_ts IS NULL"
+                                                      " ORDER BY timer_id LIMIT 11")]
+    if broken:
+        shown = ', '.join(map(str, broken[:10])) + (', ...' if len(broken) > 10 else '')
+        raise ValueError(f"Записи без времени старта или финиша: {shown}. "
+                         "Исправьте или удалите их перед выгрузкой")
+    modes = {}
+    count = 0
+    cur = conn.execute("SELECT timer_id, user_id, mode, start_ts, finish_ts, note"
+                       " FROM data ORDER BY timer_id")
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        _put(archive, 'version', np.array([FORMAT_VERSION]))
+        zones = user_timezones(conn)
+        _put(archive, 'tz_user_id', np.array(list(zones), dtype=np.int64))
+        _put(archive, 'tz_name', np.array(list(zones.values()), dtype=str))
+        for chunk in itertools.count():
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            timer_ids, user_ids, mode_names, starts, finishes, notes = zip(*rows)
+            starts = np.array(starts, dtype=np.int64)
+            notes = [(note or '').encode() for note in notes]
+            prefix = f'{chunk:06d}/'
+            _put(archive, prefix + 'timer_id', np.array(timer_ids, dtype=np.int64))
+            _put(archive, prefix + 'user_id', np.array(user_ids, dtype=np.int64))
+            # Словарное кодирование: категорий единицы, записей миллионы
+            _put(archive, prefix + 'mode', np.array([modes.setdefault(mode, len(modes))
+                                                     for mode in mode_names], dtype=np.uint16))
+            _put(archive, prefix + 'start_ts', starts)
+            _put(archive, prefix + 'duration', np.array(finishes, dtype=np.int64) - starts)
+            _put(archive, prefix + 'note_offsets',
+                 np.concatenate(([0], np.cumsum([len(note) for note in notes], dtype=np.int64))))
+            _put(archive, prefix + 'note_bytes', np.frombuffer(b''.join(notes), dtype=np.uint8))
+            count += len(rows)
+        _put(archive, 'modes', np.array(list(modes) or [''], dtype=str))
+    return count
+
+
+def _local_strings(starts, finishes, user_ids, zones):
+    # Местное время каждой записи по поясу её пользователя: большинство
+    # пользователей в поясе по умолчанию, остальные группами по поясу
+    users, inverse = np.unique(user_ids, return_inverse=True)
+    names = np.array([zones.get(user_id, DEFAULT_TZ) for user_id in users.tolist()])[inverse]
+    local_starts = np.empty_like(starts)
+    local_finishes = np.empty_like(finishes)
+    for name in np.unique(names).tolist():
+        zone = get_zone(name)
+        mask = names == name
+        local_starts[mask] = shift(starts[mask], zone.transitions, zone.offsets)
+        local_finishes[mask] = shift(finishes[mask], zone.transitions, zone.offsets)
+
+    def split(local):
+        # 'YYYY-MM-DDTHH:MM:SS' -> дата и время без цикла по записям
+        text = np.datetime_as_string(local.astype('datetime64[s]'))
+        chars = text.view('<U1').reshape(len(text), -1)
+        return text.astype('<U10'), np.ascontiguousarray(chars[:, 11:19]).view('<U8').ravel()
+
+    _, start_times = split(local_starts)
+    dates, finish_times = split(local_finishes)
+    return dates.tolist(), start_times.tolist(), finish_times.tolist()
+
+
+def import_data(conn, path, chunk_size=CHUNK_SIZE):
+    """Загружает записи из path одной транзакцией и пересчитывает daily_totals.
+
+    timer_id сохраняются, поэтому загружать стоит в пустую таблицу data;
+    при совпадении номеров транзакция откатывается целиком.
+    """
+    count = 0
+    with np.load(path, allow_pickle=False) as archive:
+        version = int(archive['version'][0])
+        if version not in (1, FORMAT_VERSION):
+            raise ValueError(f"Неизвестная версия архива: {version}")
+        modes = archive['modes']
+        chunks = sorted({name.split('/')[0] for name in archive.files if '/' in name})
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version >= 2:
+                conn.executemany("INSERT OR REPLACE INTO user_settings (user_id, tz) VALUES (?, ?)",
+                                 zip(archive['tz_user_id'].tolist(), archive['tz_name'].tolist()))
+            zones = user_timezones(conn)
+            # В пустую таблицу быстрее вставить без индексов и построить их в конце
+            indexes = []
+            if conn.execute("SELECT NOT EXISTS (SELECT 1 FROM data)").fetchone()[0]:
+                indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'"
+                                       " AND tbl_name = 'data' AND sql IS NOT NULL").fetchall()
+                for name, _ in indexes:
+                    conn.execute(f"DROP INDEX {name}")
+            for chunk in chunks:
+                column = {name: archive[f'{chunk}/{name}']
+                          for name in ('timer_id', 'user_id', 'mode', 'start_ts', 'duration',
+                                       'note_offsets', 'note_bytes')}
+                starts = column['start_ts']
+                durations = column['duration']
+                finishes = starts + durations
+                dates, start_times, finish_times = _local_strings(starts, finishes,
+                                                                  column['user_id'], zones)
+                blob = column['note_bytes'].tobytes()
+                offsets = column['note_offsets'].tolist()
+                notes = [blob[begin:end].decode() for begin, end in zip(offsets, offsets[1:])]
+                # executemany по куску: вставка идёт внутри SQLite без обращений к Python на запись
+                for begin in range(0, len(starts), chunk_size):
+                    end = begin + chunk_size
+                    conn.executemany("INSERT INTO data (timer_id, user_id, date, mode, start, finish,"
+                                     " time, note, start_ts, finish_ts)"
+                                     " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     zip(column['timer_id'][begin:end].tolist(),
+                                         column['user_id'][begin:end].tolist(),
+                                         dates[begin:end],
+                                         modes[column['mode'][begin:end]].tolist(),
+                                         start_times[begin:end], finish_times[begin:end],
+                                         durations[begin:end].tolist(), notes[begin:end],
+                                         starts[begin:end].tolist(), finishes[begin:end].tolist()))
+                count += len(starts)
+            for _, sql in indexes:
+                conn.execute(sql)
+            rebuild_rollup(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    return count
+
+
+def dump_size(conn):
+    """Сколько байт заняли бы записи data в текстовом дампе SQLite (.dump)."""
+    size, = conn.execute("SELECT coalesce(sum(length(CAST('INSERT INTO \"data\" VALUES('"
+                         " || quote(timer_id) || ',' || quote(user_id) || ',' || quote(date)"
+                         " || ',' || quote(mode) || ',' || quote(start) || ',' || quote(finish)"
+                         " || ',' || quote(time) || ',' || quote(note) || ',' || quote(start_ts)"
+                         " || ',' || quote(finish_ts) || ');' AS BLOB)) + 1), 0)"
+                         " FROM data").fetchone()
+    return size
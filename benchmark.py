@@ -0,0 +1,1479 @@
+"""Сквозной бенчмарк бота без сети.
+
+Настоящий ConversationHandler из main получает синтетические апдейты, а
+запросы к Bot API отвечает офлайн-заглушка FakeRequest. База заполняется
+генератором с заданным числом пользователей, годами истории и долями
+категорий. Результаты пишутся в JSON, чтобы сравнивать их между коммитами:
+
+    python benchmark.py --users 50 --years 1 --output before.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import ConversationHandler
+from telegram.request import BaseRequest
+
+from database import SCHEMA, migrate, rebuild_rollup
+from timezones import DAY, DEFAULT_TZ, get_zone
+
+DEFAULT_MODES = 'work=4,study=2,read=1,walk=1,rest=2,fun=2,sport=1,food=1'
+SCENARIOS = ('startup', 'dblayer', 'indexscan', 'timeconv', 'histogram', 'dispatch', 'timers',
+             'notes', 'stats', 'export', 'analytics', 'bulkedit', 'ingress', 'workers', 'outbox',
+             'groupcommit', 'registry', 'deadlines')
+PERIODS = ('За день', 'За неделю', 'За месяц', 'За год', 'За всё время')
+# Режимы статистики: все категории сразу и одна категория
+STAT_CATEGORIES = ('Все категории', 'Работа')
+
+
+def parse_modes(text):
+    modes = {}
+    for part in text.split(','):
+        mode, weight = part.split('=')
+        modes[mode.strip()] = float(weight)
+    return modes
+
+
+def seed_database(path, users, years, modes, timers_per_day, seed=1, chunk_size=10000):
+    """Заполняет data синтетической историей и пересчитывает daily_totals.
+
+    У каждого пользователя в каждый день от 0 до 2 * timers_per_day таймеров
+    длиной от минуты до четырёх часов; категории выбираются с весами modes.
+    Возвращает число вставленных записей.
+    """
+    rng = random.Random(seed)
+    mode_names, weights = list(modes), list(modes.values())
+    now = int(time.time())
+    zone = get_zone()
+    today = zone.day_number(now)
+    days = int(years * 365)
+
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    migrate(conn)
+    conn.execute("BEGIN")
+    rows = []
+    count = 0
+    for user_id in range(1, users + 1):
+        for day in range(days, -1, -1):
+            day_start = zone.day_start(today - day)
+            starts = sorted(day_start + rng.randrange(DAY)
+                            for _ in range(rng.randint(0, 2 * timers_per_day)))
+            for start_ts in starts:
+                duration = min(4 * 3600, max(60, int(rng.expovariate(1 / 2400))))
+                finish_ts = start_ts + duration
+                if finish_ts > now:
+                    continue
+                start, finish = zone.localize(start_ts), zone.localize(finish_ts)
+                rows.append((user_id, finish.strftime('%Y-%m-%d'), rng.choices(mode_names, weights)[0],
+                             start.strftime('%H:%M:%S'), finish.strftime('%H:%M:%S'), duration,
+                             'заметка' if rng.random() < 0.1 else '', start_ts, finish_ts))
+            if len(rows) >= chunk_size:
+                conn.executemany("INSERT INTO data (user_id, date, mode, start, finish, time, note,"
+                                 " start_ts, finish_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                count += len(rows)
+                rows = []
+    conn.executemany("INSERT INTO data (user_id, date, mode, start, finish, time, note,"
+                     " start_ts, finish_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    count += len(rows)
+    rebuild_rollup(conn)
+    conn.execute("COMMIT")
+    conn.close()
+    return count
+
+
+def _legacy_days(date, start, finish):
+    # Прежний путь: строки по МСК разбираются strptime, таймер через полночь
+    # поправляется на сутки, дни считаются с постоянным сдвигом +3 часа
+    finish_time = datetime.strptime(f'{date} {finish}', '%Y-%m-%d %H:%M:%S')
+    start_time = datetime.strptime(f'{date} {start}', '%Y-%m-%d %H:%M:%S')
+    elapsed = int((finish_time - start_time).total_seconds())
+    if elapsed < 0:
+        elapsed += 86400
+    finish_ts = int(finish_time.replace(tzinfo=timezone(timedelta(hours=3))).timestamp())
+    start_ts = finish_ts - elapsed
+    parts = []
+    while start_ts < finish_ts:
+        day_number = (start_ts + 10800) // 86400
+        end = min(finish_ts, (day_number + 1) * 86400 - 10800)
+        parts.append((datetime.fromtimestamp(day_number * 86400, timezone.utc).strftime('%Y-%m-%d'),
+                      end - start_ts))
+        start_ts = end
+    return parts
+
+
+def measure_time_conversion(path, runs=3):
+    """Раскладка записей по местным дням: прежний strptime и UNIX-метки через Zone.
+
+    Для каждого способа берётся лучший из runs проходов по всей таблице data.
+    """
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT date, start, finish, start_ts, finish_ts FROM data").fetchall()
+    conn.close()
+    zone = get_zone()
+    starts = [row[3] for row in rows]
+    finishes = [row[4] for row in rows]
+
+    def best(convert):
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            convert()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
+
+    methods = {
+        'strptime': lambda: [_legacy_days(date, start, finish) for date, start, finish, _, _ in rows],
+        'zone': lambda: [zone.split_by_day(start_ts, finish_ts)
+                         for start_ts, finish_ts in zip(starts, finishes)],
+        'zone_vectorized': lambda: zone.split_many(starts, finishes),
+    }
+    results = {'rows': len(rows)}
+    for name, convert in methods.items():
+        seconds = best(convert)
+        results[name] = {'seconds': round(seconds, 4),
+                         'rows_per_second': round(len(rows) / seconds) if seconds else None}
+        print(f"timeconv {name}: {results[name]['rows_per_second']} записей/с", file=sys.stderr)
+    return results
+
+
+def measure_db_layer(path, updates, users):
+    """Задержка обработки updates одновременных апдейтов: прежние запросы и Database.
+
+    Апдейт, как timer_choice и db_info, читает последние записи
+    пользователя и пишет в current_timers. Прежний путь — sqlite3.connect
+    и запросы прямо в event loop, по коммиту на запрос; новый — общий
+    Database с пулом читателей и группировкой записей. Задержка апдейта
+    считается от момента, когда пришли все апдейты, до конца его обработки.
+    """
+    from database import Database
+
+    read_sql = ("SELECT timer_id, date, mode, start, finish, time, note from data"
+                " where user_id = ? order by timer_id desc limit 10")
+
+    def timer_key(number):
+        # Таймеры несуществующих пользователей, чтобы не трогать записи бенчмарка
+        return 10 ** 9 + number
+
+    async def legacy(number):
+        conn = sqlite3.connect(path)
+        cur = conn.cursor()
+        cur.execute(read_sql, (1 + number % users,)).fetchall()
+        cur.execute("INSERT INTO current_timers (user_id, start_ts, mode) VALUES (?, ?, 'work')",
+                    (timer_key(number), int(time.time())))
+        conn.commit()
+        cur.execute("DELETE from current_timers where user_id = ?", (timer_key(number),))
+        conn.commit()
+        cur.close()
+        conn.close()
+
+    async def pooled(database, number):
+        await database.fetchall(read_sql, (1 + number % users,))
+        await database.execute("INSERT INTO current_timers (user_id, start_ts, mode) VALUES (?, ?, 'work')",
+                               (timer_key(number), int(time.time())))
+        await database.execute("DELETE from current_timers where user_id = ?", (timer_key(number),))
+
+    async def burst(handle):
+        latencies = []
+
+        async def timed(number):
+            await handle(number)
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(timed(number) for number in range(updates)))
+        return time.perf_counter() - started, latencies
+
+    async def run():
+        # Прежний путь работал без WAL; Database переключит журнал обратно
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+        results = {}
+        elapsed, latencies = await burst(legacy)
+        results['legacy'] = {'seconds': round(elapsed, 3), **summarize(latencies)}
+        database = Database(path)
+        try:
+            elapsed, latencies = await burst(lambda number: pooled(database, number))
+        finally:
+            await database.close()
+        results['pooled'] = {'seconds': round(elapsed, 3), **summarize(latencies)}
+        return results
+
+    results = {'updates': updates, **asyncio.run(run())}
+    for name in ('legacy', 'pooled'):
+        print(f"dblayer {name}: p50 {results[name]['p50_ms']} мс, p99 {results[name]['p99_ms']} мс",
+              file=sys.stderr)
+    return results
+
+
+def measure_index_scan(directory, rows, users, queries=20):
+    """Запрос таймеров категории за неделю на синтетической таблице из rows записей.
+
+    Прежний запрос — строки date/start через datetime() без индексов, то
+    есть просмотр всей таблицы; новый — диапазон по start_ts на составном
+    индексе (user_id, mode, start_ts). Таблица строится внутри SQLite
+    рекурсивным запросом; таймеры разбросаны по пяти годам хешем номера
+    строки, поэтому таблица одинакова от запуска к запуску.
+    """
+    path = os.path.join(directory, 'index.db')
+    conn = sqlite3.connect(path, isolation_level=None)
+    # Таблица одноразовая: журнал и fsync при заполнении не нужны
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE data (timer_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,"
+                 " date TEXT NOT NULL, mode TEXT NOT NULL, start TEXT, finish TEXT,"
+                 " start_ts INTEGER, finish_ts INTEGER)")
+    now = int(time.time())
+    started = time.perf_counter()
+    # Строки date/start/finish по МСК, как их пишет timer_off
+    conn.execute("INSERT INTO data (user_id, date, mode, start, finish, start_ts, finish_ts)"
+                 " WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i + 1 < :rows),"
+                 " timers AS (SELECT i % :users + 1 AS user_id,"
+                 " json_extract(:modes, '$[' || ((i / :users) % 8) || ']') AS mode,"
+                 " :now - 14400 - i * 2654435761 % (5 * 365 * 86400) AS start_ts,"
+                 " 60 + i * 40503 % 14340 AS duration FROM seq)"
+                 " SELECT user_id, date(start_ts + duration + 10800, 'unixepoch'), mode,"
+                 " time(start_ts + 10800, 'unixepoch'), time(start_ts + duration + 10800, 'unixepoch'),"
+                 " start_ts, start_ts + duration FROM timers",
+                 {'rows': rows, 'users': users, 'now': now,
+                  'modes': json.dumps(['work', 'study', 'read', 'walk', 'rest', 'fun', 'sport', 'food'])})
+    fill_seconds = time.perf_counter() - started
+    print(f"indexscan: таблица из {rows} записей за {fill_seconds:.1f} с", file=sys.stderr)
+
+    since = now - 7 * DAY
+    legacy_since = datetime.fromtimestamp(since + 10800, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    rng = random.Random(1)
+    targets = [rng.randrange(1, users + 1) for _ in range(queries)]
+
+    def timed(sql, params, count):
+        timings = []
+        found = 0
+        for user_id in targets[:count]:
+            started = time.perf_counter()
+            found += len(conn.execute(sql, params(user_id)).fetchall())
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        return {'queries': count, 'rows_found': found,
+                'best_ms': round(1000 * timings[0], 3),
+                'median_ms': round(1000 * timings[len(timings) // 2], 3)}
+
+    results = {'rows': rows, 'users': users, 'fill_seconds': round(fill_seconds, 1)}
+    # Прежний запрос читает всю таблицу, хватит пары повторов
+    results['legacy'] = timed("SELECT date, start, finish FROM data"
+                              " WHERE mode = ? AND user_id = ? AND"
+                              " datetime(date || ' ' || start) >= ? AND"
+                              " datetime(date || ' ' || finish) >= ?",
+                              lambda user_id: ('work', user_id, legacy_since, legacy_since), 2)
+    started = time.perf_counter()
+    conn.execute("CREATE INDEX idx_data_user_mode_start ON data (user_id, mode, start_ts)")
+    results['index_seconds'] = round(time.perf_counter() - started, 1)
+    results['indexed'] = timed("SELECT start_ts, finish_ts FROM data"
+                               " WHERE user_id = ? AND mode = ? AND start_ts >= ?",
+                               lambda user_id: (user_id, 'work', since), queries)
+    conn.close()
+    os.remove(path)
+    print(f"indexscan: прежний запрос {results['legacy']['median_ms']} мс, "
+          f"по индексу {results['indexed']['median_ms']} мс", file=sys.stderr)
+    return results
+
+
+def _legacy_render_category(intervals, time_intervals, date_format):
+    # Прежняя гистограмма: по линии на границу и по вызову bar на каждый таймер
+    import matplotlib.dates as mdates
+    from matplotlib.figure import Figure
+
+    from plotting import _to_png
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter(date_format))
+    for moment in time_intervals:
+        ax.axvline(x=moment, color='gray', linestyle='--', linewidth=0.5)
+    for start_datetime, duration in intervals:
+        ax.bar(start_datetime, duration / 3600, duration / 86400, align='edge', color='b')
+    return _to_png(fig)
+
+
+def measure_histogram(sizes, render_limit, runs=3):
+    """Гистограмма одной категории за год на таймерах из sizes: прежний и векторный путь.
+
+    Прежний путь — разбор строк даты и времени strptime по каждой записи и
+    bar на каждый таймер; новый — bin_intervals по UNIX-меткам и один bar.
+    Прежняя отрисовка на тысячах объектов идёт минутами, поэтому она
+    меряется только до render_limit таймеров.
+    """
+    from plotting import bin_intervals, render_category
+
+    msk = timezone(timedelta(hours=3))
+    now = int(time.time())
+    # Корзины "За год": 30-дневные шаги от полуночи порога
+    first_edge = (now - 365 * DAY + 10800) // DAY * DAY - 10800
+    edges = list(range(first_edge, now + 30 * DAY, 30 * DAY))
+    time_intervals = [datetime.fromtimestamp(edge, msk).replace(tzinfo=None) for edge in edges]
+
+    def best(function, *args):
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            function(*args)
+            timings.append(time.perf_counter() - started)
+        return round(min(timings), 4)
+
+    def legacy_prepare(rows):
+        intervals = []
+        total = 0
+        for date, start, finish in rows:
+            start_datetime = datetime.strptime(f'{date} {start}', '%Y-%m-%d %H:%M:%S')
+            finish_datetime = datetime.strptime(f'{date} {finish}', '%Y-%m-%d %H:%M:%S')
+            duration = int((finish_datetime - start_datetime).total_seconds())
+            if duration < 0:
+                duration += 86400
+            total += duration
+            intervals.append((start_datetime, duration))
+        return intervals
+
+    rng = random.Random(1)
+    results = {}
+    for size in sizes:
+        starts = sorted(rng.randrange(first_edge, now - 4 * 3600) for _ in range(size))
+        finishes = [start + rng.randrange(60, 4 * 3600) for start in starts]
+        rows = [(datetime.fromtimestamp(start, msk).strftime('%Y-%m-%d'),
+                 datetime.fromtimestamp(start, msk).strftime('%H:%M:%S'),
+                 datetime.fromtimestamp(finish, msk).strftime('%H:%M:%S'))
+                for start, finish in zip(starts, finishes)]
+        result = {'legacy_prepare_seconds': best(legacy_prepare, rows),
+                  'bin_seconds': best(bin_intervals, starts, finishes, edges),
+                  'render_seconds': best(render_category, starts, finishes, edges, '%m', DEFAULT_TZ)}
+        if size <= render_limit:
+            result['legacy_render_seconds'] = best(_legacy_render_category, legacy_prepare(rows),
+                                                   time_intervals, '%m')
+        results[size] = result
+        print(f"histogram {size}: разбор строк {result['legacy_prepare_seconds']} с, "
+              f"корзины {result['bin_seconds']} с, отрисовка {result['render_seconds']} с", file=sys.stderr)
+    return results
+
+
+def summarize(values):
+    values = sorted(values)
+
+    def percentile(q):
+        return round(1000 * values[min(len(values) - 1, int(q * len(values)))], 3)
+
+    return {'count': len(values),
+            'mean_ms': round(1000 * sum(values) / len(values), 3),
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(1000 * values[-1], 3)}
+
+
+class FakeBotApi:
+    """Локальный Bot API по HTTP с лимитами Telegram.
+
+    Бот ходит сюда обычным HTTP-клиентом, base_url указывает на
+    127.0.0.1. Отправки сверх лимитов — общего на бота и на каждый чат,
+    токен-бакетами, как их описывает Telegram, — получают 429 с
+    retry_after. Принятые отправки запоминаются в messages:
+    (время, chat_id, метод, параметры, {имя файла: байты}), отказы
+    считаются в rejected. latency — задержка каждого ответа в секундах;
+    max_in_flight — наибольшее число одновременных запросов в один чат.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, latency=0.0):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.latency = latency
+        self.messages = []
+        self.rejected = 0
+        self.max_in_flight = 0
+        self.base_url = None
+        self._in_flight = Counter()
+        self._global = None
+        self._chats = {}
+        self._message_id = 0
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f'http://{host}:{port}/bot'
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def bot(self, token='1:bench'):
+        from telegram import Bot
+
+        return Bot(token, base_url=self.base_url)
+
+    def _limit(self, chat_id):
+        """Сколько секунд ждать до следующей разрешённой отправки в чат, 0 — можно сейчас."""
+        from outbox import TokenBucket
+
+        now = time.monotonic()
+        if self._global is None:
+            self._global = TokenBucket(self.global_rate, self.global_rate, now)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        wait = max(self._global.delay(now), chat.delay(now))
+        if wait <= 0:
+            self._global.take()
+            chat.take()
+        return wait
+
+    def _message(self, chat_id, **fields):
+        self._message_id += 1
+        return {'message_id': self._message_id, 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'}, **fields}
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        params = {}
+        files = {}
+        for name, value in (await request.post()).items():
+            if isinstance(value, web.FileField):
+                files[value.filename] = value.file.read()
+            else:
+                params[name] = value
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {'id': 1, 'is_bot': True,
+                                                             'first_name': 'bench',
+                                                             'username': 'bench_bot'}})
+
+        chat_id = int(params['chat_id'])
+        self._in_flight[chat_id] += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight[chat_id])
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            wait = self._limit(chat_id)
+            if wait > 0:
+                self.rejected += 1
+                retry_after = math.ceil(wait)
+                return web.json_response({'ok': False, 'error_code': 429,
+                                          'description': f'Too Many Requests: retry after {retry_after}',
+                                          'parameters': {'retry_after': retry_after}}, status=429)
+            self.messages.append((time.monotonic(), chat_id, method, params, files))
+            if method == 'sendPhoto':
+                file_id = f'photo{self._message_id}'
+                result = self._message(chat_id, photo=[{'file_id': file_id, 'file_unique_id': file_id,
+                                                        'width': 1000, 'height': 500}])
+            elif method == 'sendDocument':
+                file_id = f'document{self._message_id}'
+                result = self._message(chat_id, document={'file_id': file_id, 'file_unique_id': file_id})
+            else:
+                result = self._message(chat_id, text=params.get('text', ''))
+            return web.json_response({'ok': True, 'result': result})
+        finally:
+            self._in_flight[chat_id] -= 1
+
+
+def measure_outbox(chats, bulk, latency=0.02):
+    """Отправка через Outbox и напрямую в локальный Bot API с лимитами Telegram.
+
+    В каждый из chats чатов одновременно уходит выгрузка из bulk длинных
+    сообщений, а через полсекунды — подтверждение таймера. Напрямую все
+    сообщения отправляются сразу и повторяются после retry_after; Outbox
+    сам держится в лимитах, подтверждения идут с приоритетом HIGH.
+    Задержка — от постановки сообщения до ответа Bot API.
+    """
+    from telegram.error import RetryAfter
+
+    from outbox import Outbox
+
+    # Длинные части выгрузки, чтобы Outbox не склеил их и число сообщений совпало
+    text = 'x' * 3000
+
+    async def run(name):
+        server = FakeBotApi(latency=latency)
+        await server.start()
+        bot = server.bot()
+        await bot.initialize()
+        outbox = Outbox()
+        outbox.start(bot)
+        latencies = {'bulk': [], 'high': []}
+        retries = 0
+
+        async def direct(chat_id):
+            nonlocal retries
+            while True:
+                try:
+                    return await bot.send_message(chat_id, text)
+                except RetryAfter as err:
+                    retries += 1
+                    retry_after = err.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    await asyncio.sleep(retry_after)
+
+        async def send(kind, chat_id, delay):
+            await asyncio.sleep(delay)
+            started = time.perf_counter()
+            if name == 'direct':
+                await direct(chat_id)
+            else:
+                await outbox.send_message(chat_id, text,
+                                          priority=Outbox.HIGH if kind == 'high' else Outbox.BULK)
+            latencies[kind].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send('bulk', chat_id, 0) for chat_id in range(1, chats + 1)
+                               for _ in range(bulk)),
+                             *(send('high', chat_id, 0.5) for chat_id in range(1, chats + 1)))
+        elapsed = time.perf_counter() - started
+        await outbox.close()
+        await bot.shutdown()
+        await server.close()
+        messages = chats * (bulk + 1)
+        return {'seconds': round(elapsed, 2),
+                'messages_per_second': round(messages / elapsed, 1),
+                'rejected_429': server.rejected,
+                'retries': retries,
+                'all': summarize(latencies['bulk'] + latencies['high']),
+                'bulk': summarize(latencies['bulk']),
+                'high': summarize(latencies['high'])}
+
+    results = {'chats': chats, 'messages_per_chat': bulk + 1,
+               'direct': asyncio.run(run('direct')),
+               'outbox': asyncio.run(run('outbox'))}
+    for name in ('direct', 'outbox'):
+        result = results[name]
+        print(f"outbox {name}: {result['messages_per_second']} сообщений/с, "
+              f"429: {result['rejected_429']}, p99 {result['all']['p99_ms']} мс, "
+              f"подтверждения p99 {result['high']['p99_ms']} мс", file=sys.stderr)
+    return results
+
+
+def measure_group_commit(directory, writes, writers):
+    """Записи остановленных таймеров от writers одновременных писателей: пачками и по одной.
+
+    Один и тот же Database с окном 2 мс и пачкой до 64 транзакций против
+    окна 0 и пачки из одной транзакции — то есть COMMIT и fsync на каждую
+    запись, как было в обработчиках.
+    """
+    from database import Database
+    from records import stop_timer
+
+    async def run(name, commit_window, batch_size):
+        database = Database(os.path.join(directory, f'commit_{name}.db'),
+                            commit_window=commit_window, batch_size=batch_size)
+        now = int(time.time())
+        latencies = []
+        numbers = iter(range(writes))
+
+        async def writer():
+            for number in numbers:
+                started = time.perf_counter()
+                await database.transaction(stop_timer, number % 1000, now - 3600 - number, 'work',
+                                           now - number, DEFAULT_TZ)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(writer() for _ in range(writers)))
+        elapsed = time.perf_counter() - started
+        await database.close()
+        return {'seconds': round(elapsed, 3),
+                'writes_per_second': round(writes / elapsed, 1),
+                **summarize(latencies)}
+
+    results = {'writes': writes, 'writers': writers,
+               'per_statement': asyncio.run(run('single', 0, 1)),
+               'group': asyncio.run(run('group', 0.002, 64))}
+    print(f"groupcommit: по одной {results['per_statement']['writes_per_second']} записей/с, "
+          f"пачками {results['group']['writes_per_second']} записей/с", file=sys.stderr)
+    return results
+
+
+def measure_registry(directory, users, spread=2.0, flush_interval=0.05):
+    """Запуск и остановка таймеров users пользователями: прежние запросы и TimerRegistry.
+
+    Каждый пользователь в случайный момент из первых spread секунд
+    запускает таймер и ещё через случайное время до spread секунд
+    останавливает. Задержка операции считается от назначенного момента,
+    то есть вместе с ожиданием занятого event loop. Прежний путь —
+    connect/INSERT/COMMIT на запуск и connect/SELECT/DELETE/COMMIT на
+    остановку прямо в event loop; новый — словарь в памяти и запись в
+    current_timers пачками раз в flush_interval секунд.
+    """
+    from database import Database
+    from timers import TimerRegistry
+
+    rng = random.Random(1)
+    plan = [(user_id, rng.uniform(0, spread), rng.uniform(0, spread)) for user_id in range(users)]
+
+    def legacy_start(path, user_id, now):
+        conn = sqlite3.connect(path)
+        conn.execute("INSERT OR REPLACE INTO current_timers (user_id, start, mode) VALUES (?, ?, 'work')",
+                     (user_id, now.strftime("%Y-%m-%d %H:%M:%S")))
+        conn.commit()
+        conn.close()
+
+    def legacy_stop(path, user_id):
+        conn = sqlite3.connect(path)
+        conn.execute("SELECT start, mode FROM current_timers WHERE user_id = ?", (user_id,)).fetchone()
+        conn.execute("DELETE FROM current_timers WHERE user_id = ?", (user_id,))
+        conn.commit()
+        conn.close()
+
+    async def load(start, stop):
+        latencies = []
+        # Отсчёт с запасом: пока создаются задачи всех пользователей, сроки не идут
+        began = time.perf_counter() + 0.5
+
+        async def user(user_id, start_delay, stop_delay):
+            for delay, operation in ((start_delay, start), (start_delay + stop_delay, stop)):
+                due = began + delay
+                await asyncio.sleep(max(0.0, due - time.perf_counter()))
+                operation(user_id)
+                latencies.append(time.perf_counter() - due)
+
+        await asyncio.gather(*(user(*entry) for entry in plan))
+        return latencies, time.perf_counter() - began
+
+    async def run():
+        results = {'users': users}
+
+        path = os.path.join(directory, 'registry_legacy.db')
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE current_timers (user_id INTEGER PRIMARY KEY, start TEXT, mode TEXT)")
+        conn.close()
+        latencies, elapsed = await load(lambda user_id: legacy_start(path, user_id, datetime.now()),
+                                        lambda user_id: legacy_stop(path, user_id))
+        results['legacy'] = {'seconds': round(elapsed, 2),
+                             'commits_per_second': round(len(latencies) / elapsed, 1),
+                             **summarize(latencies)}
+
+        database = Database(os.path.join(directory, 'registry.db'))
+        commits = []
+        commit_batch = database._commit_batch
+
+        def counted(batch):
+            commits.append(len(batch))
+            return commit_batch(batch)
+
+        database._commit_batch = counted
+        registry = TimerRegistry(database, flush_interval=flush_interval)
+        await registry.load()
+        registry.start_flushing()
+        latencies, elapsed = await load(lambda user_id: registry.start(user_id, int(time.time()), 'work'),
+                                        registry.stop)
+        await registry.close()
+        left, = await database.fetchone("SELECT count(*) FROM current_timers")
+        await database.close()
+        results['registry'] = {'seconds': round(elapsed, 2),
+                               'commits': len(commits),
+                               'commits_per_second': round(len(commits) / elapsed, 1),
+                               'rows_left': left,
+                               **summarize(latencies)}
+        return results
+
+    results = asyncio.run(run())
+    print(f"registry: прежний путь p99 {results['legacy']['p99_ms']} мс, "
+          f"{results['legacy']['commits_per_second']} коммитов/с; реестр p99 "
+          f"{results['registry']['p99_ms']} мс, {results['registry']['commits_per_second']} коммитов/с",
+          file=sys.stderr)
+    return results
+
+
+def measure_deadlines(directory, timers):
+    """Куча сроков TimerRegistry на timers одновременно запущенных таймерах.
+
+    Загрузка при старте (один запрос к current_timers и heapify), запуск и
+    остановка таймера, извлечение наступивших сроков.
+    """
+    from database import Database
+    from timers import TimerRegistry
+
+    async def run():
+        now = int(time.time())
+        database = Database(os.path.join(directory, 'deadlines.db'))
+        rng = random.Random(1)
+        starts = [now - rng.randrange(2 * DAY) for _ in range(timers)]
+        await database.transaction(lambda conn: conn.executemany(
+            "INSERT INTO current_timers (user_id, start_ts, mode) VALUES (?, ?, 'work')",
+            enumerate(starts)))
+        registry = TimerRegistry(database, remind_after=3 * 3600)
+        started = time.perf_counter()
+        await registry.load()
+        load = time.perf_counter() - started
+        await database.close()
+
+        started = time.perf_counter()
+        for user_id in range(0, timers, 2):
+            registry.stop(user_id)
+            registry.start(user_id, now, 'read')
+        restart = (time.perf_counter() - started) / (timers // 2)
+
+        started = time.perf_counter()
+        due = registry.pop_due(now + 3600)
+        pop = time.perf_counter() - started
+        return {'timers': timers,
+                'load_seconds': round(load, 3),
+                'stop_start_us': round(1e6 * restart, 2),
+                'due': len(due),
+                'pop_due_us_per_deadline': round(1e6 * pop / len(due), 2) if due else None}
+
+    results = asyncio.run(run())
+    print(f"deadlines: загрузка {results['timers']} таймеров за {results['load_seconds']} с, "
+          f"перезапуск таймера {results['stop_start_us']} мкс", file=sys.stderr)
+    return results
+
+
+class FakeRequest(BaseRequest):
+    """Офлайн Bot API: отвечает на запросы правдоподобными объектами.
+
+    latency — искусственная задержка каждого ответа в секундах.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, params, **fields):
+        self._message_id += 1
+        return {'message_id': self._message_id, 'date': int(time.time()),
+                'chat': {'id': int(params['chat_id']), 'type': 'private'}, **fields}
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data is not None else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if api_method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif api_method == 'sendMessage':
+            result = self._message(params, text=params.get('text', ''))
+        elif api_method == 'sendPhoto':
+            file_id = f'photo{self._message_id}'
+            result = self._message(params, photo=[{'file_id': file_id, 'file_unique_id': file_id,
+                                                   'width': 1000, 'height': 500}])
+        elif api_method == 'sendDocument':
+            file_id = f'document{self._message_id}'
+            result = self._message(params, document={'file_id': file_id,
+                                                     'file_unique_id': file_id})
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def message_update(update_id, user_id, text):
+    """JSON апдейта с текстовым сообщением пользователя user_id в личном чате."""
+    message = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+               'chat': {'id': user_id, 'type': 'private'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+
+class ReplayRequest(FakeRequest):
+    """FakeRequest, который отдаёт getUpdates записанные апдейты, как long polling."""
+
+    def __init__(self, updates, latency=0.0):
+        super().__init__(latency)
+        self.updates = updates
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if url.rsplit('/', 1)[-1] != 'getUpdates':
+            return await super().do_request(url, method, request_data, read_timeout, write_timeout,
+                                             connect_timeout, pool_timeout)
+        params = request_data.parameters if request_data is not None else {}
+        offset = int(params.get('offset', 0))
+        batch = [data for data in self.updates if data['update_id'] >= offset][:int(params.get('limit', 100))]
+        # Новых апдейтов нет — запрос висит, как long polling
+        await asyncio.sleep(self.latency if batch else min(1.0, float(params.get('timeout', 0)) or 1.0))
+        return 200, json.dumps({'ok': True, 'result': batch}).encode()
+
+
+class Client:
+    """Синтетический пользователь: шлёт тексты и замеряет время обработки.
+
+    Сценарий начинается с /start и заканчивается "Завершить работу", чтобы
+    следующий сценарий начинал диалог с начала.
+    """
+
+    _update_id = 0
+
+    def __init__(self, application, user_id, latencies):
+        self.application = application
+        self.user_id = user_id
+        self.latencies = latencies
+
+    def update(self, text):
+        Client._update_id += 1
+        return Update.de_json(message_update(Client._update_id, self.user_id, text),
+                              self.application.bot)
+
+    async def send(self, text, step):
+        update = self.update(text)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+
+
+async def scenario_timers(client, rounds):
+    await client.send('/start', 'start')
+    for _ in range(rounds):
+        await client.send('Работа', 'timer_start')
+        await client.send('Остановить таймер', 'timer_stop')
+        await client.send('/skip', 'skip')
+    await client.send('Завершить работу', 'done')
+
+
+async def scenario_notes(client, rounds):
+    await client.send('/start', 'start')
+    for number in range(rounds):
+        await client.send('Учёба', 'timer_start')
+        await client.send('Остановить таймер', 'timer_stop')
+        await client.send(f'заметка {number}', 'note')
+    await client.send('Завершить работу', 'done')
+
+
+async def scenario_stats(client, rounds):
+    await client.send('/start', 'start')
+    await client.send('Статистика', 'stat_menu')
+    for category in STAT_CATEGORIES:
+        step = 'stat_all' if category == 'Все категории' else 'stat_category'
+        for period in PERIODS:
+            await client.send(category, 'stat_choose_category')
+            await client.send(period, step)
+    await client.send('Завершить работу', 'done')
+
+
+async def scenario_export(client, rounds):
+    await client.send('/start', 'start')
+    for file_format in ('CSV', 'JSON'):
+        await client.send('Записи в базе', 'db_menu')
+        await client.send('Просмотреть записи', 'db_info_menu')
+        await client.send(f'Выгрузить {file_format}', f'export_{file_format.lower()}')
+    await client.send('Завершить работу', 'done')
+
+
+async def scenario_analytics(client, rounds):
+    # Половина пользователей останавливает таймеры, половина смотрит долгую
+    # статистику по разным категориям (мимо кеша); с --analytics тяжёлые
+    # чтения идут в копию, а не в основную базу
+    await client.send('/start', 'start')
+    if client.user_id % 2 == 0:
+        for _ in range(rounds):
+            await client.send('Работа', 'timer_start')
+            await client.send('Остановить таймер', 'timer_stop')
+            await client.send('/skip', 'skip')
+    else:
+        await client.send('Статистика', 'stat_menu')
+        categories = [STAT_CATEGORIES[1], 'Учёба', 'Чтение', 'Отдых', 'Развлечения']
+        for number in range(rounds):
+            await client.send(categories[number % len(categories)], 'stat_choose_category')
+            await client.send(PERIODS[-1 - number // len(categories) % 2], 'stat_long')
+    await client.send('Завершить работу', 'done')
+
+
+# Кнопки, которые проверяются в каждом состоянии диалога, и как в него попасть
+DISPATCH_STATES = (
+    ('choosing', ('/start',),
+     ('Работа', 'Учёба', 'Чтение', 'Прогулка', 'Отдых', 'Развлечения', 'Спорт', 'Еда',
+      'Записи в базе', 'Статистика')),
+    ('stat_category', ('Статистика',),
+     ('Все категории', 'Работа', 'Еда', 'Прогулка', 'Назад')),
+    ('stat_period', ('Все категории',), PERIODS + ('Назад',)),
+    ('db_info', ('Назад', 'Записи в базе', 'Просмотреть записи'),
+     ('Последняя запись', 'Последние 5 записей', 'Последние 10 записей', 'Все записи',
+      'Выгрузить CSV', 'Назад')),
+)
+
+
+async def measure_dispatch(application, iterations):
+    """Стоимость выбора обработчика для одного апдейта в ConversationHandler.
+
+    Пользователь проводится по состояниям диалога, в каждом замеряется
+    check_update для всех его кнопок без выполнения самих обработчиков.
+    """
+    conversation = next(handler for handler in application.handlers[0]
+                        if isinstance(handler, ConversationHandler))
+    client = Client(application, 10 ** 9, {})
+    results = {}
+    for state, path, texts in DISPATCH_STATES:
+        for text in path:
+            await client.send(text, 'navigate')
+        updates = [client.update(text) for text in texts]
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for update in updates:
+                conversation.check_update(update)
+        elapsed = time.perf_counter() - started
+        results[state] = {'updates': iterations * len(updates),
+                          'ns_per_update': round(1e9 * elapsed / (iterations * len(updates)))}
+    await client.send('Завершить работу', 'navigate')
+    total = sum(result['updates'] * result['ns_per_update'] for result in results.values())
+    results['mean_ns_per_update'] = round(total / sum(result['updates'] for result in results.values()))
+    print(f"dispatch: {results['mean_ns_per_update']} нс на апдейт", file=sys.stderr)
+    return results
+
+
+async def measure_bulk_edit(application, edits):
+    """Правка edits записей: по строке за сообщение и одним сообщением из всех строк.
+
+    Записи переписываются теми же значениями, поэтому оба прохода делают
+    одинаковую работу над одной и той же базой.
+    """
+    import main
+
+    rows = await main.database.fetchall("SELECT timer_id, start, finish FROM data WHERE user_id = ?"
+                                        " ORDER BY timer_id DESC LIMIT ?", (1, edits))
+    lines = [f'{timer_id} {start} {finish} правка' for timer_id, start, finish in rows]
+    client = Client(application, 1, {})
+    await client.send('/start', 'navigate')
+
+    async def edit(texts):
+        started = time.perf_counter()
+        for text in texts:
+            await client.send('Записи в базе', 'navigate')
+            await client.send('Редактировать записи', 'navigate')
+            await client.send(text, 'navigate')
+        return time.perf_counter() - started
+
+    single = await edit(lines)
+    batch = await edit(['\n'.join(lines)])
+    await client.send('Завершить работу', 'navigate')
+    results = {'edits': len(lines),
+               'single_ms_per_edit': round(1000 * single / len(lines), 3),
+               'batch_ms_per_edit': round(1000 * batch / len(lines), 3),
+               'speedup': round(single / batch, 1) if batch else None}
+    print(f"bulkedit: {results['single_ms_per_edit']} мс на правку по одной, "
+          f"{results['batch_ms_per_edit']} мс пакетом", file=sys.stderr)
+    return results
+
+
+async def run_scenarios(args):
+    # main читает настройки из окружения при импорте
+    import main
+    from metrics import registry
+
+    request = FakeRequest(latency=args.api_latency / 1000)
+    application = main.build_application('1:bench', request=request)
+    await application.initialize()
+    await application.post_init(application)
+    if main.analytics is not None:
+        # JobQueue в бенчмарке не запущена: копию заполняем сами
+        await main.analytics.refresh()
+
+    users = list(range(1, min(args.users, args.active_users) + 1))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = {}
+    try:
+        for name in args.scenarios:
+            if name == 'dispatch':
+                results[name] = await measure_dispatch(application, args.dispatch_iterations)
+                continue
+            if name == 'bulkedit':
+                results[name] = await measure_bulk_edit(application, args.bulk_edits)
+                continue
+            scenario = globals()[f'scenario_{name}']
+            latencies = {}
+            calls_before = request.calls.copy()
+
+            async def run_user(user_id):
+                async with semaphore:
+                    await scenario(Client(application, user_id, latencies), args.rounds)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(run_user(user_id) for user_id in users))
+            elapsed = time.perf_counter() - started
+            updates = sum(len(values) for values in latencies.values())
+            results[name] = {'seconds': round(elapsed, 3),
+                             'updates': updates,
+                             'updates_per_second': round(updates / elapsed, 1),
+                             'steps': {step: summarize(values) for step, values in latencies.items()},
+                             'api_calls': dict(request.calls - calls_before)}
+            print(f"{name}: {updates} апдейтов за {elapsed:.2f} с", file=sys.stderr)
+    finally:
+        await application.shutdown()
+        await application.post_shutdown(application)
+    return results, registry.summary()
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    import resource
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def startup_probe():
+    """Выполняется в отдельном процессе: импорт main, запуск и первый апдейт."""
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+
+    async def first_update():
+        application = main.build_application('1:bench', request=FakeRequest())
+        await application.initialize()
+        await application.post_init(application)
+        await Client(application, 1, {}).send('/start', 'start')
+        result = {'first_update_at': time.time(),
+                  'import_seconds': round(imported - started, 3),
+                  'first_update_seconds': round(time.perf_counter() - started, 3),
+                  'rss_mb': _rss_mb(),
+                  'charting_loaded': 'matplotlib' in sys.modules or 'numpy' in sys.modules}
+        await application.shutdown()
+        await application.post_shutdown(application)
+        return result
+
+    print(json.dumps(asyncio.run(first_update())))
+
+
+def ingress_updates(users, rounds, first_user=1, first_update=1):
+    """Записанные апдейты: пользователи запускают, останавливают таймеры и пишут заметки."""
+    texts = ['/start']
+    for number in range(rounds):
+        texts += ['Работа', 'Остановить таймер', f'заметка {number}']
+    texts.append('Завершить работу')
+    updates = []
+    for text in texts:
+        for user_id in range(first_user, first_user + users):
+            updates.append(message_update(first_update + len(updates), user_id, text))
+    return updates
+
+
+def ingress_probe(mode, updates_path, port, latency):
+    """Выполняется в отдельном процессе: бот принимает записанные апдейты вебхуком или polling.
+
+    В режиме вебхука апдейты присылает родительский процесс. Время
+    считается от начала разбора первого апдейта до момента, когда
+    обработчик в последней группе дошёл до всех. Печатает JSON с числом
+    апдейтов в секунду.
+    """
+    from telegram.ext import TypeHandler
+
+    import main
+    from webhook import run_webhook
+
+    with open(updates_path) as file:
+        updates = json.load(file)
+
+    async def run():
+        done = asyncio.Event()
+        started = None
+        handled = 0
+
+        async def first(update, context):
+            nonlocal started
+            if started is None:
+                started = time.perf_counter()
+
+        async def count(update, context):
+            nonlocal handled
+            handled += 1
+            if handled == len(updates):
+                done.set()
+
+        if mode == 'webhook':
+            application = main.build_application('1:bench', request=FakeRequest(latency))
+        else:
+            application = main.build_application('1:bench', request=ReplayRequest(updates, latency))
+        application.add_handler(TypeHandler(Update, first), group=-100)
+        application.add_handler(TypeHandler(Update, count), group=100)
+
+        if mode == 'webhook':
+            server = asyncio.get_running_loop().create_task(
+                run_webhook(application, '127.0.0.1', port, '/telegram', secret_token='bench'))
+            await done.wait()
+            elapsed = time.perf_counter() - started
+            os.kill(os.getpid(), signal.SIGTERM)
+            await server
+        else:
+            await application.initialize()
+            await application.post_init(application)
+            await application.start()
+            await application.updater.start_polling(poll_interval=0.0, timeout=10)
+            await done.wait()
+            elapsed = time.perf_counter() - started
+            await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+            await application.post_shutdown(application)
+        return {'updates': len(updates), 'seconds': round(elapsed, 3),
+                'updates_per_second': round(len(updates) / elapsed, 1)}
+
+    print(json.dumps(asyncio.run(run())))
+
+
+async def post_updates(url, updates, connections=40):
+    """Присылает апдейты вебхуку, как Telegram: до connections соединений,
+    апдейты одного пользователя по порядку."""
+    import aiohttp
+
+    from webhook import SECRET_HEADER
+
+    by_user = {}
+    for data in updates:
+        by_user.setdefault(data['message']['from']['id'], []).append(data)
+    semaphore = asyncio.Semaphore(connections)
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url + '/healthz') as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.05)
+
+        async def post_user(user_updates):
+            for data in user_updates:
+                async with semaphore:
+                    async with session.post(url + '/telegram', json=data,
+                                            headers={SECRET_HEADER: 'bench'}) as response:
+                        response.raise_for_status()
+
+        await asyncio.gather(*(post_user(user_updates) for user_updates in by_user.values()))
+
+
+def measure_ingress(directory, users, rounds, latency):
+    """Апдейты в секунду при приёме вебхуком и через polling от офлайн Bot API.
+
+    Бот в каждом режиме запускается в своём процессе со своей базой во
+    временном каталоге; вебхуку апдейты присылает этот процесс по HTTP.
+    latency — задержка ответа Bot API в секундах, в том числе на getUpdates.
+    """
+    updates = ingress_updates(users, rounds)
+    updates_path = os.path.join(directory, 'ingress.json')
+    with open(updates_path, 'w') as file:
+        json.dump(updates, file)
+    results = {'users': users, 'api_latency_ms': round(1000 * latency, 1)}
+    for mode in ('polling', 'webhook'):
+        with socket.socket() as probe_socket:
+            probe_socket.bind(('127.0.0.1', 0))
+            port = probe_socket.getsockname()[1]
+        # У каждого режима своя база, отдельная от заполненной для сценариев бота
+        environment = dict(os.environ, DB_URL=os.path.join(directory, f'ingress_{mode}.db'))
+        probe = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--ingress-probe', mode,
+                                  updates_path, str(port), str(latency)],
+                                 env=environment, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 text=True)
+        try:
+            if mode == 'webhook':
+                asyncio.run(post_updates(f'http://127.0.0.1:{port}', updates))
+            output, _ = probe.communicate()
+        finally:
+            if probe.poll() is None:
+                probe.kill()
+        if probe.returncode:
+            raise RuntimeError(f"ingress {mode}: процесс бота завершился с кодом {probe.returncode}")
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+        print(f"ingress {mode}: {results[mode]['updates_per_second']} апдейтов/с", file=sys.stderr)
+    return results
+
+
+def build_bench_application(token, shard=None):
+    """build_application для воркеров run_router: Bot API — офлайн-заглушка.
+
+    Задержка заглушки в миллисекундах — из BENCH_API_LATENCY. После
+    обработки каждого апдейта воркер дописывает байт в файл BENCH_HANDLED,
+    по его размеру замер видит, сколько апдейтов разобрано всеми воркерами.
+    """
+    from telegram.ext import TypeHandler
+
+    import main
+
+    latency = float(os.environ.get('BENCH_API_LATENCY', 0)) / 1000
+    application = main.build_application(token, shard=shard, request=FakeRequest(latency))
+    handled = open(os.environ['BENCH_HANDLED'], 'ab', buffering=0)
+
+    async def count(update, context):
+        handled.write(b'.')
+
+    application.add_handler(TypeHandler(Update, count), group=100)
+    return application
+
+
+def router_probe(workers, port):
+    """Выполняется в отдельном процессе: вебхук с workers воркерами до SIGTERM."""
+    from webhook import run_router
+
+    run_router(build_bench_application, '1:bench', workers, '127.0.0.1', port, '/telegram',
+               secret_token='bench')
+
+
+def measure_workers(directory, counts, users, rounds, latency):
+    """Пропускная способность вебхука с разным числом процессов-воркеров.
+
+    Для каждого числа воркеров поднимается run_router в отдельном процессе.
+    Сначала по пользователю на воркер проходит круг таймера с заметкой,
+    чтобы не мерить запуск воркеров, затем присылаются апдейты users
+    пользователей; замер идёт, пока воркеры не разберут их все.
+    """
+    # Своя база, общая для всех прогонов и отдельная от заполненной для сценариев бота
+    database_path = os.path.join(directory, 'workers.db')
+
+    def wait_handled(path, expected, probe):
+        while not os.path.exists(path) or os.path.getsize(path) < expected:
+            if probe.poll() is not None:
+                raise RuntimeError(f"workers: роутер завершился с кодом {probe.returncode}")
+            time.sleep(0.01)
+
+    results = {'users': users, 'api_latency_ms': round(1000 * latency, 1), 'runs': {}}
+    for number, workers in enumerate(counts, 1):
+        with socket.socket() as probe_socket:
+            probe_socket.bind(('127.0.0.1', 0))
+            port = probe_socket.getsockname()[1]
+        handled = os.path.join(directory, f'handled_{workers}')
+        environment = dict(os.environ, DB_URL=database_path, BENCH_API_LATENCY=str(1000 * latency),
+                           BENCH_HANDLED=handled)
+        # Свои пользователи у каждого прогона
+        first_user = 10 ** 6 * number
+        probe = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--router-probe',
+                                  str(workers), str(port)],
+                                 env=environment,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            url = f'http://127.0.0.1:{port}'
+            warm_up = ingress_updates(workers, 1, first_user=first_user - workers)
+            asyncio.run(post_updates(url, warm_up))
+            wait_handled(handled, len(warm_up), probe)
+
+            updates = ingress_updates(users, rounds, first_user=first_user,
+                                      first_update=len(warm_up) + 1)
+            started = time.perf_counter()
+            asyncio.run(post_updates(url, updates))
+            wait_handled(handled, len(warm_up) + len(updates), probe)
+            elapsed = time.perf_counter() - started
+            probe.send_signal(signal.SIGTERM)
+            probe.wait(60)
+        finally:
+            if probe.poll() is None:
+                probe.kill()
+        results['runs'][workers] = {'updates': len(updates), 'seconds': round(elapsed, 3),
+                                    'updates_per_second': round(len(updates) / elapsed, 1)}
+        print(f"workers {workers}: {results['runs'][workers]['updates_per_second']} апдейтов/с",
+              file=sys.stderr)
+    return results
+
+
+def measure_startup(runs):
+    """Время от запуска процесса до ответа на первый апдейт и память процесса."""
+    samples = []
+    for _ in range(runs):
+        started = time.time()
+        probe = subprocess.run([sys.executable, os.path.abspath(__file__), '--startup-probe'],
+                               capture_output=True, text=True, check=True)
+        sample = json.loads(probe.stdout.strip().splitlines()[-1])
+        sample['time_to_first_update'] = round(sample.pop('first_update_at') - started, 3)
+        samples.append(sample)
+    ordered = sorted(samples, key=lambda sample: sample['time_to_first_update'])
+    median = ordered[len(ordered) // 2]
+    print(f"startup: первый апдейт через {median['time_to_first_update']:.2f} с, "
+          f"RSS {median['rss_mb']} МБ", file=sys.stderr)
+    return {'runs': samples, 'median': median}
+
+
+# Сценарии, которые меряются без приложения бота: имя -> функция (args, путь к БД, каталог)
+STANDALONE = {
+    'dblayer': lambda args, path, directory: measure_db_layer(path, args.db_updates, args.users),
+    'indexscan': lambda args, path, directory: measure_index_scan(directory, args.index_rows,
+                                                                  args.index_users),
+    'timeconv': lambda args, path, directory: measure_time_conversion(path),
+    'histogram': lambda args, path, directory: measure_histogram(args.histogram_sizes,
+                                                                 args.histogram_render_limit),
+    'ingress': lambda args, path, directory: measure_ingress(directory, args.ingress_users, args.rounds,
+                                                             args.ingress_latency / 1000),
+    'workers': lambda args, path, directory: measure_workers(directory, args.router_workers,
+                                                             args.ingress_users, args.rounds,
+                                                             args.ingress_latency / 1000),
+    'outbox': lambda args, path, directory: measure_outbox(args.outbox_chats, args.outbox_bulk),
+    'groupcommit': lambda args, path, directory: measure_group_commit(directory, args.commit_writes,
+                                                                      args.commit_writers),
+    'registry': lambda args, path, directory: measure_registry(directory, args.registry_users),
+    'deadlines': lambda args, path, directory: measure_deadlines(directory, args.deadline_timers),
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк бота с офлайн Bot API")
+    parser.add_argument('--users', type=int, default=50, help="пользователей в базе")
+    parser.add_argument('--years', type=float, default=1.0, help="лет истории у каждого")
+    parser.add_argument('--timers-per-day', type=int, default=4, help="таймеров в день в среднем")
+    parser.add_argument('--modes', type=parse_modes, default=parse_modes(DEFAULT_MODES),
+                        help=f"веса категорий (по умолчанию {DEFAULT_MODES})")
+    parser.add_argument('--seed', type=int, default=1, help="зерно генератора данных")
+    parser.add_argument('--active-users', type=int, default=20,
+                        help="сколько пользователей одновременно пишут боту")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="сколько пользователей обрабатываются параллельно")
+    parser.add_argument('--rounds', type=int, default=5,
+                        help="повторов таймера или заметки на пользователя")
+    parser.add_argument('--scenarios', type=lambda text: text.split(','), default=list(SCENARIOS),
+                        help=f"сценарии через запятую из {','.join(SCENARIOS)}")
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help="задержка ответа Bot API в миллисекундах")
+    parser.add_argument('--real-limits', action='store_true',
+                        help="не снимать лимиты outbox (по умолчанию сняты, "
+                             "чтобы мерить сам бот, а не паузы лимитов)")
+    parser.add_argument('--analytics', action='store_true',
+                        help="читать долгую статистику из копии (ANALYTICS_DB во временном каталоге)")
+    parser.add_argument('--db', help="новый или пустой файл БД, который останется после замера "
+                                     "(по умолчанию временный)")
+    parser.add_argument('--db-updates', type=int, default=200,
+                        help="сколько одновременных апдейтов в замере слоя БД")
+    parser.add_argument('--dispatch-iterations', type=int, default=2000,
+                        help="повторов замера выбора обработчика на каждую кнопку")
+    parser.add_argument('--bulk-edits', type=int, default=200,
+                        help="сколько записей править в замере пакетной правки")
+    parser.add_argument('--deadline-timers', type=int, default=100000,
+                        help="сколько запущенных таймеров в замере кучи сроков")
+    parser.add_argument('--index-rows', type=int, default=10_000_000,
+                        help="записей в синтетической таблице замера индекса")
+    parser.add_argument('--index-users', type=int, default=1000,
+                        help="пользователей в синтетической таблице замера индекса")
+    parser.add_argument('--histogram-sizes', type=lambda text: [int(size) for size in text.split(',')],
+                        default=[1000, 100_000, 1_000_000],
+                        help="сколько таймеров в замерах гистограммы, через запятую")
+    parser.add_argument('--histogram-render-limit', type=int, default=1000,
+                        help="до скольких таймеров мерить прежнюю отрисовку (bar на таймер)")
+    parser.add_argument('--ingress-users', type=int, default=200,
+                        help="сколько пользователей в записанных апдейтах замера вебхука и polling")
+    parser.add_argument('--ingress-latency', type=float, default=50.0,
+                        help="задержка ответа Bot API в замере вебхука и polling, мс")
+    parser.add_argument('--router-workers', type=lambda text: [int(count) for count in text.split(',')],
+                        default=[1, 2, 4],
+                        help="числа воркеров для замера run_router, через запятую")
+    parser.add_argument('--outbox-chats', type=int, default=20,
+                        help="сколько чатов получают выгрузку в замере outbox")
+    parser.add_argument('--outbox-bulk', type=int, default=10,
+                        help="сколько сообщений в выгрузке каждого чата в замере outbox")
+    parser.add_argument('--commit-writes', type=int, default=5000,
+                        help="сколько записей в замере группового коммита")
+    parser.add_argument('--commit-writers', type=int, default=64,
+                        help="сколько одновременных писателей в замере группового коммита")
+    parser.add_argument('--registry-users', type=int, default=10000,
+                        help="сколько пользователей запускают и останавливают таймер в замере реестра")
+    parser.add_argument('--startup-runs', type=int, default=3,
+                        help="сколько раз запускать процесс бота для замера старта")
+    parser.add_argument('--output', help="куда записать JSON (по умолчанию stdout)")
+    parser.add_argument('--startup-probe', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--ingress-probe', nargs=4, help=argparse.SUPPRESS)
+    parser.add_argument('--router-probe', nargs=2, type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    # Синтетические записи дописались бы к настоящим данным
+    if args.db and os.path.exists(args.db) and os.path.getsize(args.db):
+        parser.error(f"файл {args.db} не пуст: укажите новый файл для бенчмарка")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.startup_probe:
+        startup_probe()
+        return 0
+    if args.ingress_probe:
+        mode, updates_path, port, latency = args.ingress_probe
+        ingress_probe(mode, updates_path, int(port), float(latency))
+        return 0
+    if args.router_probe:
+        router_probe(*args.router_probe)
+        return 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.db or os.path.join(directory, 'bench.db')
+        started = time.perf_counter()
+        rows = seed_database(path, args.users, args.years, args.modes, args.timers_per_day, args.seed)
+        seed_seconds = time.perf_counter() - started
+        print(f"База заполнена: {rows} записей за {seed_seconds:.2f} с", file=sys.stderr)
+
+        os.environ['DB_URL'] = path
+        if args.analytics:
+            os.environ['ANALYTICS_DB'] = os.path.join(directory, 'analytics.db')
+        if not args.real_limits:
+            os.environ.setdefault('OUTBOX_GLOBAL_RATE', '1000000')
+            os.environ.setdefault('OUTBOX_CHAT_RATE', '1000000')
+        # Бенчмарк не должен зависеть от фоновых задач
+        os.environ.setdefault('SNAPSHOT_INTERVAL', '3600')
+        os.environ.setdefault('METRICS_LOG_INTERVAL', '3600')
+        os.environ.setdefault('PERSISTENCE_INTERVAL', '3600')
+
+        startup = measure_startup(args.startup_runs) if 'startup' in args.scenarios else None
+        # Замеры без приложения бота идут до него, в порядке из --scenarios
+        standalone = {name: STANDALONE[name](args, path, directory)
+                      for name in args.scenarios if name in STANDALONE}
+        args.scenarios = [name for name in args.scenarios
+                          if name != 'startup' and name not in STANDALONE]
+        scenarios, stages = asyncio.run(run_scenarios(args))
+        scenarios.update(standalone)
+
+    report = {'meta': {'commit': git_commit(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'cpus': os.cpu_count(),
+                       'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                       'params': {key: value for key, value in vars(args).items() if key != 'output'}},
+              'seed': {'rows': rows, 'seconds': round(seed_seconds, 3)},
+              'startup': startup,
+              'scenarios': scenarios,
+              'stages': stages}
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import time
+from collections import OrderedDict
+
+
+class StatEntry:
+    __slots__ = ('text', 'png', 'file_id', 'created', 'snapshot')
+
+    def __init__(self, text, png, snapshot=False):
+        self.text = text
+        self.png = png
+        # file_id картинки на серверах Telegram, появляется после первой отправки
+        self.file_id = None
+        self.created = time.monotonic()
+        # Запись построена заранее фоновой задачей, а не по запросу
+        self.snapshot = snapshot
+
+
+class StatCache:
+    """Ограниченный LRU-кеш готовой статистики: текст, PNG и file_id.
+
+    Ключ включает номер версии данных пользователя, который увеличивается при
+    каждом изменении его записей, поэтому старые записи кеша просто перестают
+    запрашиваться и со временем вытесняются. ttl ограничивает возраст записи:
+    периоды статистики отсчитываются от текущего момента.
+
+    Кеш помнит недавно активных пользователей (touch и bump) — для них
+    фоновая задача строит статистику заранее, — и считает попадания и
+    возраст отданных записей.
+    """
+
+    def __init__(self, maxsize=256, ttl=300, active_size=1024):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._active_size = active_size
+        self._entries = OrderedDict()
+        self._versions = {}
+        # user_id -> time.time() последнего изменения записей; до первого
+        # изменения — время запуска, ведь запись могла быть и до перезапуска
+        self._changed = {}
+        self._started = time.time()
+        # user_id -> время последней активности, самые свежие в конце
+        self._active = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.snapshot_hits = 0
+        self._served_age_total = 0.0
+        self.served_age_max = 0.0
+
+    def version(self, user_id):
+        return self._versions.get(user_id, 0)
+
+    def touch(self, user_id):
+        self._active[user_id] = time.monotonic()
+        self._active.move_to_end(user_id)
+        while len(self._active) > self._active_size:
+            self._active.popitem(last=False)
+
+    def changed_at(self, user_id):
+        return self._changed.get(user_id, self._started)
+
+    def bump(self, user_id):
+        self._versions[user_id] = self.version(user_id) + 1
+        self._changed[user_id] = time.time()
+        self.touch(user_id)
+
+    def recently_active(self, window):
+        """user_id активных за последние window секунд, самые свежие первыми."""
+        since = time.monotonic() - window
+        users = []
+        for user_id, last_seen in reversed(self._active.items()):
+            if last_seen < since:
+                break
+            users.append(user_id)
+        return users
+
+    def peek(self, key):
+        """Запись без учёта в статистике попаданий и без продления в LRU."""
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry.created > self._ttl:
+            return None
+        return entry
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.created > self._ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        if entry.snapshot:
+            self.snapshot_hits += 1
+        age = time.monotonic() - entry.created
+        self._served_age_total += age
+        self.served_age_max = max(self.served_age_max, age)
+        return entry
+
+    def metrics(self):
+        """Попадания и возраст (секунды) отданных из кеша записей."""
+        requests = self.hits + self.misses
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'snapshot_hits': self.snapshot_hits,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'served_age_avg': self._served_age_total / self.hits if self.hits else 0.0,
+                'served_age_max': self.served_age_max}
+
+    def put(self, key, text, png, snapshot=False):
+        entry = StatEntry(text, png, snapshot)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+        return entry
@@ -0,0 +1,92 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import span
+
+
+# Воркеры не fork-аются от процесса бота: пул поднимается в post_init, когда
+# у бота уже есть потоки читателей БД, а дочерний процесс fork получает
+# копии захваченных ими блокировок и может на них зависнуть. Через forkserver
+# воркеры создаются из отдельного процесса без потоков и без matplotlib.
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class ChartQueueFull(Exception):
+    pass
+
+
+def format_time(seconds):
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    seconds = seconds % 60
+
+    time_str = "{:02d}:{:02d}:{:02d}".format(int(hours), int(minutes), int(seconds))
+    return time_str
+
+
+def _warm_up():
+    # Прогреваем воркер: matplotlib, шрифты и кеши загружаются один раз при
+    # старте процесса, а не на первом запросе пользователя
+    import plotting
+    plotting.warm_up()
+
+
+def _render(name, *args):
+    # Функция отрисовки передаётся по имени, чтобы основной процесс не
+    # импортировал plotting, а с ним matplotlib и numpy
+    import plotting
+    return getattr(plotting, name)(*args)
+
+
+def _ready():
+    pass
+
+
+class ChartRenderer:
+    """Пул процессов для отрисовки графиков вне event loop.
+
+    Одновременно в очереди может находиться не больше max_pending задач,
+    остальные сразу получают ChartQueueFull, чтобы всплеск запросов
+    статистики не занимал бота целиком. matplotlib загружается только в
+    процессах пула, start() поднимает и прогревает их в фоне.
+    """
+
+    def __init__(self, workers=2, max_pending=8):
+        self._workers = workers
+        self._max_pending = max_pending
+        self._pending = 0
+        self._executor = None
+
+    @property
+    def pending(self):
+        """Сколько графиков сейчас ждут или рисуются."""
+        return self._pending
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._workers,
+                                                 mp_context=multiprocessing.get_context(START_METHOD),
+                                                 initializer=_warm_up)
+            # Пул создаёт процессы только под задачи: пустые задачи поднимают
+            # воркеры сразу, не задерживая основной процесс
+            for _ in range(self._workers):
+                self._executor.submit(_ready)
+
+    async def render(self, name, *args):
+        """Рисует график функцией name из plotting и возвращает PNG."""
+        if self._pending >= self._max_pending:
+            raise ChartQueueFull()
+        self.start()
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with span('render'):
+                return await loop.run_in_executor(self._executor, _render, name, *args)
+        finally:
+            self._pending -= 1
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
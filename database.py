@@ -0,0 +1,703 @@
+import asyncio
+import itertools
+import os
+import pickle
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import span
+from timezones import DEFAULT_TZ, get_zone
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS current_timers (
+    user_id INTEGER NOT NULL UNIQUE,
+    start TEXT NOT NULL,
+    mode TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS data (
+    timer_id INTEGER PRIMARY KEY UNIQUE NOT NULL DEFAULT (0),
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    mode TEXT NOT NULL DEFAULT ('work'),
+    start TEXT,
+    finish TEXT,
+    time INTEGER NOT NULL DEFAULT (0),
+    note TEXT
+);
+"""
+
+
+def update_rollup(conn, user_id, mode, start_ts, finish_ts, zone, sign=1):
+    """Добавляет (sign=1) или вычитает (sign=-1) таймер из daily_totals.
+
+    Дни считаются по часовому поясу пользователя zone. Вызывается внутри
+    той же транзакции, что и изменение таблицы data.
+    """
+    conn.executemany("INSERT INTO daily_totals (user_id, day, mode, seconds) VALUES (?, ?, ?, ?)"
+                     " ON CONFLICT (user_id, day, mode) DO UPDATE SET seconds = seconds + excluded.seconds",
+                     [(user_id, day, mode, sign * seconds)
+                      for day, seconds in zone.split_by_day(start_ts, finish_ts)])
+    if sign < 0:
+        conn.execute("DELETE FROM daily_totals WHERE user_id = ? AND seconds = 0", (user_id,))
+
+
+def update_rollup_many(conn, user_id, changes, zone):
+    """update_rollup для многих таймеров одного пользователя.
+
+    changes — четвёрки (mode, start_ts, finish_ts, sign). Секунды по
+    одинаковым дню и категории складываются заранее, поэтому в daily_totals
+    уходит одна пачка строк.
+    """
+    deltas = {}
+    for mode, start_ts, finish_ts, sign in changes:
+        for day, seconds in zone.split_by_day(start_ts, finish_ts):
+            deltas[day, mode] = deltas.get((day, mode), 0) + sign * seconds
+    conn.executemany("INSERT INTO daily_totals (user_id, day, mode, seconds) VALUES (?, ?, ?, ?)"
+                     " ON CONFLICT (user_id, day, mode) DO UPDATE SET seconds = seconds + excluded.seconds",
+                     [(user_id, day, mode, seconds) for (day, mode), seconds in deltas.items() if seconds])
+    conn.execute("DELETE FROM daily_totals WHERE user_id = ? AND seconds = 0", (user_id,))
+
+
+def user_timezones(conn):
+    """Часовые пояса пользователей, которые его меняли: {user_id: имя пояса}."""
+    return dict(conn.execute("SELECT user_id, tz FROM user_settings"))
+
+
+def _fill_rollup(conn, table, zones, chunk_size=10000):
+    # Идём по data курсором кусками, чтобы не держать всю таблицу в памяти.
+    # Внутри куска таймеры группируются по поясу и делятся по дням векторно.
+    cur = conn.execute("SELECT user_id, mode, start_ts, finish_ts FROM data")
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        by_zone = {}
+        for row in rows:
+            by_zone.setdefault(zones.get(row[0], DEFAULT_TZ), []).append(row)
+        for name, zone_rows in by_zone.items():
+            _, _, starts, finishes = zip(*zone_rows)
+            conn.executemany(f"INSERT INTO {table} (user_id, day, mode, seconds) VALUES (?, ?, ?, ?)"
+                             f" ON CONFLICT (user_id, day, mode) DO UPDATE SET seconds = seconds + excluded.seconds",
+                             [(zone_rows[index][0], day, zone_rows[index][1], seconds)
+                              for index, day, seconds in get_zone(name).split_many(starts, finishes)])
+
+
+def rebuild_rollup(conn):
+    """Заново заполняет daily_totals по таблице data.
+
+    Копии статистики забываются и при следующем обновлении собираются
+    целиком: data и daily_totals могли измениться мимо журнала, например
+    при загрузке архива.
+    """
+    conn.execute("DELETE FROM daily_totals")
+    _fill_rollup(conn, 'daily_totals', user_timezones(conn))
+    conn.execute("DELETE FROM change_log_readers")
+    conn.execute("DELETE FROM change_log")
+
+
+def trim_change_log(conn, schema='main'):
+    """Удаляет строки change_log, прочитанные всеми копиями; если копий нет — все."""
+    conn.execute(f"DELETE FROM {schema}.change_log WHERE seq <= coalesce("
+                 f"(SELECT min(last_change) FROM {schema}.change_log_readers),"
+                 f" (SELECT max(seq) FROM {schema}.change_log))")
+
+
+def expire_change_log_readers(conn, max_age):
+    """Забывает копии, которые не обновлялись max_age секунд; возвращает их число.
+
+    Журнал для забытой копии больше не копится, при следующем обновлении
+    она соберётся целиком.
+    """
+    expired = conn.execute("DELETE FROM change_log_readers WHERE seen_ts < ?",
+                           (time.time() - max_age,)).rowcount
+    trim_change_log(conn)
+    return expired
+
+
+def check_rollup(conn):
+    """Сравнивает daily_totals с пересчётом по data; возвращает расхождения."""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS expected_totals ("
+                 " user_id INTEGER NOT NULL, day TEXT NOT NULL, mode TEXT NOT NULL,"
+                 " seconds INTEGER NOT NULL, PRIMARY KEY (user_id, day, mode))")
+    conn.execute("DELETE FROM expected_totals")
+    _fill_rollup(conn, 'expected_totals', user_timezones(conn))
+    return conn.execute("SELECT 'missing', * FROM (SELECT * FROM expected_totals"
+                        " EXCEPT SELECT * FROM daily_totals)"
+                        " UNION ALL "
+                        "SELECT 'unexpected', * FROM (SELECT * FROM daily_totals"
+                        " EXCEPT SELECT * FROM expected_totals)").fetchall()
+
+
+def _migration_1(conn):
+    # Время старта и финиша как целые UNIX-метки и составной индекс.
+    # Строки start/finish записаны по МСК (UTC+3), а date — date.today()
+    # сервера, часы которого старый бот считал отстающими от МСК на 3 часа:
+    # у таймеров, закончившихся с 00:00 до 03:00 МСК, date на день раньше
+    # дня финиша. Сначала date исправляется на день финиша по МСК, затем
+    # таймер через полночь начинается в предыдущий день.
+    conn.execute("UPDATE data SET date = date(date, '+1 day') WHERE finish < '03:00:00'")
+    conn.execute("ALTER TABLE data ADD COLUMN start_ts INTEGER")
+    conn.execute("ALTER TABLE data ADD COLUMN finish_ts INTEGER")
+    conn.execute("UPDATE data SET"
+                 " finish_ts = CAST(strftime('%s', date || ' ' || finish) AS INTEGER) - 10800,"
+                 " start_ts = CAST(strftime('%s', date || ' ' || start) AS INTEGER) - 10800"
+                 " - CASE WHEN start > finish THEN 86400 ELSE 0 END")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_data_user_mode_start ON data (user_id, mode, start_ts)")
+
+
+def _migration_2(conn):
+    # Сводная таблица секунд по дням и категориям для статистики
+    conn.execute("CREATE TABLE daily_totals ("
+                 " user_id INTEGER NOT NULL,"
+                 " day TEXT NOT NULL,"
+                 " mode TEXT NOT NULL,"
+                 " seconds INTEGER NOT NULL,"
+                 " PRIMARY KEY (user_id, day, mode)"
+                 ") WITHOUT ROWID")
+    # Для досчёта неполного первого дня по всем категориям сразу
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_data_user_start ON data (user_id, start_ts)")
+    # Часовых поясов пользователей ещё нет: все дни по поясу по умолчанию
+    _fill_rollup(conn, 'daily_totals', {})
+
+
+def _migration_3(conn):
+    # timer_id выдаёт сама SQLite: AUTOINCREMENT не переиспользует номера
+    # удалённых записей, а вставка без timer_id не требует SELECT max(timer_id)
+    conn.execute("CREATE TABLE data_new ("
+                 " timer_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,"
+                 " user_id INTEGER NOT NULL,"
+                 " date TEXT NOT NULL,"
+                 " mode TEXT NOT NULL DEFAULT ('work'),"
+                 " start TEXT,"
+                 " finish TEXT,"
+                 " time INTEGER NOT NULL DEFAULT (0),"
+                 " note TEXT,"
+                 " start_ts INTEGER,"
+                 " finish_ts INTEGER"
+                 ")")
+    conn.execute("INSERT INTO data_new (timer_id, user_id, date, mode, start, finish, time, note,"
+                 " start_ts, finish_ts)"
+                 " SELECT timer_id, user_id, date, mode, start, finish, time, note, start_ts, finish_ts"
+                 " FROM data")
+    conn.execute("DROP TABLE data")
+    conn.execute("ALTER TABLE data_new RENAME TO data")
+    conn.execute("CREATE INDEX idx_data_user_mode_start ON data (user_id, mode, start_ts)")
+    conn.execute("CREATE INDEX idx_data_user_start ON data (user_id, start_ts)")
+
+
+def _migration_4(conn):
+    # Постраничный просмотр записей идёт по (user_id, timer_id): rowid и так
+    # хранится в конце индекса, поэтому достаточно индекса по user_id
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_data_user ON data (user_id)")
+
+
+def _migration_5(conn):
+    # Состояния диалогов и user_data для SQLitePersistence; user_id отдельной
+    # колонкой, чтобы воркер мог выбрать только своих пользователей
+    conn.execute("CREATE TABLE conversations ("
+                 " name TEXT NOT NULL,"
+                 " key TEXT NOT NULL,"
+                 " user_id INTEGER,"
+                 " state TEXT NOT NULL,"
+                 " PRIMARY KEY (name, key)"
+                 ") WITHOUT ROWID")
+    conn.execute("CREATE TABLE user_data ("
+                 " user_id INTEGER PRIMARY KEY,"
+                 " data TEXT NOT NULL"
+                 ")")
+
+
+def _migration_6(conn):
+    # Часовой пояс пользователя (имя IANA); без строки — DEFAULT_TZ, по
+    # которому уже посчитаны дни в daily_totals
+    conn.execute("CREATE TABLE user_settings ("
+                 " user_id INTEGER PRIMARY KEY,"
+                 " tz TEXT NOT NULL"
+                 ")")
+    # Старт запущенного таймера — UNIX-метка вместо строки по МСК
+    conn.execute("CREATE TABLE current_timers_new ("
+                 " user_id INTEGER NOT NULL UNIQUE,"
+                 " start_ts INTEGER NOT NULL,"
+                 " mode TEXT NOT NULL"
+                 ")")
+    conn.execute("INSERT INTO current_timers_new (user_id, start_ts, mode)"
+                 " SELECT user_id, CAST(strftime('%s', start) AS INTEGER) - 10800, mode"
+                 " FROM current_timers")
+    conn.execute("DROP TABLE current_timers")
+    conn.execute("ALTER TABLE current_timers_new RENAME TO current_timers")
+
+
+def _migration_7(conn):
+    # Участники групповых чатов для рейтинга; имя — как показывать в рейтинге.
+    # Рейтинг соединяет chat_members с daily_totals по первичным ключам обеих таблиц.
+    conn.execute("CREATE TABLE chat_members ("
+                 " chat_id INTEGER NOT NULL,"
+                 " user_id INTEGER NOT NULL,"
+                 " name TEXT NOT NULL,"
+                 " PRIMARY KEY (chat_id, user_id)"
+                 ") WITHOUT ROWID")
+
+
+def _migration_8(conn):
+    # Журнал изменений для копий статистики (replica.py). Новые записи копия
+    # берёт по timer_id, в журнал попадают только правки и удаления таймеров
+    # и смена пояса (timer_id NULL: пересчитаны все дни пользователя).
+    # Заметки статистике не нужны, поэтому UPDATE note журнал не пополняет.
+    conn.execute("CREATE TABLE change_log ("
+                 " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                 " user_id INTEGER NOT NULL,"
+                 " timer_id INTEGER"
+                 ")")
+    # Копии, которые читают change_log: name — путь файла копии, last_change —
+    # сколько журнала она прочитала (-1 — копию нужно собрать целиком),
+    # seen_ts — время её последнего обновления. Пока копий нет, триггеры
+    # журнал не пополняют, иначе он рос бы без конца.
+    conn.execute("CREATE TABLE change_log_readers ("
+                 " name TEXT PRIMARY KEY,"
+                 " last_change INTEGER NOT NULL,"
+                 " seen_ts REAL NOT NULL"
+                 ")")
+    conn.execute("CREATE TRIGGER change_log_data_update AFTER UPDATE OF user_id, mode, start_ts, finish_ts"
+                 " ON data WHEN EXISTS (SELECT 1 FROM change_log_readers) BEGIN"
+                 " INSERT INTO change_log (user_id, timer_id) VALUES (OLD.user_id, OLD.timer_id);"
+                 " END")
+    conn.execute("CREATE TRIGGER change_log_data_delete AFTER DELETE ON data"
+                 " WHEN EXISTS (SELECT 1 FROM change_log_readers) BEGIN"
+                 " INSERT INTO change_log (user_id, timer_id) VALUES (OLD.user_id, OLD.timer_id);"
+                 " END")
+    conn.execute("CREATE TRIGGER change_log_tz_insert AFTER INSERT ON user_settings"
+                 " WHEN EXISTS (SELECT 1 FROM change_log_readers) BEGIN"
+                 " INSERT INTO change_log (user_id) VALUES (NEW.user_id);"
+                 " END")
+    conn.execute("CREATE TRIGGER change_log_tz_update AFTER UPDATE ON user_settings"
+                 " WHEN EXISTS (SELECT 1 FROM change_log_readers) BEGIN"
+                 " INSERT INTO change_log (user_id) VALUES (NEW.user_id);"
+                 " END")
+
+
+def _migration_9(conn):
+    # Сроки запущенных таймеров: remind_after — период напоминаний в секундах
+    # (0 — выключены, NULL — по умолчанию), cap — через сколько секунд таймер
+    # останавливается и сохраняется (NULL — через сутки сбрасывается, как раньше)
+    conn.execute("CREATE TABLE timer_settings ("
+                 " user_id INTEGER PRIMARY KEY,"
+                 " remind_after INTEGER,"
+                 " cap INTEGER"
+                 ")")
+
+
+# Миграции схемы по порядку; номер применённой хранится в PRAGMA user_version
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+    _migration_8,
+    _migration_9,
+]
+
+
+def migrate(conn):
+    """Применяет недостающие миграции; возвращает номер версии схемы."""
+    while True:
+        # Версию читаем под блокировкой: несколько процессов бота могут
+        # открыть общую базу одновременно, миграцию применит только первый
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.execute("COMMIT")
+                return version
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class Database:
+    """Долгоживущие соединения с SQLite; все запросы выполняются вне event loop.
+
+    Чтение идёт через пул потоков, у каждого потока своё соединение. Запись
+    идёт через один поток: SQLite всё равно допускает только одного писателя,
+    а так транзакции не конкурируют за блокировку.
+
+    Записи группируются: задачи из очереди, накопившиеся за commit_window
+    секунд (но не больше batch_size), выполняются в одной транзакции, и на
+    все приходится один fsync. Вызывающий получает результат только после
+    COMMIT своей пачки.
+
+    Один файл могут открыть несколько процессов бота. WAL работает только
+    на локальном диске; для файла на сетевом томе нужен journal_mode='DELETE'.
+    """
+
+    def __init__(self, path, readers=4, cached_statements=256, commit_window=0.002, batch_size=64,
+                 journal_mode='WAL'):
+        self.path = path
+        self._journal_mode = journal_mode
+        self._cached_statements = cached_statements
+        self._commit_window = commit_window
+        self._batch_size = batch_size
+        self._queue = None
+        self._writer_task = None
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._read_executor = ThreadPoolExecutor(max_workers=readers,
+                                                 thread_name_prefix='db-read')
+        self._write_executor = ThreadPoolExecutor(max_workers=1,
+                                                  thread_name_prefix='db-write')
+        conn = self._connect()
+        self._prepare(conn)
+        conn.close()
+
+    def _prepare(self, conn):
+        conn.executescript(SCHEMA)
+        migrate(conn)
+
+    def _connect(self):
+        # isolation_level=None: транзакции открываем сами, явным BEGIN.
+        # Подготовленные выражения кешируются модулем sqlite3 по тексту запроса,
+        # поэтому тексты запросов должны быть константами.
+        conn = sqlite3.connect(self.path,
+                               check_same_thread=False,
+                               isolation_level=None,
+                               cached_statements=self._cached_statements)
+        # busy_timeout первым: переключение журнала тоже ждёт блокировку,
+        # если базу в этот момент открывает другой процесс
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(f"PRAGMA journal_mode={self._journal_mode}")
+        # FULL: COMMIT пачки переживает и падение питания; fsync делится на всю пачку
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _fetchone(self, sql, params):
+        return self._connection().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        return self._connection().execute(sql, params).fetchall()
+
+    def _commit_batch(self, batch):
+        conn = self._connection()
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for func, args, future in batch:
+                # Точка сохранения на каждую задачу: ошибка одной не откатывает соседей
+                conn.execute("SAVEPOINT task")
+                try:
+                    results.append((True, func(conn, *args)))
+                except Exception as err:
+                    conn.execute("ROLLBACK TO task")
+                    results.append((False, err))
+                conn.execute("RELEASE task")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return results
+
+    async def _write_forever(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            # Ждём окно, чтобы в пачку попали записи, пришедшие следом
+            if self._commit_window > 0 and len(batch) + self._queue.qsize() < self._batch_size:
+                await asyncio.sleep(self._commit_window)
+            while len(batch) < self._batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+
+            try:
+                results = await loop.run_in_executor(self._write_executor, self._commit_batch, batch)
+            except Exception as err:
+                results = [(False, err)] * len(batch)
+            for (func, args, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    async def _run(self, executor, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, func, *args)
+
+    async def fetchone(self, sql, params=()):
+        with span('db'):
+            return await self._run(self._read_executor, self._fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        with span('db'):
+            return await self._run(self._read_executor, self._fetchall, sql, params)
+
+    async def transaction(self, func, *args):
+        """Выполняет func(conn, *args) в транзакции и возвращает результат после COMMIT."""
+        loop = asyncio.get_running_loop()
+        if self._writer_task is None:
+            self._queue = asyncio.Queue()
+            self._writer_task = loop.create_task(self._write_forever())
+        future = loop.create_future()
+        self._queue.put_nowait((func, args, future))
+        # Вместе с ожиданием своей пачки и её COMMIT
+        with span('db_commit'):
+            return await future
+
+    async def execute(self, sql, params=()):
+        """Выполняет один изменяющий запрос и возвращает количество затронутых строк."""
+        return await self.transaction(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def close(self):
+        if self._writer_task is not None:
+            # Пишущая задача доделывает всё, что стоит в очереди перед None
+            self._queue.put_nowait(None)
+            await self._writer_task
+            self._writer_task = None
+        self._read_executor.shutdown(wait=True)
+        self._write_executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+def _write_frame(writer, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(struct.pack('!I', len(data)) + data)
+
+
+async def _read_frame(reader):
+    size, = struct.unpack('!I', await reader.readexactly(4))
+    return pickle.loads(await reader.readexactly(size))
+
+
+class RemoteDatabase:
+    """Клиент сервера БД (python database.py serve) с интерфейсом Database.
+
+    Несколько процессов бота работают с одной базой через один сервер:
+    их записи попадают в общую очередь и группируются в транзакции вместе.
+    Функции для transaction передаются по имени, поэтому это должны быть
+    функции уровня модуля, который сервер может импортировать. Сообщения
+    сериализуются pickle, так что сервер годится только для доверенной сети.
+    """
+
+    def __init__(self, host, port):
+        self._address = (host, port)
+        self._reader = None
+        self._writer = None
+        self._lock = None
+        self._reader_task = None
+        self._ids = itertools.count()
+        self._futures = {}
+
+    async def _connect(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_connection(*self._address)
+                self._reader_task = asyncio.get_running_loop().create_task(self._read_forever())
+
+    async def _read_forever(self):
+        try:
+            while True:
+                request_id, ok, value = await _read_frame(self._reader)
+                future = self._futures.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+        except Exception as err:
+            # Ответов на отправленные запросы уже не будет; следующий запрос
+            # откроет соединение заново
+            self._writer = None
+            for future in self._futures.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Соединение с сервером БД потеряно: {err!r}"))
+            self._futures.clear()
+
+    async def _call(self, op, *args):
+        await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[request_id] = future
+        _write_frame(self._writer, (request_id, op, args))
+        await self._writer.drain()
+        return await future
+
+    async def fetchone(self, sql, params=()):
+        with span('db'):
+            return await self._call('fetchone', sql, params)
+
+    async def fetchall(self, sql, params=()):
+        with span('db'):
+            return await self._call('fetchall', sql, params)
+
+    async def transaction(self, func, *args):
+        with span('db_commit'):
+            return await self._call('transaction', func, *args)
+
+    async def execute(self, sql, params=()):
+        with span('db_commit'):
+            return await self._call('execute', sql, params)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+
+
+def open_database(url, **kwargs):
+    """Database для пути к файлу SQLite или RemoteDatabase для tcp://host:port."""
+    if url.startswith('tcp://'):
+        host, port = url[len('tcp://'):].rsplit(':', 1)
+        return RemoteDatabase(host, int(port))
+    return Database(url, **kwargs)
+
+
+SERVER_OPS = ('fetchone', 'fetchall', 'transaction', 'execute')
+
+
+async def serve(path, host='127.0.0.1', port=8765):
+    """Сервер БД: одна Database на файл, запросы клиентов RemoteDatabase."""
+    database = Database(path)
+
+    async def run(writer, request_id, op, args):
+        try:
+            frame = (request_id, True, await getattr(database, op)(*args))
+        except Exception as err:
+            frame = (request_id, False, err)
+        _write_frame(writer, frame)
+        await writer.drain()
+
+    async def handle(reader, writer):
+        tasks = set()
+        try:
+            while True:
+                request_id, op, args = await _read_frame(reader)
+                if op not in SERVER_OPS:
+                    _write_frame(writer, (request_id, False, ValueError(f"Неизвестная операция {op}")))
+                    continue
+                # Запросы клиента выполняются параллельно, записи группируются в очереди
+                task = asyncio.get_running_loop().create_task(run(writer, request_id, op, args))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Сервер БД {path} слушает {host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await database.close()
+
+
+def main(argv):
+    # Команда -> (аргументы после пути к БД для подсказки, допустимое их число)
+    commands = {'migrate': ('', (0,)), 'rebuild-rollup': ('', (0,)), 'check-rollup': ('', (0,)),
+                'serve': (' [host:port]', (0, 1)),
+                'export': (' <файл.npz>', (1,)), 'import': (' <файл.npz>', (1,)),
+                'replica': (' <копия.db>', (1,))}
+    command = argv[1] if len(argv) > 1 else None
+    if command not in commands or len(argv) - 3 not in commands[command][1]:
+        for name, (extra, _) in commands.items():
+            print(f"Использование: python {argv[0]} {name} <путь к БД>{extra}")
+        return 1
+    path = argv[2]
+    if command == 'serve':
+        host, port = argv[3].rsplit(':', 1) if len(argv) == 4 else ('127.0.0.1', 8765)
+        try:
+            asyncio.run(serve(path, host, int(port)))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    conn = sqlite3.connect(path, isolation_level=None)
+    started = time.perf_counter()
+    if command in ('export', 'import'):
+        # numpy нужен только для архивов
+        import archive
+        try:
+            if command == 'export':
+                rows = archive.export_data(conn, argv[3])
+            else:
+                conn.executescript(SCHEMA)
+                migrate(conn)
+                rows = archive.import_data(conn, argv[3])
+        except ValueError as err:
+            print(err)
+            conn.close()
+            return 1
+        elapsed = time.perf_counter() - started
+        size = os.path.getsize(argv[3])
+        dump = archive.dump_size(conn)
+        print(f"{'Выгружено' if command == 'export' else 'Загружено'} записей: {rows}"
+              f" за {elapsed:.2f} с ({rows / elapsed if elapsed else 0:.0f} записей/с)")
+        print(f"Архив {size / 2 ** 20:.1f} МБ, текстовый дамп data {dump / 2 ** 20:.1f} МБ"
+              f" ({dump / size if size else 0:.1f}x)")
+    elif command == 'replica':
+        # Обновление копии для статистики, например по cron рядом с сервером БД
+        import replica
+        copy = sqlite3.connect(argv[3], isolation_level=None)
+        copy.execute("PRAGMA busy_timeout=5000")
+        copy.execute("PRAGMA journal_mode=WAL")
+        rows = replica.refresh(copy, path)
+        copy.close()
+        print(f"Копия {argv[3]}: перенесено записей {rows} за {time.perf_counter() - started:.2f} с")
+    elif command == 'migrate':
+        before = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.executescript(SCHEMA)
+        after = migrate(conn)
+        print(f"Схема {path}: версия {before} -> {after} за {time.perf_counter() - started:.2f} с")
+    elif command == 'rebuild-rollup':
+        conn.execute("BEGIN IMMEDIATE")
+        rebuild_rollup(conn)
+        conn.execute("COMMIT")
+        print(f"daily_totals пересчитана за {time.perf_counter() - started:.2f} с")
+    else:
+        mismatches = check_rollup(conn)
+        for kind, user_id, day, mode, seconds in mismatches:
+            print(f"{kind}: user_id={user_id} day={day} mode={mode} seconds={seconds}")
+        print(f"Расхождений: {len(mismatches)}")
+        conn.close()
+        return 1 if mismatches else 0
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
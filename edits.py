@@ -0,0 +1,113 @@
+import csv
+import io
+from datetime import date, datetime, time
+from typing import NamedTuple, Optional
+
+# Разбор пакетной правки записей: строки сообщения или CSV в формате
+# выгрузки "Выгрузить CSV". Весь пакет проверяется за один проход до
+# обращения к базе, ошибки собираются с номерами строк.
+
+# Заметка-команда удаления, как и после остановки таймера
+DELETE = '/delete'
+
+
+class Edit(NamedTuple):
+    timer_id: int
+    # None — запись удаляется
+    start: Optional[time]
+    finish: Optional[time]
+    # Местный день финиша; None — прежний день записи
+    day: Optional[date] = None
+    # None — прежняя категория
+    mode: Optional[str] = None
+    note: str = ''
+
+
+def _parse_time(text):
+    for time_format in ('%H:%M:%S', '%H:%M'):
+        try:
+            return datetime.strptime(text, time_format).time()
+        except ValueError:
+            pass
+    raise ValueError(f"неверное время {text!r}, нужно ЧЧ:ММ:СС")
+
+
+def _parse_day(text):
+    try:
+        return date.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"неверная дата {text!r}, нужно ГГГГ-ММ-ДД") from None
+
+
+def _parse_id(text):
+    if not text.isdigit():
+        raise ValueError(f"неверный id таймера {text!r}")
+    return int(text)
+
+
+def _parse_line(line):
+    # id /delete | id [ГГГГ-ММ-ДД] старт финиш [заметка]
+    parts = line.split()
+    timer_id = _parse_id(parts[0])
+    if parts[1:] == [DELETE]:
+        return Edit(timer_id, None, None)
+    rest = parts[1:]
+    day = None
+    if rest and '-' in rest[0]:
+        day = _parse_day(rest.pop(0))
+    if len(rest) < 2:
+        raise ValueError("нужны время старта и финиша")
+    return Edit(timer_id, _parse_time(rest[0]), _parse_time(rest[1]), day, note=' '.join(rest[2:]))
+
+
+def _collect(numbered):
+    # (номер строки, функция разбора) -> (правки, ошибки); повтор id — тоже ошибка
+    edits, errors, seen = [], [], set()
+    for number, parse in numbered:
+        try:
+            edit = parse()
+        except ValueError as err:
+            errors.append(f"строка {number}: {err}")
+            continue
+        if edit.timer_id in seen:
+            errors.append(f"строка {number}: таймер {edit.timer_id} уже встречался")
+            continue
+        seen.add(edit.timer_id)
+        edits.append(edit)
+    if not edits and not errors:
+        errors.append("нет ни одной правки")
+    return edits, errors
+
+
+def parse_lines(text):
+    """Правки из сообщения, по одной на строку; возвращает (правки, ошибки)."""
+    return _collect((number, lambda line=line: _parse_line(line))
+                    for number, line in enumerate(text.splitlines(), 1) if line.strip())
+
+
+def parse_csv(text, modes):
+    """Правки из CSV с заголовком; возвращает (правки, ошибки).
+
+    Колонки как в выгрузке: timer_id, date, mode, start, finish, note;
+    time пересчитывается и не читается. Пустые date и mode оставляют
+    прежние значения, заметка /delete удаляет запись.
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames or 'timer_id' not in reader.fieldnames:
+        return [], ["нет заголовка с колонкой timer_id"]
+
+    def parse(row):
+        timer_id = _parse_id((row.get('timer_id') or '').strip())
+        note = row.get('note') or ''
+        if note.strip() == DELETE:
+            return Edit(timer_id, None, None)
+        mode = (row.get('mode') or '').strip() or None
+        if mode is not None and mode not in modes:
+            raise ValueError(f"неизвестная категория {mode!r}")
+        day = (row.get('date') or '').strip()
+        return Edit(timer_id, _parse_time((row.get('start') or '').strip()),
+                    _parse_time((row.get('finish') or '').strip()),
+                    _parse_day(day) if day else None, mode, note)
+
+    # Номер строки файла с учётом заголовка
+    return _collect((reader.line_num, lambda row=row: parse(row)) for row in reader)
@@ -1,10 +1,16 @@
+import argparse
+import asyncio
+import csv
+import io
+import json
 import logging
 import os
-import sqlite3
-from datetime import datetime, timedelta
-from datetime import date
+import tempfile
+import time
+from types import MappingProxyType
+from zoneinfo import ZoneInfoNotFoundError
 
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, Chat
+from telegram import InputFile, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, Chat
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -14,9 +20,22 @@ from telegram.ext import (
     filters,
 )
 
-import matplotlib.pyplot as plt
-import numpy as np
-import matplotlib.dates as mdates
+from charts import ChartQueueFull, ChartRenderer, format_time
+from cache import StatCache
+from database import expire_change_log_readers, open_database
+from edits import parse_csv, parse_lines
+from members import ChatMembers
+from menu import (ALL_CATEGORIES, CATEGORIES, CATEGORY_BY_LABEL, CATEGORY_BY_MODE, LEADERBOARD,
+                  MODE_LABELS, PERIODS, RECORD_LIMITS, rows)
+from metrics import instrument, profiler, registry, span, start_http_server
+from outbox import Outbox
+from persistence import SQLitePersistence
+from processor import UserOrderedProcessor
+from records import modify_records, save_note, set_timer_limits, set_timezone, stop_timer
+from replica import Replica
+from timers import REMIND, DeadlineAlarm, TimerRegistry
+from timezones import DAY, DEFAULT_TZ, day_name, day_number, get_zone, now_ts
+from webhook import run_router, run_webhook
 
 # Enable logging
 logging.basicConfig(
@@ -28,34 +47,29 @@ logger = logging.getLogger(__name__)
 
 # constants
 db_name = 'telegram_bot_timer.db'
-CHOOSING, TIMER_OFF, WAIT_FOR_NOTE, DB_INFO, DB_MODIFY, DB_CHOICE, STAT, STAT_CAT = range(8)
+CHOOSING, TIMER_OFF, WAIT_FOR_NOTE, DB_INFO, DB_MODIFY, DB_CHOICE, STAT, STAT_CAT, LEADERBOARD_PERIOD = range(9)
 keyboard_private_regular = [
-    ["Работа", "Учёба", "Чтение", "Прогулка"],
-    ["Отдых", "Развлечения", "Спорт", "Еда"],
+    *rows(CATEGORY_BY_LABEL, 4),
     ["Записи в базе", "Статистика"],
     ["Завершить работу"]
 ]
 markup_private_regular = ReplyKeyboardMarkup(keyboard_private_regular, one_time_keyboard=True)
 
 keyboard_group_regular = [
-    ["Статистика"],
+    ["Статистика", LEADERBOARD],
     ["Завершить работу"]
 ]
 markup_group_regular = ReplyKeyboardMarkup(keyboard_group_regular, one_time_keyboard=True)
 
 keyboard_category_stat = [
-    ["Все категории"],
-    ["Отдых", "Развлечения", "Работа"],
-    ["Учёба", "Чтение", "Спорт"],
-    ["Еда", "Прогулка"],
+    [ALL_CATEGORIES],
+    *rows(CATEGORY_BY_LABEL, 3),
     ["Назад"]
 ]
 markup_category_stat = ReplyKeyboardMarkup(keyboard_category_stat, one_time_keyboard=True)
 
 keyboard_stat = [
-    ["За день", "За неделю"],
-    ["За месяц", "За год"],
-    ["За всё время"],
+    *rows(PERIODS, 2),
     ["Назад"]
 ]
 markup_stat = ReplyKeyboardMarkup(keyboard_stat, one_time_keyboard=True)
@@ -68,667 +82,1209 @@ keyboard_db = [
 markup_db = ReplyKeyboardMarkup(keyboard_db, one_time_keyboard=True)
 
 keyboard_db_info = [
-    ["Последняя запись"],
-    ["Последние 5 записей"],
-    ["Последние 10 записей"],
-    ["Все записи"],
+    *rows(RECORD_LIMITS, 1),
+    ["Выгрузить CSV", "Выгрузить JSON"],
     ["Назад"]
 ]
 markup_db_info = ReplyKeyboardMarkup(keyboard_db_info, one_time_keyboard=True)
 
+keyboard_db_page = [
+    ["Следующая страница"],
+    ["Назад"]
+]
+markup_db_page = ReplyKeyboardMarkup(keyboard_db_page, one_time_keyboard=True)
+
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+RECORD_COLUMNS = ('timer_id', 'date', 'mode', 'start', 'finish', 'time', 'note')
+RECORDS_HEADER = "id таймера; дата; " \
+                 "режим; начало таймера; конец таймера; " \
+                 "время работы в секундах; заметка\n"
+
 stop_keyboard = [
     ["Остановить таймер"]
 ]
 stop_markup = ReplyKeyboardMarkup(stop_keyboard, one_time_keyboard=True)
 
-
-def format_time(seconds):
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    seconds = seconds % 60
-
-    time_str = "{:02d}:{:02d}:{:02d}".format(int(hours), int(minutes), int(seconds))
-    return time_str
-
-
-# Функция для преобразования времени в формат datetime
-def parse_time(time_str):
-    return datetime.strptime(time_str, '%H:%M:%S')
-
-
-# Функция для преобразования времени в формат datetime и учета даты
-def parse_datetime(date_str, time_str):
-    date = datetime.strptime(date_str, '%Y-%m-%d')
-    time = parse_time(time_str)
-    return datetime.combine(date, time.time())
-
-
+# База, копия статистики, пул графиков, таймеры, очередь исходящих и
+# участники чатов создаются в open_services() при сборке приложения: импорт
+# main ничего не открывает и не запускает
+database = None
+analytics = None
+chart_renderer = None
+timer_registry = None
+deadline_alarm = None
+outbox = None
+chat_members = None
+
+# Копия данных для долгих периодов статистики (ANALYTICS_DB — путь к файлу
+# копии). Обновляет её первый воркер раз в ANALYTICS_INTERVAL секунд; если
+# основная база на сервере БД, копию обновляют там: python database.py replica
+ANALYTICS_DB = os.environ.get('ANALYTICS_DB')
+ANALYTICS_INTERVAL = float(os.environ.get('ANALYTICS_INTERVAL', 60))
+ANALYTICS_PERIODS = frozenset(('За год', 'За всё время'))
+# Копия, которая не обновлялась CHANGE_LOG_TTL_HOURS часов, забывается
+# основной базой: журнал изменений для неё больше не копится
+CHANGE_LOG_TTL = float(os.environ.get('CHANGE_LOG_TTL_HOURS', 24)) * 3600
+
+# Напоминание о запущенном таймере — раз в TIMER_REMIND_HOURS часов, если
+# пользователь не задал свой период командой /remind
+TIMER_REMIND_AFTER = round(float(os.environ.get('TIMER_REMIND_HOURS', 3)) * 3600)
+# Напоминания не чаще, чем раз в столько секунд
+TIMER_REMIND_MIN = 900
+# Настройки сроков таймеров: user_id -> (remind_after, cap), None — по умолчанию
+timer_limits = {}
+
+# Все исходящие сообщения идут через общую очередь с учётом лимитов Telegram
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', 30))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))
+
+# Сколько апдейтов обрабатываются одновременно (апдейты одного пользователя — по очереди)
+MAX_CONCURRENT_UPDATES = int(os.environ.get('MAX_CONCURRENT_UPDATES', 256))
+
+# Как часто состояния диалогов и user_data сбрасываются в БД
+PERSISTENCE_INTERVAL = float(os.environ.get('PERSISTENCE_INTERVAL', 10))
+
+# Пакетная правка записей: сколько правок за раз, размер CSV-файла и
+# сколько ошибок разбора показывать
+EDIT_BATCH_LIMIT = int(os.environ.get('EDIT_BATCH_LIMIT', 1000))
+EDIT_FILE_LIMIT = int(os.environ.get('EDIT_FILE_KB', 512)) * 1024
+EDIT_ERRORS_SHOWN = 10
+
+# Часовые пояса пользователей: user_id -> Zone. Пользователь всегда
+# обслуживается одним воркером, поэтому хватает словаря в процессе
+user_zones = {}
+
+# Кеш готовой статистики; версии данных увеличивают timer_off, note и db_modify
+STAT_CACHE_TTL = int(os.environ.get('STAT_CACHE_TTL', 300))
+stat_cache = StatCache(maxsize=int(os.environ.get('STAT_CACHE_SIZE', 256)), ttl=STAT_CACHE_TTL)
+
+# Сколько участников показывать в рейтинге чата
+LEADERBOARD_SIZE = int(os.environ.get('LEADERBOARD_SIZE', 20))
+# Рейтинги, которые строятся прямо сейчас: одновременные нажатия ждут один расчёт
+leaderboard_builds = {}
+
+# Фоновое построение статистики заранее: как часто, для кого (активные за
+# последние SNAPSHOT_ACTIVE_WINDOW секунд) и сколько секунд отрисовки на запуск
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', 60))
+SNAPSHOT_ACTIVE_WINDOW = float(os.environ.get('SNAPSHOT_ACTIVE_WINDOW', 3600))
+SNAPSHOT_BUDGET = float(os.environ.get('SNAPSHOT_BUDGET', 2.0))
+# Самые частые запросы: (категория, период)
+SNAPSHOT_STATS = (('Все категории', 'За день'),
+                  ('Все категории', 'За неделю'))
+
+# Метрики: /metrics на METRICS_PORT (если задан) и сводка в лог раз в интервал.
+# PROFILE_DIR включает профилирование каждого PROFILE_SAMPLE-го запроса,
+# хранятся PROFILE_TOP самых медленных профилей.
+METRICS_HOST = os.environ.get('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = os.environ.get('METRICS_PORT')
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', 60))
+if os.environ.get('PROFILE_DIR'):
+    profiler.configure(os.environ['PROFILE_DIR'],
+                       top=int(os.environ.get('PROFILE_TOP', 10)),
+                       sample=int(os.environ.get('PROFILE_SAMPLE', 10)))
+
+
+def collect_gauges():
+    gauges = {}
+    # До build_application очереди ещё не созданы
+    if outbox is not None:
+        gauges['bot_outbox_queued'] = outbox.queued
+    if chart_renderer is not None:
+        gauges['bot_chart_pending'] = chart_renderer.pending
+    for name, value in stat_cache.metrics().items():
+        gauges[f'bot_stat_cache_{name}'] = value
+    return gauges
+
+
+registry.add_collector(collect_gauges)
+
+
+def reply(update, text, priority=Outbox.NORMAL, **kwargs):
+    """Ставит ответ в чат апдейта в очередь outbox и возвращает future."""
+    return outbox.send_message(update.effective_chat.id, text, priority=priority, **kwargs)
+
+
+async def user_zone(user_id):
+    """Часовой пояс пользователя из user_settings, по умолчанию DEFAULT_TZ."""
+    zone = user_zones.get(user_id)
+    if zone is None:
+        row = await database.fetchone("SELECT tz FROM user_settings WHERE user_id = ?", (user_id,))
+        zone = user_zones[user_id] = get_zone(row[0] if row else DEFAULT_TZ)
+    return zone
+
+
+async def user_limits(user_id):
+    """(период напоминаний, автоостановка) из timer_settings; None — по умолчанию."""
+    limits = timer_limits.get(user_id)
+    if limits is None:
+        row = await database.fetchone("SELECT remind_after, cap FROM timer_settings WHERE user_id = ?",
+                                      (user_id,))
+        limits = timer_limits[user_id] = tuple(row) if row else (None, None)
+    return limits
+
+
+@instrument
 async def timer_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text
-    if text == 'Работа':
-        mode = 'work'
-        reply_text = 'Запущен таймер работы'
-    elif text == 'Учёба':
-        mode = 'study'
-        reply_text = 'Запущен таймер учёбы'
-    elif text == 'Развлечения':
-        mode = 'fun'
-        reply_text = 'Запущен таймер развлечений'
-    elif text == 'Чтение':
-        mode = 'read'
-        reply_text = 'Запущен таймер чтения'
-    elif text == 'Спорт':
-        mode = 'sport'
-        reply_text = 'Запущен таймер спорта'
-    elif text == 'Прогулка':
-        mode = 'walk'
-        reply_text = 'Запущен таймер прогулки'
-    elif text == 'Еда':
-        mode = 'food'
-        reply_text = 'Запущен таймер еды'
-    else:
-        mode = 'rest'
-        reply_text = 'Запущен таймер отдыха'
+    category = CATEGORY_BY_LABEL.get(update.message.text, CATEGORY_BY_MODE['rest'])
 
-    # Учитываем, что у нас сервер в Нидерландах (Разница с МСК - 3 часа)
-    current_time = datetime.now().replace(microsecond=0) + timedelta(hours=3)
     user_id = update.message.from_user.id
-    conn = sqlite3.connect(db_name)
-    cur = conn.cursor()
-    try:
-        cur.execute(f"INSERT INTO current_timers VALUES (?, ?, ?)",
-                    (user_id, current_time, mode))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass
-    cur.close()
-    conn.close()
+    # Если таймер уже запущен, продолжает идти старый
+    if timer_registry.start(user_id, now_ts(), category.mode, *await user_limits(user_id)):
+        deadline_alarm.arm(context.job_queue)
 
-    await update.message.reply_text(reply_text, reply_markup=stop_markup)
+    await reply(update, category.started_text, priority=Outbox.HIGH, reply_markup=stop_markup)
     return TIMER_OFF
 
 
+@instrument
 async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text(
+    await reply(
+        update,
         f"Работа завершена!",
         reply_markup=ReplyKeyboardRemove(),
     )
     return ConversationHandler.END
 
 
+@instrument
 async def note(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     note_text = update.message.text
     user_id = update.message.from_user.id
     reply_text = '\nДанные успешно сохранены в базе.'
     if '/skip' not in note_text:
-        # Соединяемся с БД
-        conn = sqlite3.connect(db_name)
-        cur = conn.cursor()
-
-        # Выбираем последний таймер нашего пользователя
-        cur.execute(f"SELECT max(timer_id) from data where user_id = ?", (user_id,))
-        timer_id = cur.fetchone()[0]
-        # timer_id = context.bot_data.get(user_id)
-
         if '/delete' in note_text:
-            # Удаляем запись
-            cur.execute(f"DELETE from data where timer_id = ?",
-                        (timer_id,))
             reply_text = '\nЗапись успешно удалена из базы.'
-        else:
-            # Ставим заметку
-            cur.execute(f"UPDATE data set note = ? where timer_id = ?",
-                        (note_text, timer_id))
-
-        # Выполняем запрос и закрываем соединение
-        conn.commit()
-        cur.close()
-        conn.close()
+        # Номер таймера запомнили при остановке; после перезапуска бота его нет
+        timer_id = context.user_data.pop('timer_id', None)
+        zone = await user_zone(user_id)
+        await database.transaction(save_note, user_id, timer_id, note_text, zone.name)
+        stat_cache.bump(user_id)
 
-    await update.message.reply_text(reply_text, reply_markup=markup_private_regular)
+    await reply(update, reply_text, priority=Outbox.HIGH, reply_markup=markup_private_regular)
     return CHOOSING
 
 
+@instrument
 async def db(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("Выберите: ",
-                                    reply_markup=markup_db)
+    await reply(update, "Выберите: ",
+                reply_markup=markup_db)
     return DB_CHOICE
 
 
+@instrument
 async def db_info_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("Выберите: ",
-                                    reply_markup=markup_db_info)
+    await reply(update, "Выберите: ",
+                reply_markup=markup_db_info)
     return DB_INFO
 
 
+@instrument
 async def db_modify_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply_text = "Запущен редактор строки в базе данных. " \
+    reply_text = "Запущен редактор записей в базе данных. " \
                  "Введите id таймера, время старта, время финиша, заметку через пробел. \n\n" \
                  "Пример: 22 19:20:00 19:40:00 заметка \n\n" \
-                 "В данном случае выбирается таймер с timer_id и меняются параметры записи: время" \
-                 "старта, финиша и заметка. Заметку можно не писать.\n" \
+                 "В данном случае выбирается таймер с timer_id и меняются параметры записи: время " \
+                 "старта, финиша и заметка. Заметку можно не писать. Перед временем можно " \
+                 "указать новую дату финиша: 22 2024-05-01 19:20:00 19:40:00\n\n" \
+                 "Удалить запись: 22 /delete\n\n" \
+                 "Можно прислать несколько строк в одном сообщении или CSV-файл в формате " \
+                 "выгрузки: в нём меняются дата, категория, старт, финиш и заметка, " \
+                 "заметка /delete удаляет запись. Правки применяются, только если " \
+                 "все строки без ошибок.\n" \
                  "Чтобы вернуться обратно, введите 'Назад'"
-    await update.message.reply_text(reply_text)
+    await reply(update, reply_text)
     return DB_MODIFY
 
 
+async def iter_records(user_id, after_id=0, chunk_size=500):
+    """Записи пользователя по возрастанию timer_id, начиная после after_id.
+
+    Читает кусками по chunk_size строк с продолжением по последнему id,
+    поэтому в памяти одновременно не больше одного куска.
+    """
+    while True:
+        rows = await database.fetchall("SELECT timer_id, date, mode, start, finish, time, note "
+                                       "from data where user_id = ? and timer_id > ? "
+                                       "order by timer_id "
+                                       "limit ?", (user_id, after_id, chunk_size))
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1][0]
+
+
+def format_record(row):
+    # Слишком длинную заметку обрезаем, чтобы запись помещалась в сообщение
+    return str(row)[:MESSAGE_LIMIT - len(RECORDS_HEADER) - 1] + '\n'
+
+
+@instrument
 async def db_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text
     user_id = update.message.from_user.id
 
-    # Соединяемся с БД
-    conn = sqlite3.connect(db_name)
-    cur = conn.cursor()
-
-    if text == 'Последняя запись':
-        cur.execute(f"SELECT timer_id, date, mode, start, finish, time, note "
-                    f"from data where user_id = ? "
-                    f"order by timer_id desc "
-                    f"limit 1", (user_id,))
-    elif text == 'Последние 5 записей':
-        cur.execute(f"SELECT timer_id, date, mode, start, finish, time, note "
-                    f"from data where user_id = ? "
-                    f"order by timer_id desc "
-                    f"limit 5", (user_id,))
-    elif text == 'Последние 10 записей':
-        cur.execute(f"SELECT timer_id, date, mode, start, finish, time, note "
-                    f"from data where user_id = ? "
-                    f"order by timer_id desc "
-                    f"limit 10", (user_id,))
-    else:
-        cur.execute(f"SELECT timer_id, date, mode, start, finish, time, note from data where user_id = ?", (user_id,))
-    result = cur.fetchall()
-    cur.close()
-    conn.close()
+    limit = RECORD_LIMITS.get(update.message.text)
+    if limit is None:
+        return await send_records_page(update, context, after_id=0)
+
+    result = await database.fetchall("SELECT timer_id, date, mode, start, finish, time, note "
+                                     "from data where user_id = ? "
+                                     "order by timer_id desc "
+                                     "limit ?", (user_id, limit))
 
     if len(result) == 0:
-        await update.message.reply_text('У вас нет записей в базе.',
-                                        reply_markup=markup_private_regular)
+        await reply(update, 'У вас нет записей в базе.',
+                    reply_markup=markup_private_regular)
         return CHOOSING
 
-    reply_text = "id таймера; дата; " \
-                 "режим; начало таймера; конец таймера; " \
-                 "время работы в секундах; заметка\n"
-    await context.bot.send_message(chat_id=update.effective_chat.id,
-                                   text=reply_text)
-    reply_text = ''
-    for idx, row in enumerate(result):
-        if idx % 10 == 0 and idx != 0:
-            await context.bot.send_message(chat_id=update.effective_chat.id,
-                                           text=reply_text)
-            reply_text = ''
-        reply_text += str(row)
-        reply_text += '\n'
-
-    await update.message.reply_text(reply_text, reply_markup=markup_private_regular)
+    # Набиваем сообщения записями до лимита длины
+    messages = [[RECORDS_HEADER]]
+    length = len(RECORDS_HEADER)
+    for row in result:
+        line = format_record(row)
+        if length + len(line) > MESSAGE_LIMIT:
+            messages.append([])
+            length = 0
+        messages[-1].append(line)
+        length += len(line)
+
+    for lines in messages[:-1]:
+        outbox.send_message(update.effective_chat.id, ''.join(lines), priority=Outbox.BULK)
+    await reply(update, ''.join(messages[-1]), priority=Outbox.BULK,
+                reply_markup=markup_private_regular)
     return CHOOSING
 
 
-async def db_modify(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@instrument
+async def db_info_next_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    return await send_records_page(update, context,
+                                   after_id=context.user_data.get('records_after', 0))
+
+
+async def send_records_page(update: Update, context: ContextTypes.DEFAULT_TYPE, after_id) -> int:
+    """Одна страница "Все записи": столько записей, сколько влезает в сообщение."""
+    user_id = update.message.from_user.id
+
+    lines = [RECORDS_HEADER]
+    length = len(RECORDS_HEADER)
+    has_more = False
+    async for row in iter_records(user_id, after_id, chunk_size=100):
+        line = format_record(row)
+        if length + len(line) > MESSAGE_LIMIT:
+            has_more = True
+            break
+        lines.append(line)
+        length += len(line)
+        after_id = row[0]
+
+    if len(lines) == 1:
+        context.user_data.pop('records_after', None)
+        await reply(update, 'У вас нет записей в базе.',
+                    reply_markup=markup_private_regular)
+        return CHOOSING
+
+    if has_more:
+        # Продолжение следующей страницы — по последнему показанному id
+        context.user_data['records_after'] = after_id
+        await reply(update, ''.join(lines), priority=Outbox.BULK, reply_markup=markup_db_page)
+        return DB_INFO
+
+    context.user_data.pop('records_after', None)
+    await reply(update, ''.join(lines), priority=Outbox.BULK, reply_markup=markup_private_regular)
+    return CHOOSING
+
+
+@instrument
+async def db_export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.message.from_user.id
+    file_format = 'csv' if 'CSV' in update.message.text else 'json'
+
+    count = 0
+    # Документ собирается по кускам; больше мегабайта держится на диске, а не в памяти
+    with tempfile.SpooledTemporaryFile(max_size=1 << 20) as file:
+        stream = io.TextIOWrapper(file, encoding='utf-8', newline='')
+        if file_format == 'csv':
+            writer = csv.writer(stream)
+            writer.writerow(RECORD_COLUMNS)
+        else:
+            stream.write('[')
+
+        async for row in iter_records(user_id):
+            if file_format == 'csv':
+                writer.writerow(row)
+            else:
+                stream.write(',\n' if count else '\n')
+                stream.write(json.dumps(dict(zip(RECORD_COLUMNS, row)), ensure_ascii=False))
+            count += 1
+
+        if file_format == 'json':
+            stream.write('\n]\n')
+        stream.flush()
+        stream.detach()
+
+        if count == 0:
+            await reply(update, 'У вас нет записей в базе.',
+                        reply_markup=markup_private_regular)
+            return CHOOSING
+
+        file.seek(0)
+        with span('upload'):
+            await outbox.send_document(update.effective_chat.id,
+                                       document=InputFile(file.read(), filename=f'records.{file_format}'),
+                                       caption=f'Записей: {count}',
+                                       priority=Outbox.BULK,
+                                       reply_markup=markup_private_regular)
+    return CHOOSING
+
+
+@instrument
+async def db_modify(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = update.message.text
     if text == 'Назад' or text == 'Домой':
-        await update.message.reply_text("Выберите: ",
-                                        reply_markup=markup_private_regular)
+        await reply(update, "Выберите: ",
+                    reply_markup=markup_private_regular)
         return CHOOSING
 
-    text = text.split()
-    timer_id, start_time, finish_time = text[0:3]
-    if len(text) == 3:
-        note = ''
-    elif len(text) > 3:
-        note = ' '.join(text[3:])
-    else:
-        await update.message.reply_text("Ошибка с форматом текста")
-        return DB_MODIFY
+    edits, errors = parse_lines(text)
+    return await apply_edits(update, edits, errors)
 
+
+@instrument
+async def db_modify_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    document = update.message.document
+    if document.file_size and document.file_size > EDIT_FILE_LIMIT:
+        await reply(update, f"Файл больше {EDIT_FILE_LIMIT // 1024} КБ")
+        return DB_MODIFY
+    with span('download'):
+        file = await document.get_file()
+        content = await file.download_as_bytearray()
     try:
-        start_time = datetime.strptime(start_time, "%H:%M:%S")
-        finish_time = datetime.strptime(finish_time, "%H:%M:%S")
-
-        elapsed_time = finish_time - start_time
-        elapsed_time_in_sec = int(elapsed_time.total_seconds())
-
-        # Создание объекта datetime с помощью текущей даты и времени из time_struct
-        start_time = datetime.strftime(start_time, "%H:%M:%S")
-        finish_time = datetime.strftime(finish_time, "%H:%M:%S")
-    except Exception as err:
-        print(err)
-        await update.message.reply_text("Ошибка с форматом времени")
+        # utf-8-sig: Excel сохраняет CSV с BOM
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        await reply(update, "Файл должен быть CSV в кодировке UTF-8")
         return DB_MODIFY
 
-    # Соединяемся с БД
-    conn = sqlite3.connect(db_name)
-    cur = conn.cursor()
+    edits, errors = parse_csv(text, CATEGORY_BY_MODE)
+    return await apply_edits(update, edits, errors)
 
-    cur.execute(f"SELECT user_id from data where timer_id = ? and user_id = ?", (timer_id, user_id))
-    result = cur.fetchone()
-    if not result:
-        await update.message.reply_text('Вашего таймера с таким id не найдено')
-        cur.close()
-        conn.close()
+
+async def apply_edits(update: Update, edits, errors) -> int:
+    """Применяет пакет правок одной транзакцией или сообщает, почему не применил."""
+    user_id = update.message.from_user.id
+    if not errors and len(edits) > EDIT_BATCH_LIMIT:
+        errors = [f"не больше {EDIT_BATCH_LIMIT} правок за раз, получено {len(edits)}"]
+    if errors:
+        text = "Ничего не изменено, исправьте ошибки:\n" + '\n'.join(errors[:EDIT_ERRORS_SHOWN])
+        if len(errors) > EDIT_ERRORS_SHOWN:
+            text += f"\n…и ещё {len(errors) - EDIT_ERRORS_SHOWN}"
+        await reply(update, text[:MESSAGE_LIMIT])
         return DB_MODIFY
 
-    cur.execute(f"UPDATE data set start = ?, finish = ?, time = ?,"
-                f" note = ? where timer_id = ?", (start_time, finish_time,
-                                                  elapsed_time_in_sec, note, timer_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    # Проверка владельца и все изменения в одной транзакции
+    zone = await user_zone(user_id)
+    updated, deleted, missing = await database.transaction(modify_records, user_id, edits, zone.name)
+    if missing:
+        ids = ', '.join(map(str, missing[:EDIT_ERRORS_SHOWN]))
+        await reply(update, f"Ничего не изменено: ваших таймеров с id {ids} не найдено")
+        return DB_MODIFY
+    stat_cache.bump(user_id)
 
-    await update.message.reply_text("Запись отредактирована",
-                                    reply_markup=markup_private_regular)
+    if deleted:
+        text = f"Отредактировано записей: {updated}, удалено: {deleted}"
+    elif updated == 1:
+        text = "Запись отредактирована"
+    else:
+        text = f"Отредактировано записей: {updated}"
+    await reply(update, text, reply_markup=markup_private_regular)
     return CHOOSING
 
 
+@instrument
 async def timer_off(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # Узнаём user_id
     user_id = update.message.from_user.id
 
+    zone = await user_zone(user_id)
+    finish_ts = now_ts()
+    timer = timer_registry.stop(user_id)
+    if timer is None:
+        # Например, таймер уже остановлен автоматически
+        await reply(update, 'Таймер не запущен', priority=Outbox.HIGH,
+                    reply_markup=markup_private_regular)
+        return CHOOSING
     try:
-        # Соединяемся с БД
-        conn = sqlite3.connect(db_name)
-        cur = conn.cursor()
-
-        # Узнаём время старта таймера и его мод
-        cur.execute(f"SELECT start, mode from current_timers where user_id = ?", (user_id,))
-
-        # Вычисляем время с начала таймера
-        start_time, mode = cur.fetchone()
-        start_time = datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S")
-        finish_time = datetime.now().replace(microsecond=0) + timedelta(hours=3)
-        elapsed_time = finish_time - start_time
-        elapsed_time_in_sec = int(elapsed_time.total_seconds())
-        if elapsed_time_in_sec < 0:
-            elapsed_time_in_sec += 86400
-
-        # Удаляем таймер из current_timers
-        cur.execute(f"DELETE from current_timers where user_id = ?", (user_id,))
-        conn.commit()
+        stopped = await database.transaction(stop_timer, user_id, timer.start,
+                                             timer.mode, finish_ts, zone.name)
     except Exception:
-        await update.message.reply_text('Произошла непредвиденная ошибка. '
-                                        'Попробуйте ещё раз', reply_markup=markup_private_regular)
+        # Запись не сохранилась — таймер продолжает идти
+        timer_registry.start(user_id, timer.start, timer.mode, timer.remind_after, timer.cap)
+        deadline_alarm.arm(context.job_queue)
+        await reply(update, 'Произошла непредвиденная ошибка. '
+                    'Попробуйте ещё раз', priority=Outbox.HIGH,
+                    reply_markup=markup_private_regular)
         return CHOOSING
 
-    """
-    if elapsed_time_in_sec < 10:
-        reply_text = 'Прошло меньше 10 секунд. Данные в базе не будут сохранены.'
-        await update.message.reply_text(reply_text, reply_markup=markup_private_regular)
-        return CHOOSING"""
-    if elapsed_time_in_sec > 86400:
+    if stopped is None:
         reply_text = 'Прошло больше суток. Данные в базе не будут сохранены.'
-        await update.message.reply_text(reply_text, reply_markup=markup_private_regular)
+        await reply(update, reply_text, priority=Outbox.HIGH, reply_markup=markup_private_regular)
         return CHOOSING
-
-    # Выбираем последний таймер и инкрементируем
-    cur.execute(f"SELECT max(timer_id) from data")
-    timer_id = cur.fetchone()[0] + 1
-
-    cur.execute(f"INSERT INTO data VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (timer_id, user_id, date.today(), mode,
-                 start_time.strftime("%H:%M:%S"),
-                 finish_time.strftime("%H:%M:%S"), elapsed_time_in_sec, ''))
-    conn.commit()
-    cur.close()
-    conn.close()
+    stat_cache.bump(user_id)
+    timer_id, elapsed_time = stopped
+    context.user_data['timer_id'] = timer_id
 
     reply_text = f"Таймер остановлен. Прошло {elapsed_time}. "
 
     reply_text += "Напишите заметку, либо введите /skip. " \
                   "Если хотите удалить запись, введите /delete"
-    await update.message.reply_text(reply_text)
+    await reply(update, reply_text, priority=Outbox.HIGH)
     return WAIT_FOR_NOTE
 
 
+@instrument
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the conversation, display any stored data and ask user for input."""
     chat_type = update.effective_chat.type
     if chat_type == Chat.PRIVATE:
-        await update.message.reply_text("Бот-задрот стартует. Выберите таймер.",
-                                        reply_markup=markup_private_regular)
+        await reply(update, "Бот-задрот стартует. Выберите таймер.",
+                    reply_markup=markup_private_regular)
     else:
         # Действия бота в группе
-        await update.message.reply_text("Бот-задрот стартует."
-                                        " В чате я умею только выводить статистику пользователей.",
-                                        reply_markup=markup_group_regular)
+        await reply(update, "Бот-задрот стартует."
+                    " В чате я умею только выводить статистику пользователей и рейтинг чата.",
+                    reply_markup=markup_group_regular)
     return CHOOSING
 
 
+@instrument
 async def home(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     chat_type = update.effective_chat.type
     if chat_type == Chat.PRIVATE:
-        await update.message.reply_text("Выберите: ",
-                                        reply_markup=markup_private_regular)
+        await reply(update, "Выберите: ",
+                    reply_markup=markup_private_regular)
     else:
         # Действия бота в группе
-        await update.message.reply_text("Выберите: ",
-                                        reply_markup=markup_group_regular)
+        await reply(update, "Выберите: ",
+                    reply_markup=markup_group_regular)
     return CHOOSING
 
 
+@instrument
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
     chat_type = update.effective_chat.type
     if chat_type == Chat.PRIVATE:
         # Действия бота в чате с отдельным пользователем
-        await context.bot.send_message(chat_id=update.effective_chat.id,
-                                       text="Это бот-задрот. Я умею "
-                                            "запускать таймеры и выводить статистику. \n"
-                                            "Чтобы начать нажмите /start")
+        await outbox.send_message(update.effective_chat.id,
+                                  text="Это бот-задрот. Я умею "
+                                       "запускать таймеры и выводить статистику. \n"
+                                       "Чтобы начать нажмите /start. \n"
+                                       "Часовой пояс для статистики: /tz \n"
+                                       "Напоминания о запущенном таймере: /remind \n"
+                                       "Автоостановка забытого таймера: /cap")
     elif chat_type == Chat.GROUP or chat_type == Chat.SUPERGROUP:
         # Действия бота в группе
-        await context.bot.send_message(chat_id=update.effective_chat.id,
-                                       text="Это бот-задрот. В чате я умею только "
-                                            "выводить статистику пользователей. \n"
-                                            "Чтобы начать нажмите /start")
+        await outbox.send_message(update.effective_chat.id,
+                                  text="Это бот-задрот. В чате я умею только "
+                                       "выводить статистику пользователей "
+                                       "и рейтинг чата. \n"
+                                       "Чтобы начать нажмите /start")
     else:
         # Действия бота в других типах чатов (например, каналы)
         pass
 
 
+@instrument
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/tz — показать часовой пояс, /tz <имя IANA> — сменить его."""
+    user_id = update.message.from_user.id
+    if not context.args:
+        zone = await user_zone(user_id)
+        await reply(update, f"Ваш часовой пояс: {zone.name}. "
+                            f"Сменить: /tz Europe/Moscow, /tz Asia/Yekaterinburg и т.п.")
+        return
+    try:
+        zone = get_zone(context.args[0])
+    except (ZoneInfoNotFoundError, ValueError):
+        await reply(update, "Не знаю такого часового пояса. Пример: /tz Europe/Moscow")
+        return
+    # Сводка по дням пересчитывается в той же транзакции
+    await database.transaction(set_timezone, user_id, zone.name)
+    user_zones[user_id] = zone
+    stat_cache.bump(user_id)
+    await reply(update, f"Часовой пояс изменён на {zone.name}")
+
+
+def parse_hours(text):
+    """'8', '1.5' или '7:30' -> секунды."""
+    if ':' in text:
+        hours, minutes = text.split(':', 1)
+        return int(hours) * 3600 + int(minutes) * 60
+    return round(float(text.replace(',', '.')) * 3600)
+
+
+async def save_timer_limits(user_id, remind_after, cap, job_queue):
+    await database.transaction(set_timer_limits, user_id, remind_after, cap)
+    timer_limits[user_id] = (remind_after, cap)
+    # Запущенный таймер сразу получает новые сроки
+    timer_registry.set_limits(user_id, remind_after, cap)
+    deadline_alarm.arm(job_queue)
+
+
+@instrument
+async def cap_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/cap — показать автоостановку, /cap <часы> — задать, /cap 0 — выключить."""
+    user_id = update.message.from_user.id
+    remind_after, cap = await user_limits(user_id)
+    if not context.args:
+        if cap:
+            text = f"Таймер останавливается и сохраняется через {format_time(cap)}. "
+        else:
+            text = "Автоостановка не задана: таймер дольше суток сбрасывается без сохранения. "
+        await reply(update, text + "Задать: /cap 8 или /cap 7:30, выключить: /cap 0")
+        return
+    try:
+        seconds = parse_hours(context.args[0])
+    except ValueError:
+        seconds = -1
+    if not 0 <= seconds <= DAY:
+        await reply(update, "Укажите от 0 до 24 часов, например /cap 8 или /cap 7:30")
+        return
+    await save_timer_limits(user_id, remind_after, seconds or None, context.job_queue)
+    if seconds:
+        await reply(update, f"Таймеры будут останавливаться и сохраняться через {format_time(seconds)}")
+    else:
+        await reply(update, "Автоостановка выключена")
+
+
+@instrument
+async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/remind — показать период напоминаний, /remind <часы> — задать, /remind 0 — выключить."""
+    user_id = update.message.from_user.id
+    remind_after, cap = await user_limits(user_id)
+    if not context.args:
+        current = TIMER_REMIND_AFTER if remind_after is None else remind_after
+        if current:
+            text = f"Напоминание о запущенном таймере каждые {format_time(current)}. "
+        else:
+            text = "Напоминания выключены. "
+        await reply(update, text + "Задать: /remind 2 или /remind 0:30, выключить: /remind 0")
+        return
+    try:
+        seconds = parse_hours(context.args[0])
+    except ValueError:
+        seconds = -1
+    if not (seconds == 0 or TIMER_REMIND_MIN <= seconds <= DAY):
+        await reply(update, f"Укажите 0 или от {TIMER_REMIND_MIN // 60} минут до 24 часов, "
+                            f"например /remind 2 или /remind 0:30")
+        return
+    await save_timer_limits(user_id, seconds, cap, context.job_queue)
+    if seconds:
+        await reply(update, f"Напоминание о запущенном таймере каждые {format_time(seconds)}")
+    else:
+        await reply(update, "Напоминания выключены")
+
+
+async def handle_deadline(kind, user_id, timer):
+    # Сроки обрабатываются в отдельных задачах: пока очередь дошла до этой,
+    # пользователь мог остановить таймер или запустить новый
+    if timer_registry.get(user_id) is not timer:
+        return
+    label = MODE_LABELS.get(timer.mode, timer.mode)
+    if kind == REMIND:
+        outbox.send_message(user_id, f"Таймер \"{label}\" идёт уже {format_time(now_ts() - timer.start)}. "
+                                     f"Не забудьте его остановить", reply_markup=stop_markup)
+        return
+    # Таймер снимаем до первого await, чтобы не разойтись с timer_off
+    timer_registry.stop(user_id)
+    if timer.cap is None:
+        outbox.send_message(user_id, f"Таймер \"{label}\" шёл больше суток и остановлен без сохранения")
+        return
+    zone = await user_zone(user_id)
+    try:
+        stopped = await database.transaction(stop_timer, user_id, timer.start, timer.mode,
+                                             timer.stop_at, zone.name)
+    except Exception:
+        # Запись не сохранилась — таймер возвращается, срок наступит снова
+        if not timer_registry.start(user_id, timer.start, timer.mode, timer.remind_after, timer.cap):
+            # Пока шла запись, пользователь запустил новый таймер: вернуть старый некуда
+            start, finish = zone.localize(timer.start), zone.localize(timer.stop_at)
+            logger.error("Таймер пользователя %s (%s, %s - %s) не сохранён и потерян",
+                         user_id, timer.mode, timer.start, timer.stop_at)
+            outbox.send_message(user_id, f"Не удалось сохранить таймер \"{label}\" "
+                                         f"с {start:%d.%m %H:%M} по {finish:%d.%m %H:%M}, "
+                                         f"а вы уже запустили новый: эта запись потеряна")
+        raise
+    stat_cache.bump(user_id)
+    timer_id, elapsed_time = stopped
+    outbox.send_message(user_id, f"Таймер \"{label}\" остановлен автоматически через {elapsed_time} "
+                                 f"и сохранён (id {timer_id}). Поправить время можно в редакторе записей")
+
+
+async def handle_deadlines(due):
+    """Наступившие сроки таймеров: напоминания и автоостановка.
+
+    Остановки выполняются одновременно, чтобы их записи попали в одну
+    пачку транзакций.
+    """
+    results = await asyncio.gather(*(handle_deadline(kind, user_id, timer) for kind, user_id, timer in due),
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+@instrument
+async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Запоминает авторов сообщений в группах и убирает вышедших из чата."""
+    message = update.effective_message
+    chat_id = message.chat_id
+    if message.left_chat_member is not None:
+        await chat_members.left(chat_id, message.left_chat_member.id)
+    for user in (message.from_user, *message.new_chat_members):
+        if user is not None and not user.is_bot:
+            await chat_members.seen(chat_id, user.id, user.full_name)
+
+
+@instrument
+async def leaderboard_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if update.effective_chat.type == Chat.PRIVATE:
+        await reply(update, "Рейтинг доступен в групповых чатах",
+                    reply_markup=markup_private_regular)
+        return CHOOSING
+    await reply(update, "Выберите временной период: ",
+                reply_markup=markup_stat)
+    return LEADERBOARD_PERIOD
+
+
+async def build_leaderboard(chat_id, members, time_interval):
+    """Рейтинг участников чата за период: пара (текст, PNG).
+
+    Секунды всех участников по категориям берутся одним запросом: соединение
+    chat_members и daily_totals идёт по первичным ключам обеих таблиц. Дни
+    в daily_totals — местные дни участника, поэтому и начало периода
+    считается в часовом поясе каждого участника.
+    """
+    period = PERIODS.get(time_interval)
+    # Часовой пояс -> первый день периода в нём
+    since = {}
+    if period is not None:
+        now = now_ts()
+        for tz, in await database.fetchall("SELECT DISTINCT coalesce(s.tz, ?) FROM chat_members m"
+                                           " LEFT JOIN user_settings s ON s.user_id = m.user_id"
+                                           " WHERE m.chat_id = ?", (DEFAULT_TZ, chat_id)):
+            since[tz] = day_name(get_zone(tz).day_number(now) - period.days + 1)
+    rows = await database.fetchall("SELECT m.user_id, t.mode, sum(t.seconds)"
+                                   " FROM chat_members m"
+                                   " LEFT JOIN user_settings s ON s.user_id = m.user_id"
+                                   " LEFT JOIN json_each(?) p ON p.key = coalesce(s.tz, ?)"
+                                   " JOIN daily_totals t ON t.user_id = m.user_id"
+                                   " WHERE m.chat_id = ? AND t.day >= coalesce(p.value, '')"
+                                   " GROUP BY m.user_id, t.mode",
+                                   (json.dumps(since), DEFAULT_TZ, chat_id))
+    if not rows:
+        raise StatError("За выбранный период не найдено данных")
+
+    with span('aggregate'):
+        by_user = {}
+        for user_id, mode, seconds in rows:
+            by_user.setdefault(user_id, {})[mode] = seconds
+        ranking = sorted(by_user.items(), key=lambda item: sum(item[1].values()), reverse=True)
+        ranking = ranking[:LEADERBOARD_SIZE]
+        names = [members.get(user_id, str(user_id)) for user_id, _ in ranking]
+        present = {mode for _, totals in ranking for mode in totals}
+        modes = [category.mode for category in CATEGORIES if category.mode in present]
+        modes += sorted(present - set(modes))
+        seconds = [[totals.get(mode, 0) for _, totals in ranking] for mode in modes]
+
+    png = await chart_renderer.render('render_leaderboard', names,
+                                      [MODE_LABELS.get(mode, mode) for mode in modes], seconds)
+    lines = [f"{place}. {name} — {format_time(sum(totals.values()))}"
+             for place, (name, (_, totals)) in enumerate(zip(names, ranking), 1)]
+    return f"Рейтинг чата {time_interval.lower()}:\n" + "\n".join(lines), png
+
+
+async def cached_leaderboard(chat_id, time_interval):
+    """Рейтинг из кеша; пересчитывается, если изменились данные участников или истёк TTL.
+
+    С --workers N участники чата обслуживаются разными процессами, а версии
+    записей у каждого процесса свои: записи и участники, добавленные другими
+    воркерами, попадут в рейтинг не позже чем через STAT_CACHE_TTL секунд —
+    столько живут и кеш рейтинга, и загруженный состав чата.
+    """
+    members = await chat_members.get(chat_id)
+    # Версия — состав чата и версии записей каждого участника: сумма версий
+    # могла бы совпасть с прежней, если один участник вышел, а другой что-то записал
+    version = (chat_members.version(chat_id),
+               tuple(sorted((user_id, stat_cache.version(user_id)) for user_id in members)))
+    key = ('chat', chat_id, time_interval, version)
+    entry = stat_cache.get(key)
+    if entry is not None:
+        return entry
+    build = leaderboard_builds.get(key)
+    if build is None:
+        build = leaderboard_builds[key] = asyncio.ensure_future(
+            build_leaderboard(chat_id, dict(members), time_interval))
+        build.add_done_callback(lambda _: leaderboard_builds.pop(key, None))
+    text, png = await build
+    return stat_cache.peek(key) or stat_cache.put(key, text, png)
+
+
+@instrument
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    chat_id = update.effective_chat.id
+    try:
+        entry = await cached_leaderboard(chat_id, update.message.text)
+        outbox.send_message(chat_id, entry.text)
+        photo = entry.file_id or InputFile(entry.png, filename=f'leaderboard_{chat_id}.png')
+        with span('upload'):
+            message = await outbox.send_photo(chat_id, photo=photo)
+        entry.file_id = message.photo[-1].file_id
+    except StatError as err:
+        outbox.send_message(chat_id, str(err))
+    except ChartQueueFull:
+        outbox.send_message(chat_id, "Сейчас строится слишком много графиков. "
+                                     "Попробуйте чуть позже")
+    except Exception:
+        logger.exception("Не удалось построить рейтинг чата %s", chat_id)
+        outbox.send_message(chat_id, "Не удалось построить рейтинг. Попробуйте позже")
+    await reply(update, "Выберите временной период: ",
+                reply_markup=markup_stat)
+    return LEADERBOARD_PERIOD
+
+
+@instrument
 async def stat_cat_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text("Выберите категорию: ",
-                                    reply_markup=markup_category_stat)
+    await reply(update, "Выберите категорию: ",
+                reply_markup=markup_category_stat)
     return STAT_CAT
 
 
+@instrument
 async def stat_time_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     category = update.message.text
     context.user_data['category'] = category
 
-    await update.message.reply_text("Выберите временной период: ",
-                                    reply_markup=markup_stat)
+    await reply(update, "Выберите временной период: ",
+                reply_markup=markup_stat)
     return STAT
 
 
-async def stat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    try:
-        user_id = update.message.from_user.id
-        category = context.user_data['category']
-        time_interval = update.message.text  # за день / за неделю ...
+class StatError(Exception):
+    """Сообщение пользователю, когда статистику построить нельзя."""
 
-        translator = {'rest': 'Отдых',
-                      'fun': 'Развлечения',
-                      'work': 'Работа',
-                      'study': 'Учёба',
-                      'read': 'Чтение',
-                      'sport': 'Спорт',
-                      'food': 'Еда',
-                      'walk': 'Прогулка',
-                      'unrecorded': 'Неучтённое время'}
-
-        # Соединяемся с БД
-        conn = sqlite3.connect(db_name)
-        cur = conn.cursor()
-
-        cnt = int(cur.execute(f"SELECT count(timer_id)"
-                              f" from data"
-                              f" where user_id = ?", (user_id,)).fetchall()[0][0])
-        if cnt == 0:
-            await context.bot.send_message(chat_id=update.effective_chat.id,
-                                           text="У вас нет записей в базе данных")
-            return
 
-        # Вычисляем текущую дату и время
-        current_time = datetime.now()
-
-        # Вычисляем дату и время с которого собираем статистику
-        if 'день' in time_interval:
-            time_threshold = current_time - timedelta(days=1)
-        elif 'неделю' in time_interval:
-            time_threshold = current_time - timedelta(days=7)
-        elif 'месяц' in time_interval:
-            time_threshold = current_time - timedelta(days=30)
-        elif 'год' in time_interval:
-            time_threshold = current_time - timedelta(days=365)
-        else:
-            time_threshold = cur.execute(f"SELECT min(date)"
-                                   f" from data"
-                                   f" where user_id = ?", (user_id,)).fetchall()[0][0]
-            time_threshold = datetime.strptime(time_threshold, "%Y-%m-%d")
-
-        # выбираем минимальный день из БД
-        min_date = cur.execute(f"SELECT min(date)"
-                               f" from data"
-                               f" where user_id = ?", (user_id,)).fetchall()[0][0]
-        # переводим его в datetime формат
-        min_date = datetime.strptime(min_date, "%Y-%m-%d")
-
-        # Если наш порог окажется дальше, чем минимальная дата, то в качестве порога
-        # выбираем минимальную дату
-        time_threshold = max(min_date, time_threshold)
-
-        # Форматируем дату и время в строку в нужном формате
-        formatted_time_threshold = time_threshold.strftime('%Y-%m-%d %H:%M:%S')
-
-        summary_seconds = (current_time - time_threshold).total_seconds()
-
-        if category == 'Все категории':
-            cur.execute(f"SELECT mode, sum(time)"
-                        f" from data"
-                        f" where user_id = ? AND"
-                        f" datetime(date || ' ' || start) >= ? AND "
-                        f" datetime(date || ' ' || finish) >= ?"
-                        f" group by mode", (user_id, formatted_time_threshold,
-                                            formatted_time_threshold))
-            result = cur.fetchall()
+async def stat_source(user_id, time_interval):
+    # Долгие периоды читаются из копии, если она уже видит последнее
+    # изменение записей пользователя, иначе из основной базы
+    if analytics is None or time_interval not in ANALYTICS_PERIODS:
+        return database
+    if await analytics.snapshot_ts() < stat_cache.changed_at(user_id):
+        return database
+    return analytics
 
-            unrecorded = summary_seconds - sum([x[1] for x in result])
-            result.append(('unrecorded', unrecorded))
 
-            fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(25, 5))  # Создание двух областей графиков
+async def build_stat(user_id, category, time_interval):
+    """Собирает статистику и возвращает пару (текст или None, PNG)."""
+    db = await stat_source(user_id, time_interval)
+    # Первый день с записями берём из сводной таблицы по первичному ключу
+    min_day, = await db.fetchone("SELECT min(day)"
+                                 " from daily_totals"
+                                 " where user_id = ?", (user_id,))
+    if min_day is None:
+        raise StatError("У вас нет записей в базе данных")
+
+    # Всё считается в UNIX-метках; пояс пользователя нужен для границ дней
+    zone = await user_zone(user_id)
+    now = now_ts()
 
-            # Создание круговой диаграммы
-            ax1.pie([x[1] for x in result],
-                    labels=[translator[x[0]] for x in result],
-                    autopct='%1.1f%%')
-            ax1.set_title(f'Статистика')
+    # Начало первого дня с записями
+    min_ts = zone.day_start(day_number(min_day))
+
+    # Вычисляем момент, с которого собираем статистику, но не раньше первого дня
+    period = PERIODS.get(time_interval)
+    if period is None:
+        threshold_ts = min_ts
+    else:
+        threshold_ts = max(min_ts, now - int(period.total_seconds()))
+
+    summary_seconds = now - threshold_ts
+
+    if category == ALL_CATEGORIES:
+        # Полные дни после порога берём из сводной таблицы, а неполный
+        # первый день досчитываем по сырым записям от порога до полуночи
+        threshold_day = zone.day_number(threshold_ts)
+        next_day_ts = zone.day_start(threshold_day + 1)
+        totals = {}
+        for mode, seconds in await db.fetchall("SELECT mode, sum(seconds)"
+                                               " from daily_totals"
+                                               " where user_id = ? AND day > ?"
+                                               " group by mode",
+                                               (user_id, day_name(threshold_day))):
+            totals[mode] = totals.get(mode, 0) + seconds
+        for mode, seconds in await db.fetchall("SELECT mode, sum(min(finish_ts, ?) - start_ts)"
+                                               " from data"
+                                               " where user_id = ? AND start_ts >= ? AND start_ts < ?"
+                                               " group by mode",
+                                               (next_day_ts, user_id, threshold_ts, next_day_ts)):
+            totals[mode] = totals.get(mode, 0) + seconds
+        with span('aggregate'):
+            result = list(totals.items())
+            unrecorded = summary_seconds - sum([x[1] for x in result])
+            result.append(('unrecorded', unrecorded))
 
-            # Создание гистограммы
-            x = np.arange(len(result))
-            bars = ax2.bar(x, [(x[1] / 60) / 60 for x in result])
-            ax2.set_xticks(x, [translator[x[0]] for x in result])  # Настройка меток оси x
-            ax2.set_ylabel('Время')  # Подпись оси y
+        png = await chart_renderer.render('render_summary',
+                                          [(MODE_LABELS.get(mode, mode), seconds)
+                                           for mode, seconds in result])
+        return None, png
 
-            # Добавление надписей над гистами
-            for bar, annotation in zip(bars, [format_time(x[1]) for x in result]):
-                height = bar.get_height()
-                ax2.text(bar.get_x() + bar.get_width() / 2, height, annotation,
-                         ha='center', va='bottom')
+    if category not in CATEGORY_BY_LABEL:
+        raise StatError("Произошла ошибка c mode")
+    mode = CATEGORY_BY_LABEL[category].mode
 
+    # Выполняем SQL-запрос для выборки всех таймеров, начатых после порога
+    result = await db.fetchall("SELECT start_ts, finish_ts "
+                               "FROM data "
+                               "WHERE user_id = ? AND mode = ? AND start_ts >= ?",
+                               (user_id, mode, threshold_ts))
+    if not result:
+        raise StatError("За выбранный период не найдено данных")
+
+    with span('aggregate'):
+        # Границы корзин гистограммы от порога до текущего момента: за сутки —
+        # по часам, дальше — по местным полуночам через 1, 7 или 30 дней
+        if summary_seconds <= DAY:
+            date_format = '%H'
+            edges = [threshold_ts - (threshold_ts + zone.offset(threshold_ts)) % 3600]
+            while edges[-1] <= now:
+                edges.append(edges[-1] + 3600)
         else:
-            mode = ''
-            for k, v in translator.items():
-                if v == category:
-                    mode = k
-                    break
-            if mode == '':
-                await context.bot.send_message(chat_id=update.effective_chat.id,
-                                               text=f"Произошла ошибка c mode")
-                await update.message.reply_text("Выберите категорию: ",
-                                                reply_markup=markup_category_stat)
-                return STAT_CAT
-
-            # Выполняем SQL-запрос для выборки всех id,
-            # у которых дата и время больше time_threshold
-            cur.execute(f"SELECT date, start, finish "
-                        f"FROM data "
-                        f"WHERE mode = ? AND user_id = ? AND "
-                        f"datetime(date || ' ' || start) >= ? AND "
-                        f"datetime(date || ' ' || finish) >= ?",
-                        (mode, user_id, formatted_time_threshold,
-                         formatted_time_threshold))
-
-            result = cur.fetchall()
-            if not result:
-                await context.bot.send_message(chat_id=update.effective_chat.id,
-                                               text=f"За выбранный период не найдено данных")
-                await update.message.reply_text("Выберите категорию:",
-                                                reply_markup=markup_category_stat)
-                return STAT_CAT
-
-            # Создаем фигуру и ось графика
-            fig, ax = plt.subplots()
-
-            # Вычисляем разницу между текущим временем и временем порога
-            time_difference = current_time - time_threshold
-
-            # Определяем шаг timedelta
-            if time_difference <= timedelta(days=1):
-                # Установка формата даты на оси X
-                # ax.xaxis.set_major_locator(mdates.HourLocator(interval=1))
-                ax.xaxis.set_major_formatter(mdates.DateFormatter('%H'))
-
-                num_intervals = 25
-                step = timedelta(hours=1)
-                # Определяем интервалы для оси X
-                time_intervals = [current_time - (i - 1) * step for i in range(num_intervals + 2)]
-                # Округляем временные метки до часов
-                for i in range(len(time_intervals)):
-                    time_intervals[i] = time_intervals[i].replace(minute=0,
-                                                                  second=0,
-                                                                  microsecond=0)
-            elif timedelta(days=30) < time_difference < timedelta(days=90):
-                ax.xaxis.set_major_formatter(mdates.DateFormatter('%d'))
-                num_intervals = time_difference.days // 7
-                step = timedelta(days=7)
-                # Определяем интервалы для оси X
-                time_intervals = [current_time - (i - 1) * step for i in range(num_intervals + 2)]
-                for i in range(len(time_intervals)):
-                    time_intervals[i] = time_intervals[i].replace(hour=0,
-                                                                  minute=0,
-                                                                  second=0,
-                                                                  microsecond=0)
-            elif timedelta(days=90) <= time_difference:
-                ax.xaxis.set_major_formatter(mdates.DateFormatter('%M'))
-                num_intervals = time_difference.days // 30
-                step = timedelta(days=30)
-                # Определяем интервалы для оси X
-                time_intervals = [current_time - (i - 1) * step for i in range(num_intervals + 2)]
-                for i in range(len(time_intervals)):
-                    time_intervals[i] = time_intervals[i].replace(hour=0,
-                                                                  minute=0,
-                                                                  second=0,
-                                                                  microsecond=0)
+            if summary_seconds <= 30 * DAY:
+                date_format, step_days = '%d', 1
+            elif summary_seconds < 90 * DAY:
+                date_format, step_days = '%d', 7
             else:
-                # Установка формата даты на оси X
-                # ax.xaxis.set_major_locator(mdates.HourLocator(interval=24))
-                ax.xaxis.set_major_formatter(mdates.DateFormatter('%d'))
-                num_intervals = time_difference.days
-                step = timedelta(days=1)
-                # Определяем интервалы для оси X
-                time_intervals = [current_time - (i - 1) * step for i in range(num_intervals + 2)]
-                for i in range(len(time_intervals)):
-                    time_intervals[i] = time_intervals[i].replace(hour=0,
-                                                                  minute=0,
-                                                                  second=0,
-                                                                  microsecond=0)
-
-            # Рисуем вертикальные линии, представляющие интервалы по оси X
-            for time in time_intervals:
-                plt.axvline(x=time, color='gray', linestyle='--', linewidth=0.5)
-
-            # Построение гистограмм
-            s = 0
-            for date, start, finish in result:
-                start_datetime = parse_datetime(date, start)
-                finish_datetime = parse_datetime(date, finish)
-
-                if start > finish:
-                    start_datetime -= timedelta(hours=24)
-
-                # Вычисляем длительность каждого интервала
-                duration = finish_datetime - start_datetime
-                s += duration.total_seconds()
-
-                # Рисуем гистограмму для каждого id
-                # ax.bar(duration.total_seconds() / 3600, duration, left=start_datetime)
-                ax.bar(start_datetime,
-                       duration.total_seconds() / 3600,
-                       duration,
-                       align='edge',
-                       color='b')
-                # ax.plot([start_datetime, finish_datetime], [1, 1], color='b', linewidth=10)
-
-            await context.bot.send_message(chat_id=update.effective_chat.id,
-                                           text=f"Суммарно {time_interval.lower()}, "
-                                                f"на категорию \"{category}\" вы "
-                                                f"потратили: {format_time(s)}")
-
-            # Добавляем подписи осей и заголовок
-            plt.xlabel('Время')
-            plt.ylabel('Часы')
-            plt.title('Статистика')
-
-        cur.close()
-        conn.close()
-
-        # Генерация изображения диаграммы в формате PNG
-        plt.savefig('pie_chart.png', format='png')
-        plt.close()
-
-        # Отправка изображения пользователю
-        await context.bot.send_photo(chat_id=update.effective_chat.id, photo=open('pie_chart.png', 'rb'))
-
-        # Удаление файла после отправки
-        os.remove('pie_chart.png')
-
-        await update.message.reply_text("Выберите категорию:",
-                                        reply_markup=markup_category_stat)
+                date_format, step_days = '%m', 30
+            first_day = zone.day_number(threshold_ts)
+            edges = [zone.day_start(first_day)]
+            while edges[-1] <= now:
+                edges.append(zone.day_start(first_day + len(edges) * step_days))
+
+        # Сами таймеры раскладываются по корзинам в воркере векторно
+        starts, finishes = zip(*result)
+        s = sum(finishes) - sum(starts)
+
+    png = await chart_renderer.render('render_category', starts, finishes, edges,
+                                      date_format, zone.name)
+
+    text = f"Суммарно {time_interval.lower()}, " \
+           f"на категорию \"{category}\" вы " \
+           f"потратили: {format_time(s)}"
+    return text, png
+
+
+@instrument
+async def stat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        user_id = update.message.from_user.id
+        category = context.user_data['category']
+        time_interval = update.message.text  # за день / за неделю ...
+
+        stat_cache.touch(user_id)
+        # Повторный запрос с неизменившимися данными не идёт ни в БД, ни в отрисовку
+        key = (user_id, category, time_interval, stat_cache.version(user_id))
+        entry = stat_cache.get(key)
+        if entry is None:
+            text, png = await build_stat(user_id, category, time_interval)
+            entry = stat_cache.put(key, text, png)
+
+        if entry.text:
+            outbox.send_message(update.effective_chat.id, entry.text)
+
+        # Уже загруженную картинку отправляем по file_id, иначе прямо из памяти
+        photo = entry.file_id or InputFile(entry.png, filename=f'stat_{user_id}.png')
+        with span('upload'):
+            message = await outbox.send_photo(update.effective_chat.id, photo=photo)
+        entry.file_id = message.photo[-1].file_id
+
+        await reply(update, "Выберите категорию:",
+                    reply_markup=markup_category_stat)
         return STAT_CAT
-    except Exception as err:
-        await context.bot.send_message(chat_id=update.effective_chat.id,
-                                       text=f"Произошла ошибка: {err}")
-        await update.message.reply_text("Выберите категорию: ",
-                                        reply_markup=markup_category_stat)
+    except StatError as err:
+        outbox.send_message(update.effective_chat.id, str(err))
+        await reply(update, "Выберите категорию: ",
+                    reply_markup=markup_category_stat)
+    except ChartQueueFull:
+        outbox.send_message(update.effective_chat.id,
+                            "Сейчас строится слишком много графиков. "
+                            "Попробуйте чуть позже")
+        await reply(update, "Выберите категорию: ",
+                    reply_markup=markup_category_stat)
+    except Exception:
+        logger.exception("Не удалось построить статистику пользователя %s",
+                         update.message.from_user.id)
+        outbox.send_message(update.effective_chat.id,
+                            "Не удалось построить статистику. Попробуйте позже")
+        await reply(update, "Выберите категорию: ",
+                    reply_markup=markup_category_stat)
     return STAT_CAT
 
 
-def main() -> None:
-    token = '???????????'
-    # token = '??????????'  # test bot
+async def refresh_snapshots(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Заранее строит частую статистику для недавно активных пользователей.
 
-    application = Application.builder().token(token).build()
+    Пропускает пользователей, у которых запись в кеше для текущей версии
+    данных ещё жива. Графики строятся по одному и только пока пул пуст:
+    запросы пользователей важнее. Запуск прекращается, когда отрисовка
+    заняла больше SNAPSHOT_BUDGET секунд.
+    """
+    started = time.monotonic()
+    built = skipped = 0
+    keys = [(user_id, category, time_interval, stat_cache.version(user_id))
+            for user_id in stat_cache.recently_active(SNAPSHOT_ACTIVE_WINDOW)
+            for category, time_interval in SNAPSHOT_STATS]
+    for key in keys:
+        if stat_cache.peek(key) is not None:
+            skipped += 1
+            continue
+        if chart_renderer.pending or time.monotonic() - started > SNAPSHOT_BUDGET:
+            break
+        user_id, category, time_interval, _ = key
+        try:
+            text, png = await build_stat(user_id, category, time_interval)
+        except (StatError, ChartQueueFull):
+            continue
+        stat_cache.put(key, text, png, snapshot=True)
+        built += 1
+
+    metrics = stat_cache.metrics()
+    logger.info("Снимки статистики: построено=%d пропущено=%d за %.2f с; "
+                "кеш: hit_rate=%.2f snapshot_hits=%d возраст_ср=%.0f с возраст_макс=%.0f с",
+                built, skipped, time.monotonic() - started, metrics['hit_rate'],
+                metrics['snapshot_hits'], metrics['served_age_avg'], metrics['served_age_max'])
+
+
+async def refresh_analytics(context: ContextTypes.DEFAULT_TYPE) -> None:
+    started = time.monotonic()
+    copied = await analytics.refresh()
+    if copied:
+        logger.info("Копия статистики: перенесено записей %d за %.2f с",
+                    copied, time.monotonic() - started)
+
+
+async def expire_change_log(context: ContextTypes.DEFAULT_TYPE) -> None:
+    expired = await database.transaction(expire_change_log_readers, CHANGE_LOG_TTL)
+    if expired:
+        logger.info("Забыто копий статистики, не обновлявшихся %.0f ч: %d",
+                    CHANGE_LOG_TTL / 3600, expired)
+
+
+async def log_metrics(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Одна строка JSON, чтобы её было удобно разбирать сборщиком логов
+    logger.info("metrics %s", json.dumps(registry.summary(), ensure_ascii=False))
+
+
+async def post_init(application: Application) -> None:
+    # Поднимаем и прогреваем воркеры заранее, а не на первом запросе статистики
+    chart_renderer.start()
+    outbox.start(application.bot)
+    await timer_registry.load(application.bot_data.get('shard'))
+    timer_registry.start_flushing()
+    # Сроки таймеров, наступившие, пока бот не работал, обработаются сразу
+    deadline_alarm.arm(application.job_queue)
+    if METRICS_PORT:
+        # У воркеров свои метрики, каждый отдаёт их на своём порту подряд
+        shard = application.bot_data.get('shard')
+        start_http_server(METRICS_HOST, int(METRICS_PORT) + (shard[0] if shard else 0))
+    if application.job_queue is None:
+        logger.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]), "
+                       "фоновые снимки статистики, сводка метрик, обновление копии"
+                       " статистики, очистка журнала изменений, напоминания и"
+                       " автоостановка таймеров отключены")
+    else:
+        application.job_queue.run_repeating(refresh_snapshots, interval=SNAPSHOT_INTERVAL,
+                                            first=SNAPSHOT_INTERVAL, name='stat_snapshots')
+        application.job_queue.run_repeating(log_metrics, interval=METRICS_LOG_INTERVAL,
+                                            first=METRICS_LOG_INTERVAL, name='metrics_log')
+        shard = application.bot_data.get('shard')
+        if analytics is not None and analytics.source and (shard is None or shard[0] == 0):
+            # Первое обновление сразу: пустую копию заполнит целиком
+            application.job_queue.run_repeating(refresh_analytics, interval=ANALYTICS_INTERVAL,
+                                                first=0, name='analytics_refresh')
+        if shard is None or shard[0] == 0:
+            # Копии могут обновляться и по cron (python database.py replica), не только ботом
+            application.job_queue.run_repeating(expire_change_log, interval=3600, first=3600,
+                                                name='change_log_expiry')
+
+
+async def post_shutdown(application: Application) -> None:
+    await outbox.close()
+    chart_renderer.close()
+    # Дописываем в current_timers последние изменения до закрытия БД
+    await timer_registry.close()
+    if analytics is not None:
+        await analytics.close()
+    await database.close()
+
+
+def menu_handler(actions):
+    """Один обработчик на состояние диалога: текст кнопки -> обработчик.
+
+    Фильтр — проверка вхождения в множество кнопок, выбор обработчика —
+    поиск в словаре, вместо перебора регулярных выражений по очереди.
+    """
+    actions = MappingProxyType(dict(actions))
+
+    async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        return await actions[update.message.text](update, context)
+
+    return MessageHandler(filters.Text(frozenset(actions)), dispatch)
+
+
+def open_services(shard=None):
+    """Создаёт объекты, которым нужны файлы, процессы и очереди; один раз на процесс."""
+    global database, analytics, chart_renderer, timer_registry, deadline_alarm, outbox, chat_members
+    # Общий слой доступа к БД: соединения живут всё время работы бота,
+    # записи группируются в транзакции по окну в миллисекундах или по размеру пачки.
+    # DB_URL — путь к файлу SQLite (в том числе на общем томе, тогда для сетевой ФС
+    # нужен DB_JOURNAL_MODE=DELETE) или tcp://host:port сервера БД.
+    database = open_database(os.environ.get('DB_URL', db_name),
+                             commit_window=float(os.environ.get('DB_COMMIT_WINDOW_MS', 2)) / 1000,
+                             batch_size=int(os.environ.get('DB_COMMIT_BATCH', 64)),
+                             journal_mode=os.environ.get('DB_JOURNAL_MODE', 'WAL'))
+    analytics = (Replica(ANALYTICS_DB, source=getattr(database, 'path', None),
+                         readers=int(os.environ.get('ANALYTICS_READERS', 2)),
+                         mmap_size=int(os.environ.get('ANALYTICS_MMAP_MB', 256)) * 2 ** 20)
+                 if ANALYTICS_DB else None)
+    # Пул процессов для графиков; размер и длину очереди можно задать через окружение
+    chart_renderer = ChartRenderer(workers=int(os.environ.get('CHART_WORKERS', 2)),
+                                   max_pending=int(os.environ.get('CHART_QUEUE', 8)))
+    # Запущенные таймеры живут в памяти, в current_timers они пишутся пачками
+    timer_registry = TimerRegistry(database,
+                                   flush_interval=float(os.environ.get('TIMER_FLUSH_INTERVAL', 1.0)),
+                                   remind_after=TIMER_REMIND_AFTER)
+    # Одна задача JobQueue на ближайший срок из кучи timer_registry
+    deadline_alarm = DeadlineAlarm(timer_registry, handle_deadlines)
+    # Общий лимит Telegram на бота делится между воркерами
+    workers = shard[1] if shard is not None else 1
+    outbox = Outbox(global_rate=OUTBOX_GLOBAL_RATE / workers, chat_rate=OUTBOX_CHAT_RATE)
+    # Участники групповых чатов для рейтинга, собираются по входящим сообщениям
+    chat_members = ChatMembers(database, ttl=STAT_CACHE_TTL)
+
+
+def build_application(token, shard=None, request=None) -> Application:
+    """Собирает приложение бота.
+
+    shard — пара (номер воркера, число воркеров), если апдейты делятся между
+    процессами по user_id: воркер поднимает таймеры и состояния только своих
+    пользователей. request — свой BaseRequest для запросов к Bot API
+    (бенчмарк подставляет офлайн-заглушку).
+    """
+    open_services(shard)
+
+    # Пока один пользователь ждёт БД или график, апдейты остальных
+    # обрабатываются; апдейты одного пользователя идут строго по очереди
+    builder = (Application.builder()
+               .token(token)
+               .concurrent_updates(UserOrderedProcessor(MAX_CONCURRENT_UPDATES))
+               .persistence(SQLitePersistence(database, shard=shard,
+                                              update_interval=PERSISTENCE_INTERVAL))
+               .post_init(post_init)
+               .post_shutdown(post_shutdown))
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
+    application.bot_data['shard'] = shard
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
-        states={CHOOSING: [MessageHandler(
-            filters.Regex("^(Работа|Учёба|Развлечения|Еда|"
-                          "Отдых|Чтение|Спорт|Прогулка)$"), timer_choice
-        ),
-            MessageHandler(
-                filters.Regex("^Записи в базе$"), db
-            ),
-            MessageHandler(
-                filters.Regex("^Статистика$"), stat_cat_choice
-            )
-        ],
-            STAT: [MessageHandler(filters.Regex("^(За день|"
-                                                "За неделю|"
-                                                "За месяц|"
-                                                "За год|"
-                                                "За всё время)$"), stat),
-                   MessageHandler(filters.Regex("^Назад$"), home)],
-            STAT_CAT: [MessageHandler(filters.Regex("^(Все категории|"
-                                                    "Работа|Учёба|Развлечения|Еда|"
-                                                    "Отдых|Чтение|Спорт|Прогулка)$"), stat_time_choice),
-                       MessageHandler(filters.Regex("^Назад$"), home)],
-            DB_CHOICE: [MessageHandler(filters.Regex("^Просмотреть записи$"), db_info_choice),
-                        MessageHandler(filters.Regex("^Редактировать записи$"), db_modify_choice),
-                        MessageHandler(filters.Regex("^Назад$"), home)],
-            DB_INFO: [MessageHandler(filters.Regex(r"(?i)запис"), db_info),
-                      MessageHandler(filters.Regex("^Назад$"), home)],
-            DB_MODIFY: [MessageHandler(filters.TEXT, db_modify)],
-            TIMER_OFF: [MessageHandler(filters.Regex("^Остановить таймер$"), timer_off)],
-            WAIT_FOR_NOTE: [MessageHandler(filters.TEXT, note)]},
-        fallbacks=[MessageHandler(filters.Regex("^Завершить работу$"), done)],
+        states={CHOOSING: [menu_handler({**dict.fromkeys(CATEGORY_BY_LABEL, timer_choice),
+                                         "Записи в базе": db,
+                                         "Статистика": stat_cat_choice,
+                                         LEADERBOARD: leaderboard_choice})],
+                STAT: [menu_handler({**dict.fromkeys(PERIODS, stat), "Назад": home})],
+                LEADERBOARD_PERIOD: [menu_handler({**dict.fromkeys(PERIODS, leaderboard),
+                                                   "Назад": home})],
+                STAT_CAT: [menu_handler({**dict.fromkeys([ALL_CATEGORIES, *CATEGORY_BY_LABEL],
+                                                         stat_time_choice),
+                                         "Назад": home})],
+                DB_CHOICE: [menu_handler({"Просмотреть записи": db_info_choice,
+                                          "Редактировать записи": db_modify_choice,
+                                          "Назад": home})],
+                DB_INFO: [menu_handler({**dict.fromkeys(RECORD_LIMITS, db_info),
+                                        "Следующая страница": db_info_next_page,
+                                        "Выгрузить CSV": db_export,
+                                        "Выгрузить JSON": db_export,
+                                        "Назад": home})],
+                DB_MODIFY: [MessageHandler(filters.TEXT, db_modify),
+                            MessageHandler(filters.Document.ALL, db_modify_file)],
+                TIMER_OFF: [menu_handler({"Остановить таймер": timer_off})],
+                WAIT_FOR_NOTE: [MessageHandler(filters.TEXT, note)]},
+        fallbacks=[menu_handler({"Завершить работу": done})],
+        # Состояние диалога хранится в БД и переживает перезапуск воркера
+        name="main",
+        persistent=True,
     )
 
+    # Отдельная группа: учёт участников не мешает обработке того же апдейта
+    application.add_handler(MessageHandler(filters.ChatType.GROUPS, track_chat_member), group=-1)
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("tz", timezone_command))
+    application.add_handler(CommandHandler("cap", cap_command))
+    application.add_handler(CommandHandler("remind", remind_command))
     application.add_handler(conv_handler)
     application.add_handler(MessageHandler(filters.Regex(r"(?i)stat"), stat))
+    return application
+
+
+def parse_args(argv=None):
+    # Все параметры можно задать и через переменные окружения
+    parser = argparse.ArgumentParser(description="Бот-задрот: таймеры и статистика")
+    parser.add_argument('--token', default=os.environ.get('BOT_TOKEN'),
+                        help="токен бота (BOT_TOKEN)")
+    parser.add_argument('--mode', choices=('polling', 'webhook'),
+                        default=os.environ.get('BOT_MODE', 'polling'),
+                        help="способ получения апдейтов (BOT_MODE)")
+    parser.add_argument('--listen', default=os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'),
+                        help="адрес HTTP-сервера вебхука (WEBHOOK_LISTEN)")
+    parser.add_argument('--port', type=int, default=int(os.environ.get('WEBHOOK_PORT', 8443)),
+                        help="порт HTTP-сервера вебхука (WEBHOOK_PORT)")
+    parser.add_argument('--url-path', default=os.environ.get('WEBHOOK_PATH', '/telegram'),
+                        help="путь, на который Telegram присылает апдейты (WEBHOOK_PATH)")
+    parser.add_argument('--webhook-url', default=os.environ.get('WEBHOOK_URL'),
+                        help="публичный адрес вебхука; если задан, регистрируется "
+                             "в Telegram при старте (WEBHOOK_URL)")
+    parser.add_argument('--secret-token', default=os.environ.get('WEBHOOK_SECRET'),
+                        help="секрет в заголовке X-Telegram-Bot-Api-Secret-Token (WEBHOOK_SECRET)")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('BOT_WORKERS', 1)),
+                        help="число процессов-воркеров в режиме вебхука; апдейты "
+                             "делятся между ними по user_id (BOT_WORKERS)")
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error("не задан токен: --token или BOT_TOKEN")
+    if args.workers < 1:
+        parser.error("--workers должно быть не меньше 1")
+    if args.workers > 1 and args.mode != 'webhook':
+        # getUpdates нельзя поделить между процессами
+        parser.error("несколько воркеров поддерживаются только в режиме вебхука")
+    return args
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def main() -> None:
+    args = parse_args()
+    if args.workers > 1:
+        run_router(build_application, args.token, args.workers, args.listen, args.port,
+                   args.url_path, webhook_url=args.webhook_url, secret_token=args.secret_token)
+        return
+
+    application = build_application(args.token)
+    if args.mode == 'webhook':
+        asyncio.run(run_webhook(application, args.listen, args.port, args.url_path,
+                                webhook_url=args.webhook_url,
+                                secret_token=args.secret_token))
+    else:
+        # Run the bot until the user presses Ctrl-C
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+import time
+
+
+def _write_member(conn, chat_id, user_id, name):
+    if name is None:
+        conn.execute("DELETE FROM chat_members WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+    else:
+        conn.execute("INSERT OR REPLACE INTO chat_members (chat_id, user_id, name) VALUES (?, ?, ?)",
+                     (chat_id, user_id, name))
+
+
+class ChatMembers:
+    """Участники групповых чатов, которых бот видел во входящих апдейтах.
+
+    Список участников не запрашивается у Telegram: автор каждого сообщения
+    в группе добавляется в chat_members, вышедшие из чата удаляются. В
+    памяти лежат участники уже встречавшихся чатов, поэтому повторное
+    сообщение известного участника — проверка словаря без записи в БД.
+
+    С --workers N участников одного чата записывают разные процессы, поэтому
+    состав чата перечитывается из БД, если загружен больше ttl секунд назад.
+    version(chat_id) меняется при каждом изменении состава чата, в том числе
+    найденном при перечитывании.
+    """
+
+    def __init__(self, database, ttl=300):
+        self._database = database
+        self._ttl = ttl
+        # chat_id -> {user_id: имя}
+        self._chats = {}
+        # chat_id -> time.monotonic() загрузки из БД
+        self._loaded = {}
+        self._versions = {}
+
+    async def get(self, chat_id):
+        members = self._chats.get(chat_id)
+        loaded = self._loaded.get(chat_id)
+        if members is None or time.monotonic() - loaded >= self._ttl:
+            started = time.monotonic()
+            rows = dict(await self._database.fetchall("SELECT user_id, name FROM chat_members"
+                                                      " WHERE chat_id = ?", (chat_id,)))
+            # Пока шёл запрос, чат мог загрузить или перечитать параллельный апдейт
+            if self._loaded.get(chat_id) != loaded:
+                return self._chats[chat_id]
+            if rows != members:
+                if members is not None:
+                    self._versions[chat_id] = self.version(chat_id) + 1
+                members = self._chats[chat_id] = rows
+            self._loaded[chat_id] = started
+        return members
+
+    def version(self, chat_id):
+        return self._versions.get(chat_id, 0)
+
+    async def seen(self, chat_id, user_id, name):
+        members = await self.get(chat_id)
+        if members.get(user_id) == name:
+            return
+        members[user_id] = name
+        self._versions[chat_id] = self.version(chat_id) + 1
+        await self._database.transaction(_write_member, chat_id, user_id, name)
+
+    async def left(self, chat_id, user_id):
+        members = await self.get(chat_id)
+        if members.pop(user_id, None) is None:
+            return
+        self._versions[chat_id] = self.version(chat_id) + 1
+        await self._database.transaction(_write_member, chat_id, user_id, None)
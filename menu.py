@@ -0,0 +1,60 @@
+from datetime import timedelta
+from types import MappingProxyType
+from typing import NamedTuple
+
+# Неизменяемый реестр кнопок бота. Из него строятся клавиатуры, фильтры
+# состояний диалога и словари для выбора действия по тексту кнопки, поэтому
+# новая категория — это одна строка в CATEGORIES.
+
+
+class Category(NamedTuple):
+    label: str
+    mode: str
+    started_text: str
+
+
+CATEGORIES = (
+    Category('Работа', 'work', 'Запущен таймер работы'),
+    Category('Учёба', 'study', 'Запущен таймер учёбы'),
+    Category('Чтение', 'read', 'Запущен таймер чтения'),
+    Category('Прогулка', 'walk', 'Запущен таймер прогулки'),
+    Category('Отдых', 'rest', 'Запущен таймер отдыха'),
+    Category('Развлечения', 'fun', 'Запущен таймер развлечений'),
+    Category('Спорт', 'sport', 'Запущен таймер спорта'),
+    Category('Еда', 'food', 'Запущен таймер еды'),
+)
+
+CATEGORY_BY_LABEL = MappingProxyType({category.label: category for category in CATEGORIES})
+CATEGORY_BY_MODE = MappingProxyType({category.mode: category for category in CATEGORIES})
+
+ALL_CATEGORIES = 'Все категории'
+
+# Кнопка рейтинга участников в групповом чате
+LEADERBOARD = 'Рейтинг чата'
+
+# Подписи категорий на графиках; время вне таймеров тоже показывается
+MODE_LABELS = MappingProxyType({**{category.mode: category.label for category in CATEGORIES},
+                                'unrecorded': 'Неучтённое время'})
+
+# Период статистики: насколько назад от текущего момента, None — всё время
+PERIODS = MappingProxyType({
+    'За день': timedelta(days=1),
+    'За неделю': timedelta(days=7),
+    'За месяц': timedelta(days=30),
+    'За год': timedelta(days=365),
+    'За всё время': None,
+})
+
+# Кнопки просмотра записей: сколько последних записей показать, None — все постранично
+RECORD_LIMITS = MappingProxyType({
+    'Последняя запись': 1,
+    'Последние 5 записей': 5,
+    'Последние 10 записей': 10,
+    'Все записи': None,
+})
+
+
+def rows(labels, width):
+    """Раскладывает кнопки по рядам клавиатуры по width в ряд."""
+    labels = list(labels)
+    return [labels[i:i + width] for i in range(0, len(labels), width)]
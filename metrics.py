@@ -0,0 +1,249 @@
+import bisect
+import contextlib
+import contextvars
+import cProfile
+import functools
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        # Последняя корзина — всё, что больше BUCKETS[-1]
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля сверху: граница корзины, в которую он попал."""
+        rank = q * self.count
+        for bound, total in zip(BUCKETS + (float('inf'),), itertools.accumulate(self.counts)):
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+class Metrics:
+    """Счётчики и гистограммы процесса бота.
+
+    Метрика задаётся именем и кортежем пар меток ((имя, значение), ...).
+    Запись — пара словарных операций под блокировкой, поэтому метрики можно
+    не выключать в проде. Для значений, которые проще прочитать, чем
+    считать (размер кеша, длина очереди), есть сборщики: функции,
+    возвращающие словарь {имя: значение}.
+    """
+
+    def __init__(self):
+        # Отдача /metrics идёт из отдельного потока
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[name, labels] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[name, labels] = self._counters.get((name, labels), 0) + value
+
+    def add_collector(self, collect):
+        self._collectors.append(collect)
+
+    def _gauges(self):
+        gauges = {}
+        for collect in self._collectors:
+            try:
+                gauges.update(collect())
+            except Exception:
+                logger.exception("Сборщик метрик завершился с ошибкой")
+        return gauges
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count))
+                                for key, h in self._histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        for name, value in sorted(self._gauges().items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Короткая сводка для строки лога: число, среднее и p95 в мс."""
+        with self._lock:
+            histograms = {
+                name + _format_labels(labels): {
+                    'count': histogram.count,
+                    'avg_ms': round(1000 * histogram.sum / histogram.count, 1),
+                    'p95_ms': round(1000 * histogram.quantile(0.95), 1),
+                }
+                for (name, labels), histogram in sorted(self._histograms.items())
+            }
+            counters = {name + _format_labels(labels): value
+                        for (name, labels), value in sorted(self._counters.items())}
+        return {'histograms': histograms, 'counters': counters, 'gauges': self._gauges()}
+
+
+registry = Metrics()
+
+# Имя обработчика, внутри которого сейчас выполняется код
+_handler = contextvars.ContextVar('metrics_handler', default='background')
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Замер этапа обработки (db, render, upload, ...) внутри текущего обработчика."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('bot_stage_seconds', time.perf_counter() - started,
+                         (('handler', _handler.get()), ('stage', stage)))
+
+
+class SlowestProfiler:
+    """Профилирует выборку запросов и хранит cProfile самых медленных.
+
+    Профилируется каждый sample-й запрос и только если сейчас не идёт
+    другой замер: cProfile один на поток. Обработчики работают в одном
+    event loop, поэтому в профиль попадает и то, что другие апдейты
+    успели сделать за время запроса. Хранятся top самых медленных
+    профилей в directory; их можно открыть через pstats, snakeviz или
+    построить по ним flamegraph.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self._top = 0
+        self._sample = 1
+        self._counter = itertools.count()
+        self._active = False
+        # (длительность, путь к файлу) — минимальная куча из top самых медленных
+        self._slowest = []
+
+    def configure(self, directory, top=10, sample=10):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._top = top
+        self._sample = max(1, sample)
+
+    def start(self):
+        if self.directory is None or self._active or next(self._counter) % self._sample:
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        self._active = True
+        return profile
+
+    def finish(self, profile, name, elapsed):
+        if profile is None:
+            return
+        profile.disable()
+        self._active = False
+        if len(self._slowest) >= self._top and elapsed <= self._slowest[0][0]:
+            return
+        path = os.path.join(self.directory, f'{name}_{int(elapsed * 1000)}ms_{time.time_ns()}.prof')
+        profile.dump_stats(path)
+        heapq.heappush(self._slowest, (elapsed, path))
+        if len(self._slowest) > self._top:
+            _, evicted = heapq.heappop(self._slowest)
+            os.remove(evicted)
+
+
+profiler = SlowestProfiler()
+
+
+def instrument(handler):
+    """Декоратор обработчика: время, число вызовов и ошибок, выборочный профиль."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        token = _handler.set(name)
+        profile = profiler.start()
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return await handler(update, context)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _handler.reset(token)
+            profiler.finish(profile, name, elapsed)
+            registry.observe('bot_handler_seconds', elapsed, (('handler', name),))
+            registry.inc('bot_handler_total', (('handler', name), ('status', status)))
+
+    return wrapper
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(host, port):
+    """Отдаёт GET /metrics из фонового потока; работает и при polling, и при вебхуке."""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,243 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.paused_until = 0
+
+    def delay(self, now):
+        """Через сколько секунд можно будет отправить следующее сообщение."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        self.paused_until = now + seconds
+        self.tokens = 0
+
+
+class _Item:
+    __slots__ = ('priority', 'seq', 'chat_id', 'method', 'kwargs', 'future', 'pending')
+
+    def __init__(self, priority, seq, chat_id, method, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.pending = True
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def _log_failure(future):
+    # Ошибку забираем здесь, чтобы неожидаемые отправки не терялись молча
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Не удалось отправить сообщение", exc_info=future.exception())
+
+
+class Outbox:
+    """Общая очередь исходящих сообщений с учётом лимитов Telegram.
+
+    Лимиты считаются токен-бакетами: общий на бота и свой на каждый чат
+    (для групп он строже). Сообщения с меньшим priority уходят раньше, так
+    что подтверждения таймеров обгоняют большие выгрузки. Подряд идущие
+    тексты в один чат склеиваются в одно сообщение, пока оно укладывается в
+    MESSAGE_LIMIT. На 429 чат ставится на паузу на retry_after секунд, а
+    сообщение возвращается в очередь. В каждый чат одновременно отправляется
+    не больше одного сообщения, чтобы не нарушать порядок.
+    """
+
+    HIGH = 0
+    NORMAL = 1
+    BULK = 2
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60,
+                 group_burst=5, max_in_flight=16):
+        self._global_rate = global_rate
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._group_rate = group_rate
+        self._group_burst = group_burst
+        self._max_in_flight = max_in_flight
+        self._bot = None
+        self._heap = []
+        self._seq = itertools.count()
+        self._global = None
+        self._buckets = {}
+        # Последнее поставленное в очередь сообщение каждого чата — для склейки
+        self._tails = {}
+        self._busy_chats = set()
+        self._wakeup = None
+        self._slots = None
+        self._task = None
+
+    def start(self, bot):
+        loop = asyncio.get_running_loop()
+        self._bot = bot
+        self._global = TokenBucket(self._global_rate, self._global_rate, loop.time())
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self._max_in_flight)
+        self._task = loop.create_task(self._dispatch_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def queued(self):
+        """Сколько сообщений ждёт отправки."""
+        return len(self._heap)
+
+    def _bucket(self, chat_id, now):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные chat_id у групп и каналов
+            if chat_id < 0:
+                bucket = TokenBucket(self._group_rate, self._group_burst, now)
+            else:
+                bucket = TokenBucket(self._chat_rate, self._chat_burst, now)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _enqueue(self, chat_id, method, priority, kwargs):
+        tail = self._tails.get(chat_id)
+        if (method == 'send_message' and tail is not None and tail.pending
+                and tail.method == 'send_message' and tail.priority == priority
+                and set(tail.kwargs) == {'text'} and set(kwargs) <= {'text', 'reply_markup'}
+                and len(tail.kwargs['text']) + 1 + len(kwargs['text']) <= MESSAGE_LIMIT):
+            # Дописываем текст к ещё не отправленному сообщению этого чата
+            tail.kwargs['text'] += '\n' + kwargs['text']
+            if 'reply_markup' in kwargs:
+                tail.kwargs['reply_markup'] = kwargs['reply_markup']
+            return tail.future
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_log_failure)
+        item = _Item(priority, next(self._seq), chat_id, method, kwargs, future)
+        self._tails[chat_id] = item
+        heapq.heappush(self._heap, item)
+        self._wakeup.set()
+        return future
+
+    # Методы ставят сообщение в очередь сразу и возвращают future с отправленным
+    # Message. Ждать его не обязательно: так несколько текстов подряд успевают
+    # склеиться в одно сообщение.
+    def send_message(self, chat_id, text, priority=NORMAL, **kwargs):
+        return self._enqueue(chat_id, 'send_message', priority, dict(text=text, **kwargs))
+
+    def send_photo(self, chat_id, photo, priority=NORMAL, **kwargs):
+        return self._enqueue(chat_id, 'send_photo', priority, dict(photo=photo, **kwargs))
+
+    def send_document(self, chat_id, document, priority=NORMAL, **kwargs):
+        return self._enqueue(chat_id, 'send_document', priority, dict(document=document, **kwargs))
+
+    def _pop_ready(self, now):
+        """Достаёт самое приоритетное сообщение, чат которого не ограничен.
+
+        Возвращает (сообщение или None, сколько ждать до ближайшего готового).
+        """
+        skipped = []
+        item = None
+        wait = None
+        while self._heap:
+            candidate = heapq.heappop(self._heap)
+            if candidate.chat_id in self._busy_chats:
+                skipped.append(candidate)
+                continue
+            delay = self._bucket(candidate.chat_id, now).delay(now)
+            if delay <= 0:
+                item = candidate
+                break
+            wait = delay if wait is None else min(wait, delay)
+            skipped.append(candidate)
+        for candidate in skipped:
+            heapq.heappush(self._heap, candidate)
+        return item, wait
+
+    async def _dispatch_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            wait = None
+            if self._heap:
+                now = loop.time()
+                wait = self._global.delay(now)
+                if wait <= 0:
+                    item, wait = self._pop_ready(now)
+                    if item is not None:
+                        await self._slots.acquire()
+                        item.pending = False
+                        if self._tails.get(item.chat_id) is item:
+                            del self._tails[item.chat_id]
+                        self._global.take()
+                        self._bucket(item.chat_id, now).take()
+                        self._busy_chats.add(item.chat_id)
+                        loop.create_task(self._send(item))
+                        continue
+
+            # Ждём новое сообщение, конец отправки или освобождение лимита
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, item):
+        started = time.perf_counter()
+        try:
+            result = await getattr(self._bot, item.method)(chat_id=item.chat_id, **item.kwargs)
+        except RetryAfter as err:
+            registry.inc('bot_telegram_retry_after_total')
+            retry_after = err.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning("Чат %s: превышен лимит, повтор через %s с", item.chat_id, retry_after)
+            now = asyncio.get_running_loop().time()
+            self._bucket(item.chat_id, now).pause(now, retry_after)
+            heapq.heappush(self._heap, item)
+        except Exception as err:
+            if not item.future.done():
+                item.future.set_exception(err)
+        else:
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            registry.observe('bot_telegram_request_seconds', time.perf_counter() - started,
+                             (('method', item.method),))
+            self._busy_chats.discard(item.chat_id)
+            self._slots.release()
+            self._wakeup.set()
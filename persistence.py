@@ -0,0 +1,105 @@
+import json
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+
+def _write_conversation(conn, name, key, user_id, state):
+    if state is None:
+        conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+    else:
+        conn.execute("INSERT OR REPLACE INTO conversations (name, key, user_id, state)"
+                     " VALUES (?, ?, ?, ?)", (name, key, user_id, json.dumps(state)))
+
+
+def _write_user_data(conn, user_id, data):
+    if data is None:
+        conn.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+    else:
+        conn.execute("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                     (user_id, json.dumps(data, ensure_ascii=False)))
+
+
+class SQLitePersistence(BasePersistence):
+    """Состояния ConversationHandler и user_data в общей БД бота.
+
+    Хранится только то, что нужно диалогам: user_data и состояния
+    разговоров, значения сериализуются в JSON. Application сбрасывает
+    изменения раз в update_interval секунд и при остановке, записи идут
+    через группирующую транзакции очередь Database.
+
+    Если апдейты делятся между воркерами по user_id, shard — пара
+    (номер воркера, число воркеров), и воркер читает только своих
+    пользователей. Пользователь всегда приходит в один и тот же воркер,
+    поэтому перечитывать данные перед каждым апдейтом не нужно.
+    """
+
+    def __init__(self, database, shard=None, update_interval=60):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False,
+                                                     user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self._database = database
+        self._shard = shard
+
+    def _shard_filter(self):
+        if self._shard is None:
+            return "", ()
+        index, count = self._shard
+        return " WHERE user_id % ? = ?", (count, index)
+
+    async def get_user_data(self):
+        where, params = self._shard_filter()
+        rows = await self._database.fetchall("SELECT user_id, data FROM user_data" + where, params)
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    async def get_conversations(self, name):
+        where, params = self._shard_filter()
+        where = (where + " AND" if where else " WHERE") + " name = ?"
+        rows = await self._database.fetchall("SELECT key, state FROM conversations" + where,
+                                             params + (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        # Ключ — (chat_id, user_id): user_id последний, по нему делятся воркеры
+        await self._database.transaction(_write_conversation, name, json.dumps(key),
+                                         key[-1], new_state)
+
+    async def update_user_data(self, user_id, data):
+        await self._database.transaction(_write_user_data, user_id, data)
+
+    async def drop_user_data(self, user_id):
+        await self._database.transaction(_write_user_data, user_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def flush(self):
+        pass
+
+    # chat_data, bot_data и callback_data не хранятся
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,142 @@
+# Отрисовка графиков. Модуль импортируется только в процессах пула
+# ChartRenderer: matplotlib и numpy не нужны основному процессу бота и не
+# должны замедлять его запуск.
+import io
+
+import matplotlib
+
+# Явно выбираем неинтерактивный backend до импорта остального matplotlib
+matplotlib.use('Agg')
+
+import matplotlib.dates as mdates
+import numpy as np
+from matplotlib.figure import Figure
+
+from charts import format_time
+from timezones import get_zone, shift
+
+
+def _to_png(fig):
+    # У каждой отрисовки свой буфер в памяти; наружу отдаём только байты
+    with io.BytesIO() as buf:
+        fig.savefig(buf, format='png')
+        return buf.getvalue()
+
+
+def render_summary(result):
+    """Круговая диаграмма и гистограмма по категориям.
+
+    result — список пар (название категории, секунды).
+    """
+    # Создание двух областей графиков. Figure не регистрируется в pyplot,
+    # поэтому параллельные отрисовки не делят общее состояние.
+    fig = Figure(figsize=(25, 5))
+    ax1, ax2 = fig.subplots(1, 2)
+
+    # Создание круговой диаграммы
+    ax1.pie([x[1] for x in result],
+            labels=[x[0] for x in result],
+            autopct='%1.1f%%')
+    ax1.set_title('Статистика')
+
+    # Создание гистограммы
+    x = np.arange(len(result))
+    bars = ax2.bar(x, [(x[1] / 60) / 60 for x in result])
+    ax2.set_xticks(x, [x[0] for x in result])  # Настройка меток оси x
+    ax2.set_ylabel('Время')  # Подпись оси y
+
+    # Добавление надписей над гистами
+    for bar, annotation in zip(bars, [format_time(x[1]) for x in result]):
+        height = bar.get_height()
+        ax2.text(bar.get_x() + bar.get_width() / 2, height, annotation,
+                 ha='center', va='bottom')
+
+    return _to_png(fig)
+
+
+def bin_intervals(starts, finishes, edges):
+    """Секунды таймеров в каждой корзине [edges[i], edges[i + 1]).
+
+    Таймер, пересекающий границу корзины (в том числе полночь), делится
+    между соседними корзинами. Считается без цикла по таймерам: покрытие до
+    момента e равно сумме (e - start) по стартам до e минус сумме (e - finish)
+    по финишам до e, а секунды в корзине — разность покрытий на её границах.
+    """
+    edges = np.asarray(edges, dtype=np.int64)
+
+    def covered(points):
+        points = np.sort(np.asarray(points, dtype=np.int64))
+        prefix = np.concatenate(([0], np.cumsum(points)))
+        count = np.searchsorted(points, edges, side='right')
+        return count * edges - prefix[count]
+
+    return np.diff(covered(starts) - covered(finishes))
+
+
+def render_category(starts, finishes, edges, date_format, tz):
+    """Гистограмма таймеров одной категории.
+
+    starts и finishes — UNIX-метки таймеров, edges — границы корзин,
+    tz — часовой пояс пользователя для подписей по местному времени.
+    """
+    seconds = bin_intervals(starts, finishes, edges)
+
+    zone = get_zone(tz)
+    edges = np.asarray(edges, dtype=np.int64)
+    local_edges = shift(edges, zone.transitions, zone.offsets).astype('datetime64[s]')
+    widths = np.diff(edges) / 86400
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter(date_format))
+
+    # Вертикальные линии на границах корзин одной коллекцией
+    ax.vlines(local_edges, 0, 1, transform=ax.get_xaxis_transform(),
+              color='gray', linestyle='--', linewidth=0.5)
+
+    # Вся гистограмма — один вызов bar
+    ax.bar(local_edges[:-1], seconds / 3600, widths, align='edge', color='b')
+
+    # Добавляем подписи осей и заголовок
+    ax.set_xlabel('Время')
+    ax.set_ylabel('Часы')
+    ax.set_title('Статистика')
+
+    return _to_png(fig)
+
+
+def render_leaderboard(names, labels, seconds):
+    """Рейтинг участников чата: горизонтальные столбцы из частей по категориям.
+
+    names — участники от первого места к последнему, labels — подписи
+    категорий, seconds[i][j] — секунды участника j в категории i.
+    """
+    hours = np.asarray(seconds, dtype=np.float64) / 3600
+    y = np.arange(len(names))
+
+    fig = Figure(figsize=(10, max(3, 0.5 * len(names) + 1.5)))
+    ax = fig.subplots()
+    left = np.zeros(len(names))
+    for label, row in zip(labels, hours):
+        ax.barh(y, row, left=left, label=label)
+        left += row
+
+    # Суммарное время справа от каждого столбца
+    for position, total in zip(y, left):
+        ax.text(total, position, ' ' + format_time(total * 3600), va='center')
+
+    # Место справа под подпись самого длинного столбца
+    ax.margins(x=0.15)
+    ax.set_yticks(y, names)
+    ax.invert_yaxis()
+    ax.set_xlabel('Часы')
+    ax.set_title('Рейтинг чата')
+    ax.legend(loc='lower right')
+    fig.tight_layout()
+
+    return _to_png(fig)
+
+
+def warm_up():
+    # Первая отрисовка загружает шрифты и заполняет кеши matplotlib
+    render_summary([('warm up', 1)])
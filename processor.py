@@ -0,0 +1,59 @@
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+
+def conversation_key(update):
+    """(chat_id, user_id) апдейта, как у ConversationHandler; None — апдейт без чата и автора."""
+    chat = getattr(update, 'effective_chat', None)
+    user = getattr(update, 'effective_user', None)
+    if chat is None and user is None:
+        return None
+    return (chat.id if chat else None, user.id if user else None)
+
+
+class UserOrderedProcessor(BaseUpdateProcessor):
+    """Апдейты одного пользователя в чате — по очереди, разных — параллельно.
+
+    ConversationHandler переводит диалог в новое состояние только после
+    возврата обработчика, поэтому при обычном concurrent_updates два быстрых
+    нажатия одного пользователя сверялись бы с одним и тем же старым
+    состоянием. Здесь апдейты с одним ключом диалога ждут друг друга в
+    порядке поступления (asyncio.Lock отдаёт блокировку по очереди), а
+    пользователи, ждущие БД или график, не задерживают остальных.
+
+    Место в max_concurrent_updates берётся уже после очереди своего ключа:
+    апдейты, ждущие предыдущий апдейт того же пользователя, его не занимают
+    и не мешают другим пользователям.
+    """
+
+    def __init__(self, max_concurrent_updates=256):
+        super().__init__(max_concurrent_updates)
+        # ключ диалога -> [Lock, сколько апдейтов его держат или ждут]
+        self._locks = {}
+
+    async def process_update(self, update, coroutine):
+        key = conversation_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
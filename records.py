@@ -0,0 +1,106 @@
+import json
+from datetime import datetime, timedelta
+
+from database import update_rollup, update_rollup_many
+from timezones import DAY, get_zone
+
+# Функции, которые выполняются внутри Database.transaction. Они живут в
+# отдельном модуле без побочных эффектов при импорте: сервер БД
+# (python database.py serve) получает их по имени и импортирует у себя.
+
+
+def save_note(conn, user_id, timer_id, note_text, tz):
+    if timer_id is None:
+        # Выбираем последний таймер нашего пользователя
+        timer_id = conn.execute("SELECT max(timer_id) from data where user_id = ?",
+                                (user_id,)).fetchone()[0]
+    if '/delete' in note_text:
+        # Удаляем запись и вычитаем её из сводной таблицы
+        row = conn.execute("SELECT mode, start_ts, finish_ts from data"
+                           " where timer_id = ? and user_id = ?",
+                           (timer_id, user_id)).fetchone()
+        if row:
+            conn.execute("DELETE from data where timer_id = ?", (timer_id,))
+            update_rollup(conn, user_id, *row, get_zone(tz), sign=-1)
+    else:
+        # Ставим заметку
+        conn.execute("UPDATE data set note = ? where timer_id = ? and user_id = ?",
+                     (note_text, timer_id, user_id))
+
+
+def modify_records(conn, user_id, edits, tz):
+    """Применяет пакет правок (edits.Edit) и возвращает (изменено, удалено, не найдены).
+
+    Владелец всех записей проверяется одним запросом. Если хоть одного
+    таймера пользователя нет, ничего не меняется.
+    """
+    # Список id одним параметром: текст запроса не зависит от размера пакета
+    rows = {timer_id: row for timer_id, *row in conn.execute(
+        "SELECT timer_id, mode, start_ts, finish_ts from data"
+        " where timer_id IN (SELECT value FROM json_each(?)) and user_id = ?",
+        (json.dumps([edit.timer_id for edit in edits]), user_id))}
+    missing = [edit.timer_id for edit in edits if edit.timer_id not in rows]
+    if missing:
+        return 0, 0, missing
+
+    zone = get_zone(tz)
+    updates, deletes, changes = [], [], []
+    for edit in edits:
+        mode, old_start_ts, old_finish_ts = rows[edit.timer_id]
+        changes.append((mode, old_start_ts, old_finish_ts, -1))
+        if edit.start is None:
+            deletes.append((edit.timer_id,))
+            continue
+        # Без даты — тот же местный день, что и прежний финиш; старт
+        # позже финиша значит, что таймер начался накануне
+        day = edit.day or zone.localize(old_finish_ts).date()
+        mode = edit.mode or mode
+        finish_ts = zone.to_timestamp(datetime.combine(day, edit.finish))
+        start_day = day - timedelta(days=1) if edit.start > edit.finish else day
+        start_ts = zone.to_timestamp(datetime.combine(start_day, edit.start))
+        updates.append((day.isoformat(), mode, edit.start.strftime("%H:%M:%S"),
+                        edit.finish.strftime("%H:%M:%S"), finish_ts - start_ts, edit.note,
+                        start_ts, finish_ts, edit.timer_id))
+        changes.append((mode, start_ts, finish_ts, 1))
+
+    conn.executemany("UPDATE data set date = ?, mode = ?, start = ?, finish = ?, time = ?, note = ?,"
+                     " start_ts = ?, finish_ts = ? where timer_id = ?", updates)
+    conn.executemany("DELETE from data where timer_id = ?", deletes)
+    update_rollup_many(conn, user_id, changes, zone)
+    return len(updates), len(deletes), []
+
+
+def stop_timer(conn, user_id, start_ts, mode, finish_ts, tz):
+    # Обе отметки — UNIX-метки, поэтому таймер через полночь считается как любой другой
+    elapsed = finish_ts - start_ts
+    if elapsed > DAY:
+        return None
+
+    # date/start/finish — местное время пользователя для показа записей
+    zone = get_zone(tz)
+    start, finish = zone.localize(start_ts), zone.localize(finish_ts)
+    # Номер таймера выдаёт SQLite при вставке
+    timer_id, = conn.execute("INSERT INTO data (user_id, date, mode, start, finish, time, note,"
+                             " start_ts, finish_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                             " RETURNING timer_id",
+                             (user_id, finish.date().isoformat(), mode,
+                              start.strftime("%H:%M:%S"), finish.strftime("%H:%M:%S"),
+                              elapsed, '', start_ts, finish_ts)).fetchone()
+    update_rollup(conn, user_id, mode, start_ts, finish_ts, zone)
+    return timer_id, timedelta(seconds=elapsed)
+
+
+def set_timezone(conn, user_id, tz):
+    # Дни в daily_totals считаются по поясу пользователя: пересчитываем его сводку.
+    # Записей у одного пользователя немного, numpy для этого не нужен.
+    conn.execute("INSERT OR REPLACE INTO user_settings (user_id, tz) VALUES (?, ?)", (user_id, tz))
+    conn.execute("DELETE FROM daily_totals WHERE user_id = ?", (user_id,))
+    zone = get_zone(tz)
+    for mode, start_ts, finish_ts in conn.execute("SELECT mode, start_ts, finish_ts FROM data"
+                                                  " WHERE user_id = ?", (user_id,)).fetchall():
+        update_rollup(conn, user_id, mode, start_ts, finish_ts, zone)
+
+
+def set_timer_limits(conn, user_id, remind_after, cap):
+    conn.execute("INSERT OR REPLACE INTO timer_settings (user_id, remind_after, cap) VALUES (?, ?, ?)",
+                 (user_id, remind_after, cap))
@@ -0,0 +1,196 @@
+"""Копия данных для тяжёлой статистики в отдельном файле SQLite.
+
+Долгие периоды статистики читают много строк; на копии эти чтения не
+делят файл и блокировки с записью таймеров и могут идти параллельно из
+нескольких процессов. Читатели открывают копию с mmap_size и query_only.
+
+Копия содержит data без заметок и строк местного времени и daily_totals,
+скопированную из основной базы. Обновление инкрементное: новые записи
+берутся по timer_id больше прошлого (AUTOINCREMENT не выдаёт номера
+повторно), правки и удаления — из журнала change_log, который пополняют
+триггеры основной базы. Копии отмечаются в основной базе
+(change_log_readers): журнал пишется, только пока есть хоть одна копия, и
+хранится до части, прочитанной всеми. Каждую копию должен обновлять один
+процесс.
+
+    python database.py replica telegram_bot_timer.db analytics.db
+"""
+import time
+
+from database import Database, trim_change_log
+from timezones import DAY, day_name
+
+REPLICA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS data (
+    timer_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    start_ts INTEGER,
+    finish_ts INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_data_user_mode_start ON data (user_id, mode, start_ts);
+CREATE INDEX IF NOT EXISTS idx_data_user_start ON data (user_id, start_ts);
+CREATE TABLE IF NOT EXISTS daily_totals (
+    user_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    seconds INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day, mode)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS replica_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    last_timer_id INTEGER NOT NULL,
+    last_change INTEGER NOT NULL,
+    snapshot_ts REAL NOT NULL
+);
+INSERT OR IGNORE INTO replica_state (id, last_timer_id, last_change, snapshot_ts) VALUES (0, 0, 0, 0);
+"""
+
+
+def _copy_totals(conn, user_id, since):
+    conn.execute("DELETE FROM daily_totals WHERE user_id = ? AND day >= ?", (user_id, since))
+    conn.execute("INSERT INTO daily_totals (user_id, day, mode, seconds)"
+                 " SELECT user_id, day, mode, seconds FROM src.daily_totals"
+                 " WHERE user_id = ? AND day >= ?", (user_id, since))
+
+
+def refresh(conn, source):
+    """Переносит в копию изменения базы source с прошлого обновления.
+
+    Возвращает число перенесённых записей data. Чтение source идёт в одной
+    транзакции с записью копии, то есть по согласованному снимку; на
+    основную базу в режиме WAL это не ставит блокировку записи.
+    """
+    conn.executescript(REPLICA_SCHEMA)
+    # Копия отмечается в основной базе по пути своего файла
+    name = next(path for _, schema, path in conn.execute("PRAGMA database_list") if schema == 'main')
+    conn.execute("ATTACH DATABASE ? AS src", (source,))
+    try:
+        # Отметка до снимка: с этого момента триггеры пишут журнал и для этой копии
+        conn.execute("INSERT OR IGNORE INTO src.change_log_readers (name, last_change, seen_ts)"
+                     " VALUES (?, -1, ?)", (name, time.time()))
+        # BEGIN без IMMEDIATE: блокировку записи берём только на копию
+        conn.execute("BEGIN")
+        try:
+            snapshot_ts = time.time()
+            last_timer_id, last_change = conn.execute("SELECT last_timer_id, last_change"
+                                                      " FROM replica_state").fetchone()
+            # Счётчики AUTOINCREMENT не уменьшаются при удалении строк, в отличие
+            # от max(): ни удалённые записи, ни очищенный журнал их не сбивают
+            sequences = dict(conn.execute("SELECT name, seq FROM src.sqlite_sequence"
+                                          " WHERE name IN ('data', 'change_log')"))
+            top_timer_id = sequences.get('data', 0)
+            top_change = sequences.get('change_log', 0)
+            reader = conn.execute("SELECT last_change FROM src.change_log_readers WHERE name = ?",
+                                  (name,)).fetchone()
+            if (reader is None or reader[0] < 0
+                    or top_timer_id < last_timer_id or top_change < last_change):
+                # Копия новая или забыта основной базой (журнал для неё не
+                # писался), либо основную базу пересоздали: собираем заново
+                last_timer_id = last_change = 0
+
+            if last_timer_id == 0:
+                conn.execute("DELETE FROM data")
+                conn.execute("DELETE FROM daily_totals")
+                copied = conn.execute("INSERT INTO data (timer_id, user_id, mode, start_ts, finish_ts)"
+                                      " SELECT timer_id, user_id, mode, start_ts, finish_ts"
+                                      " FROM src.data").rowcount
+                conn.execute("INSERT INTO daily_totals (user_id, day, mode, seconds)"
+                             " SELECT user_id, day, mode, seconds FROM src.daily_totals")
+            else:
+                # user_id -> с какого дня заново скопировать daily_totals пользователя.
+                # День берётся по UTC на сутки раньше: так он не позже местного в любом поясе.
+                since = {}
+
+                def changed(user_id, start_ts):
+                    day = day_name(start_ts // DAY - 1) if start_ts is not None else ''
+                    since[user_id] = min(since.get(user_id, day), day)
+
+                timer_ids = set()
+                for user_id, timer_id in conn.execute("SELECT user_id, timer_id FROM src.change_log"
+                                                      " WHERE seq > ?", (last_change,)).fetchall():
+                    if timer_id is None:
+                        # Сменился пояс: дни пользователя пересчитаны целиком
+                        since[user_id] = ''
+                    elif timer_id <= last_timer_id:
+                        # Записи новее last_timer_id придут ниже вместе с новыми
+                        timer_ids.add(timer_id)
+                for timer_id in timer_ids:
+                    row = conn.execute("SELECT user_id, start_ts FROM data WHERE timer_id = ?",
+                                       (timer_id,)).fetchone()
+                    if row:
+                        changed(*row)
+                        conn.execute("DELETE FROM data WHERE timer_id = ?", (timer_id,))
+                rows = [row for timer_id in timer_ids
+                        for row in conn.execute("SELECT timer_id, user_id, mode, start_ts, finish_ts"
+                                                " FROM src.data WHERE timer_id = ?", (timer_id,))]
+                rows += conn.execute("SELECT timer_id, user_id, mode, start_ts, finish_ts"
+                                     " FROM src.data WHERE timer_id > ?", (last_timer_id,)).fetchall()
+                conn.executemany("INSERT INTO data (timer_id, user_id, mode, start_ts, finish_ts)"
+                                 " VALUES (?, ?, ?, ?, ?)", rows)
+                for _, user_id, _, start_ts, _ in rows:
+                    changed(user_id, start_ts)
+                for user_id, day in since.items():
+                    _copy_totals(conn, user_id, day)
+                copied = len(rows)
+
+            conn.execute("UPDATE replica_state SET last_timer_id = ?, last_change = ?, snapshot_ts = ?",
+                         (top_timer_id, top_change, snapshot_ts))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        # Короткие записи в основную базу: отметка прочитанного и очистка журнала
+        if not conn.execute("UPDATE src.change_log_readers SET last_change = ?, seen_ts = ?"
+                            " WHERE name = ?", (top_change, time.time(), name)).rowcount:
+            # Копию забыли во время обновления: изменения после снимка могли
+            # не попасть в журнал, в следующий раз собираем заново
+            conn.execute("UPDATE replica_state SET last_timer_id = 0")
+        trim_change_log(conn, 'src')
+    finally:
+        conn.execute("DETACH DATABASE src")
+    return copied
+
+
+class Replica(Database):
+    """Копия для чтения статистики: пул читателей как у Database.
+
+    Соединения читателей открываются с query_only и mmap_size: страницы
+    копии читаются из отображённого файла без копирования в кеш SQLite.
+    refresh() выполняется в отдельном потоке на своём соединении.
+    """
+
+    def __init__(self, path, source=None, readers=2, mmap_size=256 * 2 ** 20):
+        self.source = source
+        self._mmap_size = mmap_size
+        self._refresh_conn = None
+        super().__init__(path, readers=readers)
+
+    def _prepare(self, conn):
+        conn.executescript(REPLICA_SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = super()._connection()
+            conn.execute(f"PRAGMA mmap_size={self._mmap_size}")
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def _refresh(self):
+        if self._refresh_conn is None:
+            self._refresh_conn = self._connect()
+            # Копию всегда можно собрать заново, fsync на каждое обновление не нужен
+            self._refresh_conn.execute("PRAGMA synchronous=NORMAL")
+            with self._lock:
+                self._connections.append(self._refresh_conn)
+        return refresh(self._refresh_conn, self.source)
+
+    async def refresh(self):
+        """Обновляет копию по базе source; возвращает число перенесённых записей."""
+        return await self._run(self._write_executor, self._refresh)
+
+    async def snapshot_ts(self):
+        """Время (time.time()) снимка основной базы, по которому собрана копия."""
+        row = await self.fetchone("SELECT snapshot_ts FROM replica_state")
+        return row[0]
@@ -0,0 +1,61 @@
+"""Выгрузка в .npz и загрузка обратно: записи, заметки, пояса и сводка по дням."""
+import sqlite3
+
+import pytest
+
+from archive import export_data, import_data
+from database import SCHEMA, check_rollup, migrate
+from records import save_note, set_timezone, stop_timer
+from timezones import DEFAULT_TZ
+
+START = 1709240400  # 2024-03-01 00:00 МСК
+
+
+def open_db(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    migrate(conn)
+    return conn
+
+
+def dump(conn):
+    return {'data': conn.execute("SELECT timer_id, user_id, date, mode, start, finish, time,"
+                                 " coalesce(note, ''), start_ts, finish_ts"
+                                 " FROM data ORDER BY timer_id").fetchall(),
+            'user_settings': conn.execute("SELECT user_id, tz FROM user_settings ORDER BY user_id").fetchall(),
+            'daily_totals': conn.execute("SELECT user_id, day, mode, seconds FROM daily_totals"
+                                         " ORDER BY user_id, day, mode").fetchall()}
+
+
+def test_round_trip_keeps_records_notes_and_rollup(tmp_path):
+    source = open_db(tmp_path / 'source.db')
+    zones = {1: DEFAULT_TZ, 2: 'America/New_York', 3: 'Asia/Tokyo'}
+    for user_id, tz in zones.items():
+        if tz != DEFAULT_TZ:
+            set_timezone(source, user_id, tz)
+        for number in range(30):
+            # Таймеры через местную полночь и переход на летнее время в Нью-Йорке 10 марта
+            start = START + number * 20 * 3600 + user_id * 600
+            timer_id, _ = stop_timer(source, user_id, start, ('work', 'sport', 'rest')[number % 3],
+                                     start + 5 * 3600, tz)
+            if number % 4:
+                save_note(source, user_id, timer_id, f'заметка {number} ✓\nвторая строка', tz)
+    target_path = tmp_path / 'target.db'
+    assert export_data(source, tmp_path / 'backup.npz', chunk_size=7) == 90
+
+    target = open_db(target_path)
+    assert import_data(target, tmp_path / 'backup.npz', chunk_size=7) == 90
+    assert dump(target) == dump(source)
+    assert check_rollup(target) == []
+    source.close()
+    target.close()
+
+
+def test_records_without_timestamps_are_reported(tmp_path):
+    conn = open_db(tmp_path / 'bot.db')
+    stop_timer(conn, 1, START, 'work', START + 3600, DEFAULT_TZ)
+    conn.execute("INSERT INTO data (user_id, date, mode, start, finish, time) VALUES"
+                 " (1, '2024-03-01', 'work', NULL, NULL, 0)")
+    with pytest.raises(ValueError, match='2'):
+        export_data(conn, tmp_path / 'backup.npz')
+    conn.close()
@@ -0,0 +1,49 @@
+"""StatCache: срок жизни записей, версии данных пользователя и размер LRU."""
+import cache
+from cache import StatCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    stats = StatCache(ttl=300)
+    stats.put(('user', 1), 'текст', b'png')
+    clock.now += 300
+    assert stats.get(('user', 1)).text == 'текст'
+    clock.now += 1
+    assert stats.peek(('user', 1)) is None
+    assert stats.get(('user', 1)) is None
+    assert stats.metrics()['size'] == 0
+    assert (stats.hits, stats.misses) == (1, 1)
+
+
+def test_bump_moves_user_to_a_new_key():
+    stats = StatCache()
+    key = ('user', 1, 'За неделю', stats.version(1))
+    stats.put(key, 'старое', b'png')
+    other = ('user', 2, 'За неделю', stats.version(2))
+    stats.put(other, 'чужое', b'png')
+    stats.bump(1)
+    assert stats.version(1) == 1
+    assert stats.get(('user', 1, 'За неделю', stats.version(1))) is None
+    # Данные второго пользователя не менялись — его запись по-прежнему в кеше
+    assert stats.get(('user', 2, 'За неделю', stats.version(2))).text == 'чужое'
+    assert stats.recently_active(60) == [1]
+
+
+def test_least_recently_used_entry_is_evicted():
+    stats = StatCache(maxsize=2)
+    stats.put('a', 'a', b'')
+    stats.put('b', 'b', b'')
+    stats.get('a')
+    stats.put('c', 'c', b'')
+    assert stats.peek('b') is None
+    assert stats.peek('a') is not None and stats.peek('c') is not None
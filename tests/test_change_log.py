@@ -0,0 +1,87 @@
+"""Журнал изменений для копий статистики: пишется только для зарегистрированных копий."""
+import sqlite3
+
+import replica
+from database import SCHEMA, expire_change_log_readers, migrate, rebuild_rollup
+from records import stop_timer
+from timezones import DEFAULT_TZ, now_ts
+
+
+def open_source(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    migrate(conn)
+    return conn
+
+
+def add_timers(conn, user_id, count):
+    now = now_ts()
+    for number in range(count):
+        start = now - (2 * number + 2) * 3600
+        stop_timer(conn, user_id, start, 'work', start + 3600, DEFAULT_TZ)
+
+
+def replica_rows(copy):
+    return copy.execute("SELECT timer_id, user_id, mode, start_ts, finish_ts FROM data"
+                        " ORDER BY timer_id").fetchall()
+
+
+def source_rows(conn):
+    return conn.execute("SELECT timer_id, user_id, mode, start_ts, finish_ts FROM data"
+                        " ORDER BY timer_id").fetchall()
+
+
+def test_log_is_written_only_while_a_replica_reads_it(tmp_path):
+    source = str(tmp_path / 'bot.db')
+    conn = open_source(source)
+    add_timers(conn, 1, 5)
+    # Копий нет: правки и удаления журнал не пополняют
+    conn.execute("DELETE FROM data WHERE timer_id = 1")
+    conn.execute("UPDATE data SET mode = 'study' WHERE timer_id = 2")
+    assert conn.execute("SELECT count(*) FROM change_log").fetchone() == (0,)
+
+    copy = sqlite3.connect(str(tmp_path / 'copy.db'), isolation_level=None)
+    replica.refresh(copy, source)
+    assert replica_rows(copy) == source_rows(conn)
+
+    # Копия зарегистрирована: удаление попадает в журнал и переносится в неё
+    conn.execute("DELETE FROM data WHERE timer_id = 3")
+    assert conn.execute("SELECT count(*) FROM change_log").fetchone() == (1,)
+    replica.refresh(copy, source)
+    assert replica_rows(copy) == source_rows(conn)
+    # Прочитанное единственной копией удалено
+    assert conn.execute("SELECT count(*) FROM change_log").fetchone() == (0,)
+
+    # Копия давно не обновлялась: забываем её, журнал больше не пишется
+    conn.execute("UPDATE change_log_readers SET seen_ts = 0")
+    assert expire_change_log_readers(conn, 3600) == 1
+    conn.execute("DELETE FROM data WHERE timer_id = 4")
+    assert conn.execute("SELECT count(*) FROM change_log").fetchone() == (0,)
+    # Вернувшаяся копия собирается заново и не теряет удаление
+    replica.refresh(copy, source)
+    assert replica_rows(copy) == source_rows(conn)
+    copy.close()
+    conn.close()
+
+
+def test_rebuild_rollup_makes_replicas_copy_everything(tmp_path):
+    source = str(tmp_path / 'bot.db')
+    conn = open_source(source)
+    add_timers(conn, 1, 3)
+    copy = sqlite3.connect(str(tmp_path / 'copy.db'), isolation_level=None)
+    replica.refresh(copy, source)
+
+    # Правка мимо журнала, как при загрузке архива, и пересчёт сводки
+    conn.execute("DROP TRIGGER change_log_data_update")
+    conn.execute("UPDATE data SET finish_ts = finish_ts - 600")
+    conn.execute("BEGIN IMMEDIATE")
+    rebuild_rollup(conn)
+    conn.execute("COMMIT")
+    assert conn.execute("SELECT count(*) FROM change_log_readers").fetchone() == (0,)
+
+    replica.refresh(copy, source)
+    assert replica_rows(copy) == source_rows(conn)
+    assert (copy.execute("SELECT * FROM daily_totals ORDER BY day, mode").fetchall()
+            == conn.execute("SELECT * FROM daily_totals ORDER BY day, mode").fetchall())
+    copy.close()
+    conn.close()
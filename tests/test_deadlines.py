@@ -0,0 +1,62 @@
+"""Куча сроков TimerRegistry: устаревшие сроки, напоминания и автоостановка."""
+import time
+
+from timers import REMIND, STOP, TimerRegistry
+
+HOUR = 3600
+
+
+def kinds(due):
+    return [(kind, user_id, timer.start) for kind, user_id, timer in due]
+
+
+def test_stale_deadlines_are_skipped():
+    registry = TimerRegistry(None)
+    first = int(time.time())
+    registry.start(1, first, 'work', remind_after=HOUR)
+    registry.stop(1)
+    # Тот же пользователь запустил новый таймер: сроки старого в куче, но не в силе
+    second = first + 600
+    registry.start(1, second, 'sport', remind_after=HOUR)
+    assert registry.next_deadline() == second + HOUR
+    assert registry.pop_due(first + HOUR) == []
+    assert kinds(registry.pop_due(second + HOUR)) == [(REMIND, 1, second)]
+
+    # Новые настройки: прежнее напоминание через 2 часа и остановка через сутки отбрасываются
+    registry.set_limits(1, remind_after=0, cap=3 * HOUR)
+    assert registry.next_deadline() == second + 3 * HOUR
+    assert registry.pop_due(second + 2 * HOUR) == []
+    assert kinds(registry.pop_due(second + 3 * HOUR)) == [(STOP, 1, second)]
+
+
+def test_reminders_then_cap():
+    registry = TimerRegistry(None)
+    start = int(time.time())
+    registry.start(1, start, 'work', remind_after=HOUR, cap=int(2.5 * HOUR))
+    registry.start(2, start, 'work', remind_after=HOUR, cap=int(2.5 * HOUR))
+    assert kinds(registry.pop_due(start + HOUR)) == [(REMIND, 1, start), (REMIND, 2, start)]
+    assert kinds(registry.pop_due(start + 2 * HOUR)) == [(REMIND, 1, start), (REMIND, 2, start)]
+    # Третьего напоминания нет: раньше наступает автоостановка
+    assert registry.next_deadline() == start + int(2.5 * HOUR)
+    assert kinds(registry.pop_due(start + int(2.5 * HOUR))) == [(STOP, 1, start), (STOP, 2, start)]
+    assert registry.next_deadline() is None
+
+
+def test_late_wakeup_skips_reminders_of_a_capped_timer():
+    registry = TimerRegistry(None)
+    start = int(time.time())
+    registry.start(1, start, 'work', remind_after=HOUR, cap=int(1.5 * HOUR))
+    # Бот проснулся после автоостановки: только остановка, без напоминания
+    assert kinds(registry.pop_due(start + 2 * HOUR)) == [(STOP, 1, start)]
+
+
+def test_stale_entries_do_not_pile_up():
+    registry = TimerRegistry(None)
+    start = int(time.time())
+    for number in range(5000):
+        registry.start(1, start + number, 'work', remind_after=HOUR)
+        registry.stop(1)
+    registry.start(2, start, 'work', remind_after=HOUR)
+    registry.pop_due(start)
+    assert len(registry._deadlines) == 2
+    assert registry.next_deadline() == start + HOUR
@@ -0,0 +1,89 @@
+"""Пакетная правка записей: разбор сообщения и CSV, применение к базе."""
+import sqlite3
+from datetime import date, time
+
+from database import SCHEMA, check_rollup, migrate
+from edits import Edit, parse_csv, parse_lines
+from records import modify_records, stop_timer
+from timezones import DEFAULT_TZ
+
+MODES = {'work', 'sport', 'rest'}
+START = 1709280000  # 2024-03-01 11:00 МСК
+
+
+def test_parse_lines_collects_errors_with_line_numbers():
+    edits, errors = parse_lines("1 10:00 11:30 заметка с пробелами\n"
+                                "\n"
+                                "2 10:00\n"
+                                "x 10:00 11:00\n"
+                                "3 2024-13-01 10:00 11:00\n"
+                                "4 25:00 11:00\n"
+                                "1 12:00 13:00\n"
+                                "5 /delete\n"
+                                "6 2024-03-02 23:00 01:00")
+    assert edits == [Edit(1, time(10), time(11, 30), note='заметка с пробелами'),
+                     Edit(5, None, None),
+                     Edit(6, time(23), time(1), date(2024, 3, 2))]
+    assert [error.split(':')[0] for error in errors] == ['строка 3', 'строка 4', 'строка 5',
+                                                         'строка 6', 'строка 7']
+    assert 'уже встречался' in errors[-1]
+
+
+def test_parse_lines_without_edits():
+    assert parse_lines("\n  \n") == ([], ["нет ни одной правки"])
+
+
+def test_parse_csv():
+    text = ("timer_id,date,mode,start,finish,time,note\n"
+            "1,,,10:00:00,11:00:00,3600,\n"
+            "2,2024-03-01,sport,09:00,10:00,0,бег\n"
+            "3,,chess,09:00,10:00,0,\n"
+            "4,,,,,,/delete\n"
+            "5,,,10:00,,0,\n")
+    edits, errors = parse_csv(text, MODES)
+    assert edits == [Edit(1, time(10), time(11)),
+                     Edit(2, time(9), time(10), date(2024, 3, 1), 'sport', 'бег'),
+                     Edit(4, None, None)]
+    assert errors == ["строка 4: неизвестная категория 'chess'",
+                      "строка 6: неверное время '', нужно ЧЧ:ММ:СС"]
+    assert parse_csv("id,start\n1,10:00\n", MODES) == ([], ["нет заголовка с колонкой timer_id"])
+
+
+def open_db(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    migrate(conn)
+    return conn
+
+
+def test_other_users_timer_changes_nothing(tmp_path):
+    conn = open_db(tmp_path / 'bot.db')
+    own, _ = stop_timer(conn, 1, START, 'work', START + 3600, DEFAULT_TZ)
+    other, _ = stop_timer(conn, 2, START, 'work', START + 3600, DEFAULT_TZ)
+    before = conn.execute("SELECT * FROM data ORDER BY timer_id").fetchall()
+    edits = [Edit(own, time(9), time(10)), Edit(other, None, None)]
+    assert modify_records(conn, 1, edits, DEFAULT_TZ) == (0, 0, [other])
+    assert conn.execute("SELECT * FROM data ORDER BY timer_id").fetchall() == before
+    conn.close()
+
+
+def test_batch_edit_updates_records_and_rollup(tmp_path):
+    conn = open_db(tmp_path / 'bot.db')
+    ids = [stop_timer(conn, 1, START + number * 7200, 'work', START + number * 7200 + 3600,
+                      DEFAULT_TZ)[0] for number in range(3)]
+    edits, errors = parse_lines(f"{ids[0]} 09:00 09:30 короче\n"
+                                # Финиш раньше старта: таймер начался накануне
+                                f"{ids[1]} 23:00 01:00\n"
+                                f"{ids[2]} /delete")
+    assert errors == []
+    assert modify_records(conn, 1, edits, DEFAULT_TZ) == (2, 1, [])
+
+    rows = conn.execute("SELECT timer_id, date, start, finish, time, note FROM data"
+                        " ORDER BY timer_id").fetchall()
+    assert rows == [(ids[0], '2024-03-01', '09:00:00', '09:30:00', 1800, 'короче'),
+                    (ids[1], '2024-03-01', '23:00:00', '01:00:00', 7200, '')]
+    assert check_rollup(conn) == []
+    assert conn.execute("SELECT day, mode, seconds FROM daily_totals WHERE user_id = 1"
+                        " ORDER BY day").fetchall() == [('2024-02-29', 'work', 3600),
+                                                        ('2024-03-01', 'work', 1800 + 3600)]
+    conn.close()
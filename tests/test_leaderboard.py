@@ -0,0 +1,85 @@
+"""Рейтинг чата: участники из других воркеров и периоды по поясу каждого участника."""
+import asyncio
+import sqlite3
+
+import pytest
+
+from charts import format_time
+from database import SCHEMA, Database, migrate
+from members import ChatMembers
+from records import set_timezone, stop_timer
+from timezones import DEFAULT_TZ, get_zone, now_ts
+
+CHAT_ID = -100
+# Пояса с разницей в 25 часов: в любой момент сегодняшний день одного из
+# участников не совпадает с сегодняшним днём по DEFAULT_TZ
+ZONES = {1: 'Pacific/Kiritimati', 2: 'Pacific/Pago_Pago', 3: DEFAULT_TZ}
+
+
+class Charts:
+    async def render(self, *args):
+        return b''
+
+
+@pytest.fixture
+def main_module(tmp_path, monkeypatch):
+    path = tmp_path / 'bot.db'
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    migrate(conn)
+    now = now_ts()
+    for user_id, tz in ZONES.items():
+        set_timezone(conn, user_id, tz)
+        conn.execute("INSERT INTO chat_members (chat_id, user_id, name) VALUES (?, ?, ?)",
+                     (CHAT_ID, user_id, f'user{user_id}'))
+        # user_id часов во вчерашнем местном дне участника и user_id минут в сегодняшнем
+        zone = get_zone(tz)
+        today = zone.day_number(now)
+        start = zone.day_start(today - 1) + 60
+        stop_timer(conn, user_id, start, 'work', start + user_id * 3600, tz)
+        start = zone.day_start(today)
+        stop_timer(conn, user_id, start, 'work', start + user_id * 60, tz)
+    conn.close()
+    monkeypatch.setenv('DB_URL', str(path))
+    import main
+    main.build_application('1:test')
+    monkeypatch.setattr(main, 'chart_renderer', Charts())
+    yield main
+    asyncio.run(main.database.close())
+
+
+def test_period_starts_in_each_members_zone(main_module):
+    async def run(period):
+        members = {user_id: f'user{user_id}' for user_id in ZONES}
+        return await main_module.build_leaderboard(CHAT_ID, members, period)
+
+    text, _ = asyncio.run(run('За день'))
+    assert text.splitlines()[1:] == [f"{place}. user{user_id} — {format_time(user_id * 60)}"
+                                     for place, user_id in enumerate((3, 2, 1), 1)]
+    text, _ = asyncio.run(run('За неделю'))
+    assert text.splitlines()[1:] == [f"{place}. user{user_id} — {format_time(user_id * 3660)}"
+                                     for place, user_id in enumerate((3, 2, 1), 1)]
+
+
+def test_members_from_other_workers_appear_after_ttl(tmp_path):
+    async def run():
+        database = Database(str(tmp_path / 'bot.db'))
+        try:
+            # Два воркера: каждый видит свои апдейты, общая у них только БД
+            first = ChatMembers(database, ttl=0.05)
+            second = ChatMembers(database, ttl=0.05)
+            assert await second.get(CHAT_ID) == {}
+            await first.seen(CHAT_ID, 1, 'Анна')
+            assert await second.get(CHAT_ID) == {}
+            version = second.version(CHAT_ID)
+            await asyncio.sleep(0.05)
+            assert await second.get(CHAT_ID) == {1: 'Анна'}
+            assert second.version(CHAT_ID) == version + 1
+            # Состав не изменился — версия та же
+            await asyncio.sleep(0.05)
+            assert await second.get(CHAT_ID) == {1: 'Анна'}
+            assert second.version(CHAT_ID) == version + 1
+        finally:
+            await database.close()
+
+    asyncio.run(run())
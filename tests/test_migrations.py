@@ -0,0 +1,37 @@
+"""Перенос записей старого бота: даты, метки времени и сводка по дням."""
+import sqlite3
+from datetime import datetime, timezone
+
+from database import SCHEMA, check_rollup, migrate
+
+
+def ts(text):
+    return int(datetime.fromisoformat(text).replace(tzinfo=timezone.utc).timestamp())
+
+
+def test_legacy_rows_get_finish_day_and_timestamps(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'bot.db', isolation_level=None)
+    conn.executescript(SCHEMA)
+    # Как писал старый бот: start/finish по МСК, date — дата сервера по UTC
+    conn.executemany("INSERT INTO data VALUES (?, 1, ?, 'work', ?, ?, ?, '')", [
+        (1, '2024-03-01', '10:00:00', '12:00:00', 7200),
+        # Через полночь МСК, финиш 01:15 МСК 2 марта = 22:15 UTC 1 марта
+        (2, '2024-03-01', '23:30:00', '01:15:00', 6300),
+        # Целиком после полуночи МСК, но до полуночи UTC
+        (3, '2024-03-01', '01:00:00', '02:30:00', 5400),
+        # Через полночь МСК, финиш после 03:00 МСК — дата сервера уже 2 марта
+        (4, '2024-03-02', '23:00:00', '04:00:00', 18000),
+    ])
+    migrate(conn)
+
+    rows = conn.execute("SELECT timer_id, date, start_ts, finish_ts FROM data ORDER BY timer_id").fetchall()
+    assert rows == [
+        (1, '2024-03-01', ts('2024-03-01 07:00'), ts('2024-03-01 09:00')),
+        (2, '2024-03-02', ts('2024-03-01 20:30'), ts('2024-03-01 22:15')),
+        (3, '2024-03-02', ts('2024-03-01 22:00'), ts('2024-03-01 23:30')),
+        (4, '2024-03-02', ts('2024-03-01 20:00'), ts('2024-03-02 01:00')),
+    ]
+    assert check_rollup(conn) == []
+    totals = dict(conn.execute("SELECT day, seconds FROM daily_totals WHERE user_id = 1"))
+    assert totals == {'2024-03-01': 7200 + 1800 + 3600, '2024-03-02': 4500 + 5400 + 14400}
+    conn.close()
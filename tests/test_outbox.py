@@ -0,0 +1,98 @@
+"""Outbox против локального Bot API по HTTP с лимитами Telegram."""
+import asyncio
+
+from benchmark import FakeBotApi
+from outbox import MESSAGE_LIMIT, Outbox
+
+
+def run_with_outbox(scenario, server_options=None, **outbox_options):
+    """Поднимает FakeBotApi и Outbox поверх него, выполняет scenario(outbox) и возвращает сервер."""
+    server = FakeBotApi(**(server_options or {}))
+
+    async def run():
+        await server.start()
+        bot = server.bot()
+        await bot.initialize()
+        outbox = Outbox(**outbox_options)
+        outbox.start(bot)
+        try:
+            await scenario(outbox)
+        finally:
+            await outbox.close()
+            await bot.shutdown()
+            await server.close()
+
+    asyncio.run(run())
+    return server
+
+
+def test_higher_priority_goes_first():
+    async def scenario(outbox):
+        # Всё ставится в очередь до первой отправки; одна отправка за раз
+        futures = [outbox.send_message(chat_id, 'выгрузка', priority=Outbox.BULK) for chat_id in (1, 2, 3)]
+        futures.append(outbox.send_message(4, 'ответ', priority=Outbox.NORMAL))
+        futures.append(outbox.send_message(5, 'таймер запущен', priority=Outbox.HIGH))
+        await asyncio.gather(*futures)
+
+    server = run_with_outbox(scenario, max_in_flight=1)
+    assert [chat_id for _, chat_id, *_ in server.messages] == [5, 4, 1, 2, 3]
+
+
+def test_consecutive_texts_are_coalesced():
+    async def scenario(outbox):
+        first = outbox.send_message(1, 'раз')
+        second = outbox.send_message(1, 'два')
+        third = outbox.send_message(1, 'три')
+        # Картинка разрывает склейку: следующий текст уходит отдельно
+        photo = outbox.send_photo(1, photo=b'png')
+        fourth = outbox.send_message(1, 'четыре')
+        # Длинные тексты склеиваются, только пока укладываются в MESSAGE_LIMIT
+        long = [outbox.send_message(2, 'x' * (MESSAGE_LIMIT // 2 - 1)) for _ in range(3)]
+        messages = await asyncio.gather(first, second, third, photo, fourth, *long)
+        assert messages[0] is messages[1] is messages[2]
+        assert messages[5] is messages[6]
+        assert messages[7] is not messages[6]
+
+    server = run_with_outbox(scenario, chat_burst=10)
+    sent = [(chat_id, method, params.get('text')) for _, chat_id, method, params, _ in server.messages]
+    assert [(method, text) for chat_id, method, text in sent if chat_id == 1] == [
+        ('sendMessage', 'раз\nдва\nтри'), ('sendPhoto', None), ('sendMessage', 'четыре')]
+    assert [len(text) for chat_id, _, text in sent if chat_id == 2] == [MESSAGE_LIMIT - 1,
+                                                                         MESSAGE_LIMIT // 2 - 1]
+
+
+def test_one_request_in_flight_per_chat():
+    async def scenario(outbox):
+        await asyncio.gather(*(outbox.send_photo(chat_id, photo=f'{chat_id}-{number}'.encode())
+                               for number in range(5) for chat_id in (1, 2)))
+
+    # Медленный Bot API: следующая отправка в чат не уходит, пока не ответили на прошлую
+    server = run_with_outbox(scenario, server_options={'latency': 0.05, 'chat_burst': 10},
+                             chat_rate=100, chat_burst=100)
+    assert server.max_in_flight == 1
+    for chat_id in (1, 2):
+        files = [list(files.values())[0] for _, chat, _, _, files in server.messages if chat == chat_id]
+        assert files == [f'{chat_id}-{number}'.encode() for number in range(5)]
+    # Разные чаты при этом отправляются параллельно
+    assert server.messages[-1][0] - server.messages[0][0] < 5 * 0.05 * 2
+
+
+def test_retry_after_pauses_the_chat_and_requeues():
+    async def scenario(outbox):
+        # Outbox считает лимит чата щедрее, чем Bot API, и получает 429
+        first = [outbox.send_photo(1, photo=f'1-{number}'.encode()) for number in range(3)]
+        await asyncio.sleep(0.2)
+        other = await outbox.send_photo(2, photo=b'2-0')
+        await asyncio.gather(*first)
+        assert other.chat.id == 2
+
+    server = run_with_outbox(scenario, server_options={'chat_rate': 1, 'chat_burst': 1},
+                             chat_rate=100, chat_burst=100)
+    assert server.rejected >= 1
+    sent = [(chat_id, list(files.values())[0]) for _, chat_id, _, _, files in server.messages]
+    # Все сообщения чата доставлены по порядку, несмотря на повторы
+    assert [content for chat_id, content in sent if chat_id == 1] == [b'1-0', b'1-1', b'1-2']
+    # Пауза касается только чата с 429: второй чат её не ждёт
+    assert sent.index((2, b'2-0')) < sent.index((1, b'1-1'))
+    times = [moment for moment, chat_id, *_ in server.messages if chat_id == 1]
+    assert times[1] - times[0] >= 0.9
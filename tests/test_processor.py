@@ -0,0 +1,39 @@
+"""UserOrderedProcessor: порядок внутри диалога и общий лимит апдейтов."""
+import asyncio
+from types import SimpleNamespace
+
+from processor import UserOrderedProcessor
+
+
+def update(user_id):
+    user = SimpleNamespace(id=user_id)
+    return SimpleNamespace(effective_chat=user, effective_user=user)
+
+
+def test_waiting_updates_do_not_hold_global_slots():
+    async def run():
+        processor = UserOrderedProcessor(2)
+        release = asyncio.Event()
+        handled = []
+
+        async def handle(name, wait=False):
+            if wait:
+                await release.wait()
+            handled.append(name)
+
+        # Первый апдейт пользователя 1 завис, за ним в очереди ещё два
+        tasks = [asyncio.create_task(processor.process_update(update(1), handle('1-0', wait=True)))]
+        tasks += [asyncio.create_task(processor.process_update(update(1), handle(f'1-{number}')))
+                  for number in (1, 2)]
+        await asyncio.sleep(0)
+        assert processor.current_concurrent_updates == 1
+        # Второй слот свободен для другого пользователя
+        await asyncio.wait_for(processor.process_update(update(2), handle('2-0')), 1)
+        assert handled == ['2-0']
+        release.set()
+        await asyncio.gather(*tasks)
+        assert handled == ['2-0', '1-0', '1-1', '1-2']
+        assert processor.current_concurrent_updates == 0
+        assert not processor._locks
+
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+"""Команды check-rollup и rebuild-rollup: поиск расхождений daily_totals и пересчёт."""
+import sqlite3
+
+import database
+from database import SCHEMA, migrate
+from records import set_timezone, stop_timer
+from timezones import DEFAULT_TZ
+
+START = 1709280000  # 2024-03-01 11:00 МСК
+
+
+def test_check_finds_mismatches_and_rebuild_fixes_them(tmp_path, capsys):
+    path = str(tmp_path / 'bot.db')
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    migrate(conn)
+    for user_id in (1, 2):
+        for number in range(5):
+            start = START + number * 86400
+            stop_timer(conn, user_id, start, 'work', start + 3600, DEFAULT_TZ)
+    set_timezone(conn, 2, 'Asia/Tokyo')
+    expected = conn.execute("SELECT * FROM daily_totals ORDER BY 1, 2, 3").fetchall()
+    assert database.main(['database.py', 'check-rollup', path]) == 0
+    assert 'Расхождений: 0' in capsys.readouterr().out
+
+    # Сводка разошлась с data: лишние секунды, пропавший день и чужая строка
+    conn.execute("UPDATE daily_totals SET seconds = seconds + 60 WHERE user_id = 1 AND day = '2024-03-01'")
+    conn.execute("DELETE FROM daily_totals WHERE user_id = 2 AND day = '2024-03-02'")
+    conn.execute("INSERT INTO daily_totals VALUES (3, '2024-03-01', 'sport', 600)")
+    assert database.main(['database.py', 'check-rollup', path]) == 1
+    out = capsys.readouterr().out
+    assert 'Расхождений: 4' in out
+    assert 'missing: user_id=1 day=2024-03-01 mode=work seconds=3600' in out
+    assert 'unexpected: user_id=1 day=2024-03-01 mode=work seconds=3660' in out
+    assert 'missing: user_id=2 day=2024-03-02 mode=work seconds=3600' in out
+    assert 'unexpected: user_id=3 day=2024-03-01 mode=sport seconds=600' in out
+
+    assert database.main(['database.py', 'rebuild-rollup', path]) == 0
+    assert conn.execute("SELECT * FROM daily_totals ORDER BY 1, 2, 3").fetchall() == expected
+    assert database.main(['database.py', 'check-rollup', path]) == 0
+    conn.close()
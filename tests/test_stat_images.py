@@ -0,0 +1,93 @@
+"""Одновременные запросы статистики: каждый пользователь получает свою картинку."""
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from benchmark import FakeBotApi
+from charts import format_time
+from database import SCHEMA, migrate
+from records import stop_timer
+from timezones import DEFAULT_TZ, now_ts
+
+USERS = 12
+
+
+def stat_update(user_id, text):
+    async def reply_text(*args, **kwargs):
+        pass
+
+    message = SimpleNamespace(from_user=SimpleNamespace(id=user_id), text=text,
+                              reply_text=reply_text)
+    return SimpleNamespace(message=message, effective_chat=SimpleNamespace(id=user_id))
+
+
+@pytest.fixture(scope='module')
+def main_module(tmp_path_factory):
+    # main настраивается окружением при сборке приложения
+    path = tmp_path_factory.mktemp('stat') / 'bot.db'
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    migrate(conn)
+    now = now_ts()
+    for user_id in range(1, USERS + 1):
+        # У пользователя user_id ровно user_id часов работы за неделю
+        for number in range(user_id):
+            start = now - (2 * number + 2) * 3600
+            stop_timer(conn, user_id, start, 'work', start + 3600, DEFAULT_TZ)
+    conn.close()
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('DB_URL', str(path))
+        patch.setenv('CHART_QUEUE', str(USERS))
+        patch.setenv('OUTBOX_GLOBAL_RATE', '1000000')
+        patch.setenv('OUTBOX_CHAT_RATE', '1000000')
+        import main
+        main.build_application('1:test')
+        yield main
+        main.chart_renderer.close()
+        asyncio.run(main.database.close())
+
+
+async def ask_stat(main_module, bot, user_id):
+    context = SimpleNamespace(bot=bot, user_data={'category': 'Работа'})
+    await main_module.stat(stat_update(user_id, 'За неделю'), context)
+
+
+def test_concurrent_stats_reach_their_users(main_module):
+    # Задержка Bot API: пока одна картинка загружается, успевают дорисоваться другие
+    server = FakeBotApi(global_rate=1000000, chat_rate=1000000, chat_burst=1000000, latency=0.05)
+
+    async def run():
+        await server.start()
+        bot = server.bot()
+        await bot.initialize()
+        main_module.outbox.start(bot)
+        try:
+            await asyncio.gather(*(ask_stat(main_module, bot, user_id)
+                                   for user_id in range(1, USERS + 1)))
+            # Эталон: график каждого пользователя, построенный отдельно от остальных
+            return {user_id: (await main_module.build_stat(user_id, 'Работа', 'За неделю'))[1]
+                    for user_id in range(1, USERS + 1)}
+        finally:
+            await main_module.outbox.close()
+            await bot.shutdown()
+            await server.close()
+
+    expected = asyncio.run(run())
+
+    photos = {}
+    texts = {}
+    for _, chat_id, method, params, files in server.messages:
+        if method == 'sendPhoto':
+            assert chat_id not in photos, f"пользователь {chat_id} получил две картинки"
+            photos[chat_id] = files
+        elif method == 'sendMessage':
+            texts.setdefault(chat_id, []).append(params['text'])
+
+    assert sorted(photos) == list(range(1, USERS + 1))
+    for user_id, files in photos.items():
+        assert list(files) == [f'stat_{user_id}.png']
+        assert files[f'stat_{user_id}.png'] == expected[user_id]
+        assert any(f"потратили: {format_time(user_id * 3600)}" in text for text in texts[user_id])
+    assert len(set(expected.values())) == USERS
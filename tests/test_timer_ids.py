@@ -0,0 +1,40 @@
+"""Одновременные остановки таймеров: номера выдаёт SQLite, без повторов и потерь."""
+import asyncio
+import sqlite3
+
+from database import Database, check_rollup
+from records import stop_timer
+from timezones import DEFAULT_TZ, now_ts
+
+STOPS = 2000
+USERS = 50
+
+
+def test_concurrent_stops_get_unique_timer_ids(tmp_path):
+    path = str(tmp_path / 'bot.db')
+    now = now_ts()
+
+    async def run():
+        # Две базы на один файл — как два процесса бота со своими пишущими соединениями
+        databases = [Database(path), Database(path)]
+        try:
+            results = await asyncio.gather(*(
+                databases[number % 2].transaction(stop_timer, number % USERS, now - 3600 - number,
+                                                  'work', now - number, DEFAULT_TZ)
+                for number in range(STOPS)))
+        finally:
+            for database in databases:
+                await database.close()
+        return [timer_id for timer_id, _ in results]
+
+    timer_ids = asyncio.run(run())
+
+    assert len(set(timer_ids)) == STOPS
+    conn = sqlite3.connect(path)
+    try:
+        assert conn.execute("SELECT count(*) FROM data").fetchone() == (STOPS,)
+        assert sorted(timer_ids) == [timer_id for timer_id, in
+                                     conn.execute("SELECT timer_id FROM data ORDER BY timer_id")]
+        assert check_rollup(conn) == []
+    finally:
+        conn.close()
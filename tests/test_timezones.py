@@ -0,0 +1,71 @@
+"""Zone: деление интервалов по местным дням вокруг переходов на летнее время."""
+import random
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from timezones import get_zone
+
+
+def local_ts(name, *args):
+    return int(datetime(*args, tzinfo=ZoneInfo(name)).timestamp())
+
+
+def reference_split(name, start_ts, finish_ts):
+    # Поминутно через zoneinfo: медленно, но без общих с Zone вычислений
+    totals = {}
+    for ts in range(start_ts, finish_ts, 60):
+        day = datetime.fromtimestamp(ts, ZoneInfo(name)).date().isoformat()
+        totals[day] = totals.get(day, 0) + min(60, finish_ts - ts)
+    return list(totals.items())
+
+
+def test_days_around_dst_have_23_and_25_hours():
+    zone = get_zone('Europe/Berlin')
+    spring = local_ts('Europe/Berlin', 2024, 3, 31)
+    autumn = local_ts('Europe/Berlin', 2024, 10, 27)
+    assert zone.day_start(zone.day_number(spring)) == spring
+    assert zone.split_by_day(spring, local_ts('Europe/Berlin', 2024, 4, 1)) == [('2024-03-31', 23 * 3600)]
+    assert zone.split_by_day(autumn, local_ts('Europe/Berlin', 2024, 10, 28)) == [('2024-10-27', 25 * 3600)]
+    # Ночной таймер через переход: 22:00 субботы - 06:00 воскресенья — 7 часов весной, 9 осенью
+    assert zone.split_by_day(local_ts('Europe/Berlin', 2024, 3, 30, 22),
+                             local_ts('Europe/Berlin', 2024, 3, 31, 6)) == [('2024-03-30', 7200),
+                                                                           ('2024-03-31', 5 * 3600)]
+    assert zone.split_by_day(local_ts('Europe/Berlin', 2024, 10, 26, 22),
+                             local_ts('Europe/Berlin', 2024, 10, 27, 6)) == [('2024-10-26', 7200),
+                                                                            ('2024-10-27', 7 * 3600)]
+
+
+def test_day_without_midnight_starts_at_transition():
+    # В Сантьяго 8 сентября 2024 часы перевели с 00:00 сразу на 01:00
+    zone = get_zone('America/Santiago')
+    first = local_ts('America/Santiago', 2024, 9, 8, 1)
+    assert zone.day_start(zone.day_number(first)) == first
+    assert zone.split_by_day(first - 3600, first + 3600) == [('2024-09-07', 3600), ('2024-09-08', 3600)]
+
+
+def test_split_many_matches_split_by_day_and_zoneinfo():
+    rng = random.Random(20)
+    # Переходы в полночь (Сантьяго), получасовой сдвиг (Лорд-Хау) и обычный европейский
+    for name, moment in (('Europe/Berlin', datetime(2024, 3, 31)),
+                         ('America/Santiago', datetime(2024, 9, 8)),
+                         ('America/Santiago', datetime(2024, 4, 7)),
+                         ('Australia/Lord_Howe', datetime(2024, 4, 7))):
+        zone = get_zone(name)
+        around = int(moment.replace(tzinfo=ZoneInfo(name)).timestamp())
+        starts = [around + rng.randrange(-2 * 86400, 86400) // 60 * 60 for _ in range(40)]
+        finishes = [start + rng.choice((0, 600, 3 * 3600, 20 * 3600, 86400)) for start in starts]
+        parts = zone.split_many(starts, finishes)
+        for index, (start, finish) in enumerate(zip(starts, finishes)):
+            expected = reference_split(name, start, finish)
+            assert zone.split_by_day(start, finish) == expected
+            assert [(day, seconds) for number, day, seconds in parts if number == index] == expected
+
+
+def test_localize_and_to_timestamp_round_trip_over_dst():
+    zone = get_zone('America/New_York')
+    start = local_ts('America/New_York', 2024, 3, 10)
+    for ts in range(start, start + 86400, 900):
+        assert zone.to_timestamp(zone.localize(ts)) == ts or zone.localize(ts).hour == 1
+        assert zone.localize(ts) == datetime.fromtimestamp(ts, ZoneInfo('America/New_York')).replace(tzinfo=None)
+    # В день перехода 23 часа: через сутки после полуночи уже час ночи
+    assert zone.localize(start + 86400) - zone.localize(start) == timedelta(days=1, hours=1)
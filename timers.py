@@ -0,0 +1,260 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from timezones import DAY
+
+logger = logging.getLogger(__name__)
+
+# Виды сроков запущенного таймера
+REMIND = 'remind'
+STOP = 'stop'
+
+
+class ActiveTimer:
+    # start — UNIX-метка запуска; remind_after — период напоминаний в секундах
+    # (0 — без напоминаний); cap — через сколько секунд таймер останавливается
+    # и сохраняется, None — через сутки сбрасывается без сохранения
+    __slots__ = ('start', 'mode', 'remind_after', 'cap')
+
+    def __init__(self, start, mode, remind_after=0, cap=None):
+        self.start = start
+        self.mode = mode
+        self.remind_after = remind_after
+        self.cap = cap
+
+    @property
+    def stop_at(self):
+        return self.start + (self.cap or DAY)
+
+    def next_reminder(self, now):
+        """Ближайшее напоминание позже now или None."""
+        if not self.remind_after:
+            return None
+        when = self.start + self.remind_after * max(1, (int(now) - self.start) // self.remind_after + 1)
+        return when if when < self.stop_at else None
+
+    def expects(self, kind, when):
+        # Срок из кучи ещё в силе, если не менялись ни таймер, ни его настройки
+        if kind == STOP:
+            return when == self.stop_at
+        return (bool(self.remind_after) and when < self.stop_at
+                and (when - self.start) % self.remind_after == 0)
+
+
+def _write_changes(conn, changes):
+    conn.executemany("INSERT OR REPLACE INTO current_timers (user_id, start_ts, mode) VALUES (?, ?, ?)",
+                     [(user_id, timer.start, timer.mode)
+                      for user_id, timer in changes if timer is not None])
+    conn.executemany("DELETE FROM current_timers WHERE user_id = ?",
+                     [(user_id,) for user_id, timer in changes if timer is None])
+
+
+class DeadlineAlarm:
+    """Одна задача JobQueue на ближайший срок из кучи TimerRegistry.
+
+    Задача переставляется, только когда появился срок раньше поставленного;
+    сработав, она передаёт наступившие сроки в callback и ставит себя на
+    следующий.
+    """
+
+    def __init__(self, registry, callback):
+        self._registry = registry
+        self._callback = callback
+        self._job = None
+        self._when = None
+
+    def arm(self, job_queue, min_delay=0.0):
+        if job_queue is None:
+            return
+        when = self._registry.next_deadline()
+        if when is None or (self._job is not None and self._when <= when):
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+        self._when = when
+        self._job = job_queue.run_once(self._run, when=max(min_delay, when - time.time()),
+                                       name='timer_deadlines')
+
+    async def _run(self, context):
+        self._job = self._when = None
+        min_delay = 0.0
+        try:
+            await self._callback(self._registry.pop_due(time.time()))
+        except Exception:
+            # Например, БД недоступна: вернувшиеся в кучу сроки повторим не сразу
+            logger.exception("Не удалось обработать сроки таймеров")
+            min_delay = 60.0
+        finally:
+            self.arm(context.job_queue, min_delay)
+
+
+class TimerRegistry:
+    """Запущенные таймеры в памяти процесса, по одному на пользователя.
+
+    Источник истины для запуска и остановки таймера — словарь в памяти.
+    Таблица current_timers догоняет его пачками: изменения копятся и
+    записываются одной транзакцией раз в flush_interval секунд и при
+    остановке бота. При старте словарь восстанавливается из таблицы.
+
+    Сроки напоминаний и автоостановки лежат в куче (when, user_id, start,
+    вид): запуск таймера — O(log n), ближайший срок — вершина кучи, поэтому
+    искать забытые таймеры перебором не нужно. Остановленные таймеры из
+    кучи не удаляются: их сроки отбрасываются при извлечении, а когда
+    таких набирается больше живых, куча собирается заново.
+    """
+
+    def __init__(self, database, flush_interval=1.0, remind_after=0):
+        self._database = database
+        self._flush_interval = flush_interval
+        # Период напоминаний для пользователей, которые его не задавали
+        self._remind_after = remind_after
+        self._timers = {}
+        self._deadlines = []
+        # user_id -> ActiveTimer для записи или None для удаления
+        self._pending = {}
+        self._task = None
+
+    async def load(self, shard=None):
+        """Восстанавливает таймеры из current_timers.
+
+        shard — пара (номер, число воркеров): воркер берёт только таймеры
+        пользователей, чьи апдейты приходят к нему.
+        """
+        # Таймеры вместе с настройками сроков одним запросом
+        if shard is None:
+            rows = await self._database.fetchall("SELECT c.user_id, c.start_ts, c.mode, s.remind_after, s.cap"
+                                                 " FROM current_timers c"
+                                                 " LEFT JOIN timer_settings s USING (user_id)")
+        else:
+            index, count = shard
+            rows = await self._database.fetchall("SELECT c.user_id, c.start_ts, c.mode, s.remind_after, s.cap"
+                                                 " FROM current_timers c"
+                                                 " LEFT JOIN timer_settings s USING (user_id)"
+                                                 " WHERE c.user_id % ? = ?", (count, index))
+        for user_id, start, mode, remind_after, cap in rows:
+            self._timers[user_id] = ActiveTimer(start, mode, self._default_remind(remind_after), cap)
+        self._rebuild_deadlines(time.time())
+        logger.info("Восстановлено запущенных таймеров: %d", len(self._timers))
+
+    def _default_remind(self, remind_after):
+        return self._remind_after if remind_after is None else remind_after
+
+    def _schedule(self, user_id, timer, now):
+        when = timer.next_reminder(now)
+        if when is not None:
+            heapq.heappush(self._deadlines, (when, user_id, timer.start, REMIND))
+        heapq.heappush(self._deadlines, (timer.stop_at, user_id, timer.start, STOP))
+
+    def _rebuild_deadlines(self, now):
+        # O(n) heapify вместо n вставок; заодно выбрасывает устаревшие сроки
+        self._deadlines = [(timer.stop_at, user_id, timer.start, STOP)
+                           for user_id, timer in self._timers.items()]
+        self._deadlines += [(when, user_id, timer.start, REMIND)
+                            for user_id, timer in self._timers.items()
+                            for when in (timer.next_reminder(now),) if when is not None]
+        heapq.heapify(self._deadlines)
+
+    def start(self, user_id, start, mode, remind_after=None, cap=None):
+        """Запускает таймер; если он уже идёт, оставляет старый и возвращает False.
+
+        remind_after None — период напоминаний по умолчанию.
+        """
+        if user_id in self._timers:
+            return False
+        timer = ActiveTimer(start, mode, self._default_remind(remind_after), cap)
+        self._timers[user_id] = timer
+        self._pending[user_id] = timer
+        self._schedule(user_id, timer, time.time())
+        return True
+
+    def set_limits(self, user_id, remind_after=None, cap=None):
+        """Новые настройки сроков для уже запущенного таймера пользователя."""
+        timer = self._timers.get(user_id)
+        if timer is None:
+            return
+        timer.remind_after = self._default_remind(remind_after)
+        timer.cap = cap
+        # Прежние сроки перестанут совпадать с настройками и отбросятся
+        self._schedule(user_id, timer, time.time())
+
+    def next_deadline(self):
+        """Ближайший действующий срок (UNIX-метка) или None."""
+        while self._deadlines:
+            when, user_id, start, kind = self._deadlines[0]
+            timer = self._timers.get(user_id)
+            if timer is not None and timer.start == start and timer.expects(kind, when):
+                return when
+            heapq.heappop(self._deadlines)
+        return None
+
+    def pop_due(self, now):
+        """Извлекает наступившие сроки: список (вид, user_id, ActiveTimer).
+
+        Следующее напоминание того же таймера сразу кладётся в кучу.
+        """
+        due = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            when, user_id, start, kind = heapq.heappop(self._deadlines)
+            timer = self._timers.get(user_id)
+            if timer is None or timer.start != start or not timer.expects(kind, when):
+                continue
+            if kind == REMIND:
+                if timer.stop_at <= now:
+                    # Таймер останавливается в этом же вызове, напоминать незачем
+                    continue
+                # Следующее — позже now: пропущенные напоминания не копятся
+                following = timer.next_reminder(now)
+                if following is not None:
+                    heapq.heappush(self._deadlines, (following, user_id, start, REMIND))
+            due.append((kind, user_id, timer))
+        # Живых сроков не больше двух на таймер: пересборка, когда устаревших
+        # больше, чем живых, стоит O(1) в пересчёте на операцию
+        if len(self._deadlines) > 4 * len(self._timers) + 1024:
+            self._rebuild_deadlines(now)
+        return due
+
+    def stop(self, user_id):
+        """Останавливает таймер и возвращает его, либо None, если таймера нет."""
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            self._pending[user_id] = None
+        return timer
+
+    def get(self, user_id):
+        return self._timers.get(user_id)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        changes, self._pending = list(self._pending.items()), {}
+        try:
+            await self._database.transaction(_write_changes, changes)
+        except Exception:
+            # Возвращаем изменения в очередь, если за это время их не перекрыли новые
+            for user_id, timer in changes:
+                self._pending.setdefault(user_id, timer)
+            raise
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Не удалось сохранить запущенные таймеры")
+
+    def start_flushing(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._flush_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,167 @@
+import bisect
+import functools
+import time
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+# Время в базе хранится UNIX-метками (UTC). Местное время пользователя
+# нужно только для границ дней и подписей, его даёт Zone по имени пояса
+# из user_settings.
+
+DEFAULT_TZ = 'Europe/Moscow'
+DAY = 86400
+
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# Переходы смещений ищутся на этом промежутке; за его пределами действует
+# ближайшее известное смещение
+_SCAN_FROM = 0
+_SCAN_TO = int(datetime(2100, 1, 1, tzinfo=timezone.utc).timestamp())
+# Шаг поиска переходов: два перехода в пределах недели не встречаются
+_SCAN_STEP = 7 * DAY
+
+
+def now_ts():
+    return int(time.time())
+
+
+@functools.lru_cache(maxsize=4096)
+def day_name(number):
+    """Номер дня от 1970-01-01 -> 'YYYY-MM-DD'."""
+    return date.fromordinal(number + _EPOCH_ORDINAL).isoformat()
+
+
+def day_number(name):
+    """'YYYY-MM-DD' -> номер дня от 1970-01-01."""
+    return date.fromisoformat(name).toordinal() - _EPOCH_ORDINAL
+
+
+def _offset_at(tzinfo, ts):
+    return int(datetime.fromtimestamp(ts, tzinfo).utcoffset().total_seconds())
+
+
+def _scan_transitions(tzinfo):
+    transitions, offsets = [], [_offset_at(tzinfo, _SCAN_FROM)]
+    previous = _SCAN_FROM
+    for ts in range(_SCAN_FROM + _SCAN_STEP, _SCAN_TO + _SCAN_STEP, _SCAN_STEP):
+        offset = _offset_at(tzinfo, ts)
+        if offset != offsets[-1]:
+            # Точный момент перехода — бинарным поиском внутри недели
+            low, high = previous, ts
+            while high - low > 1:
+                middle = (low + high) // 2
+                if _offset_at(tzinfo, middle) == offsets[-1]:
+                    low = middle
+                else:
+                    high = middle
+            transitions.append(high)
+            offsets.append(offset)
+        previous = ts
+    return tuple(transitions), tuple(offsets)
+
+
+def shift(ts, transitions, offsets):
+    """Векторно переводит массив UNIX-меток в секунды местного времени от эпохи."""
+    import numpy as np
+
+    ts = np.asarray(ts, dtype=np.int64)
+    return ts + np.asarray(offsets, dtype=np.int64)[np.searchsorted(transitions, ts, side='right')]
+
+
+class Zone:
+    """Часовой пояс с заранее найденными переходами смещения от UTC.
+
+    Смещение для метки — бисекция по кортежу переходов, без обращения к
+    ZoneInfo и без разбора строк. Для массивов меток есть векторные
+    day_numbers и split_many на numpy.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.tzinfo = ZoneInfo(name)
+        self.transitions, self.offsets = _scan_transitions(self.tzinfo)
+
+    def __repr__(self):
+        return f'Zone({self.name!r})'
+
+    def offset(self, ts):
+        return self.offsets[bisect.bisect_right(self.transitions, ts)]
+
+    def day_number(self, ts):
+        """Номер местного дня, в который попадает метка."""
+        return (ts + self.offset(ts)) // DAY
+
+    def local_day(self, ts):
+        return day_name(self.day_number(ts))
+
+    def day_start(self, number):
+        """UNIX-метка начала местного дня number — обычно его полночи.
+
+        Если полночь пропущена переходом на летнее время (так бывает в
+        Сантьяго), день начинается с момента перехода.
+        """
+        local = number * DAY
+        ts = local - self.offset(local - self.offset(local))
+        if self.day_number(ts) == number and self.day_number(ts - 1) < number:
+            return ts
+        # Полночь попала в переход: первую секунду дня ищем бинарным поиском,
+        # смещения не превышают суток
+        low, high = local - 2 * DAY, local + 2 * DAY
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self.day_number(middle) < number:
+                low = middle
+            else:
+                high = middle
+        return high
+
+    def localize(self, ts):
+        """Наивный datetime по местному времени."""
+        return _EPOCH + timedelta(seconds=ts + self.offset(ts))
+
+    def to_timestamp(self, local):
+        """UNIX-метка для наивного datetime по местному времени."""
+        return int(local.replace(tzinfo=self.tzinfo).timestamp())
+
+    def split_by_day(self, start_ts, finish_ts):
+        """Разбивает интервал на куски по местным дням; возвращает пары (день, секунды)."""
+        parts = []
+        while start_ts < finish_ts:
+            number = self.day_number(start_ts)
+            end = min(finish_ts, self.day_start(number + 1))
+            parts.append((day_name(number), end - start_ts))
+            start_ts = end
+        return parts
+
+    def day_numbers(self, ts):
+        """Векторный day_number для массива меток."""
+        return shift(ts, self.transitions, self.offsets) // DAY
+
+    def split_many(self, starts, finishes):
+        """split_by_day для многих интервалов сразу.
+
+        Возвращает тройки (номер интервала, день, секунды). Интервалы внутри
+        одного местного дня — почти все таймеры — раскладываются векторно,
+        поштучно делятся только переходящие через полночь.
+        """
+        import numpy as np
+
+        starts = np.asarray(starts, dtype=np.int64)
+        finishes = np.asarray(finishes, dtype=np.int64)
+        first = self.day_numbers(starts)
+        last = self.day_numbers(finishes - 1)
+        positive = finishes > starts
+        single = positive & (first == last)
+        parts = [(index, day_name(number), seconds) for index, number, seconds
+                 in zip(np.flatnonzero(single).tolist(), first[single].tolist(),
+                        (finishes - starts)[single].tolist())]
+        for index in np.flatnonzero(positive & ~single).tolist():
+            parts.extend((index, day, seconds)
+                         for day, seconds in self.split_by_day(int(starts[index]), int(finishes[index])))
+        return parts
+
+
+@functools.lru_cache(maxsize=None)
+def get_zone(name=DEFAULT_TZ):
+    """Zone по имени IANA; неизвестное имя — ZoneInfoNotFoundError или ValueError."""
+    return Zone(name)
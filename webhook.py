@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+from telegram import Bot, Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def route_key(data):
+    """user_id автора апдейта (в сыром JSON); по нему апдейт закрепляется за воркером."""
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user') or value.get('chat')
+            if isinstance(sender, dict) and 'id' in sender:
+                return sender['id']
+    return 0
+
+
+async def _serve_http(listen, port, url_path, secret_token, accept, status):
+    """Поднимает HTTP-сервер вебхука и ждёт SIGINT/SIGTERM.
+
+    accept(data) получает JSON апдейта, status() — словарь для /healthz.
+    Возвращает функцию закрытия сервера; к этому моменту он уже отвечает
+    503 на новые апдейты.
+    """
+    # aiohttp нужен только для режима вебхука
+    from aiohttp import web
+
+    draining = False
+
+    async def handle_update(request):
+        if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+            return web.Response(status=403)
+        if draining:
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await accept(data)
+        return web.Response()
+
+    async def health(request):
+        body = status()
+        healthy = not draining and body.pop('healthy', True)
+        body['status'] = 'ok' if healthy else 'draining' if draining else 'unhealthy'
+        return web.json_response(body, status=200 if healthy else 503)
+
+    app = web.Application()
+    app.router.add_post(url_path, handle_update)
+    app.router.add_get('/healthz', health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, listen, port).start()
+    logger.info("Вебхук слушает %s:%s%s", listen, port, url_path)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    await stop_event.wait()
+
+    # Новые апдейты получают 503, Telegram повторит их позже
+    draining = True
+    logger.info("Остановка: дожидаемся разбора очереди апдейтов")
+    return runner.cleanup
+
+
+async def _start_application(application):
+    # run_polling вызывает post_init/post_shutdown сам, здесь это делаем вручную
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+
+async def _drain(application, drain_timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + drain_timeout
+    while application.update_queue.qsize() and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+
+
+async def _stop_application(application):
+    await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+async def _set_webhook(bot, webhook_url, secret_token):
+    await bot.set_webhook(url=webhook_url,
+                          secret_token=secret_token,
+                          allowed_updates=Update.ALL_TYPES)
+
+
+async def run_webhook(application, listen, port, url_path, webhook_url=None, secret_token=None,
+                      drain_timeout=10.0):
+    """Принимает апдейты по вебхуку на собственном aiohttp-сервере.
+
+    POST на url_path кладёт апдейт в очередь приложения, GET /healthz
+    отвечает 200, пока бот принимает апдейты, и 503 во время остановки.
+    По SIGINT/SIGTERM сервер перестаёт брать новые апдейты (Telegram
+    повторит их на другую реплику), дожидается разбора очереди не дольше
+    drain_timeout секунд и только потом останавливает приложение.
+    """
+    async def accept(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    def status():
+        return {'queue': application.update_queue.qsize()}
+
+    await _start_application(application)
+    if webhook_url:
+        await _set_webhook(application.bot, webhook_url, secret_token)
+    try:
+        cleanup = await _serve_http(listen, port, url_path, secret_token, accept, status)
+        # Пока очередь разбирается, /healthz уже отвечает 503
+        await _drain(application, drain_timeout)
+        await cleanup()
+    finally:
+        await _stop_application(application)
+
+
+async def _pump_updates(application, queue, drain_timeout):
+    loop = asyncio.get_running_loop()
+    await _start_application(application)
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await _drain(application, drain_timeout)
+    finally:
+        await _stop_application(application)
+
+
+def _run_worker(build_application, token, index, count, queue, drain_timeout):
+    # Останавливает воркеры роутер, отправляя None в очередь: сигналы от
+    # терминала или systemd приходят всей группе процессов, и воркер не должен
+    # бросить недоразобранные апдейты раньше роутера
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    application = build_application(token, shard=(index, count))
+    asyncio.run(_pump_updates(application, queue, drain_timeout))
+
+
+def run_router(build_application, token, workers, listen, port, url_path, webhook_url=None,
+               secret_token=None, drain_timeout=10.0):
+    """Вебхук с несколькими процессами-воркерами.
+
+    Роутер принимает апдейты и отдаёт каждый воркеру номер user_id % workers,
+    так что пользователь всегда обслуживается одним процессом: его таймер,
+    кеш статистики и состояние диалога живут в одном месте. Воркер строится
+    вызовом build_application(token, shard=(номер, workers)) в отдельном
+    процессе; общая у воркеров только БД.
+    """
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [context.Process(target=_run_worker, name=f'bot-worker-{index}',
+                                 args=(build_application, token, index, workers, queue,
+                                       drain_timeout))
+                 for index, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+
+    async def accept(data):
+        queues[route_key(data) % workers].put(data)
+
+    def status():
+        alive = [process.is_alive() for process in processes]
+        return {'workers': len(alive), 'alive': sum(alive), 'healthy': all(alive)}
+
+    async def serve():
+        if webhook_url:
+            async with Bot(token) as bot:
+                await _set_webhook(bot, webhook_url, secret_token)
+        cleanup = await _serve_http(listen, port, url_path, secret_token, accept, status)
+        await cleanup()
+
+    try:
+        asyncio.run(serve())
+    finally:
+        # Воркер дорабатывает всё, что стоит в его очереди перед None
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(drain_timeout + 30)
+            if process.is_alive():
+                logger.warning("Воркер %s не остановился, завершаем принудительно", process.name)
+                process.terminate()